@@ -0,0 +1,203 @@
+"""Per-day, per-tier usage and revenue rollups.
+
+app.py records events as they happen: signups, logins, generations and
+tokens, checkouts, tier changes and paid invoices from Stripe webhooks,
+and users reaching their tier's limit. Increments are aggregated in
+memory and added onto the usage_rollups table in bulk by a
+WriteBehindBuffer (value = value + n), like usage metering, so workers
+never overwrite each other and a request never waits on the write.
+
+The table holds one row per (day, tier, metric), a few dozen rows a day
+however many users there are, and /admin/stats reads nothing else. The
+"users" metric is a net change: +1 on signup, and -1/+1 when a user moves
+between tiers. Summing it over all days gives the users per tier now.
+
+`python analytics.py backfill` rebuilds the metrics that can be derived
+from the users table (signups, users) in one streaming pass. The others
+only exist as events and are kept as they are.
+"""
+import argparse
+import math
+from collections import Counter
+from datetime import datetime, timedelta, timezone
+
+from sqlalchemy import delete, func, select
+from sqlalchemy.dialects import postgresql, sqlite
+
+from db import UsageRollup, User
+from metering import WriteBehindBuffer
+
+# Rebuilt by backfill(); everything else is event-only
+DERIVED_METRICS = ("signups", "users")
+
+
+def _day(when=None):
+    """UTC date of an epoch timestamp, datetime or date (today for None)."""
+    if when is None:
+        return datetime.now(timezone.utc).date()
+    if isinstance(when, (int, float)):
+        return datetime.fromtimestamp(when, timezone.utc).date()
+    if isinstance(when, datetime):
+        return (when.astimezone(timezone.utc) if when.tzinfo else when).date()
+    return when
+
+
+def _aware(moment):
+    # Naive timestamps in the users table are UTC
+    return moment if moment.tzinfo else moment.replace(tzinfo=timezone.utc)
+
+
+def _insert(bind):
+    dialect = postgresql if bind.dialect.name == "postgresql" else sqlite
+    return dialect.insert(UsageRollup.__table__)
+
+
+def apply_rollups(batch, bind):
+    """Add {(day, tier): {metric: n}} onto the stored counters in one transaction."""
+    rows = [
+        {"day": day, "tier": tier, "metric": metric, "value": n}
+        for (day, tier), counts in batch.items()
+        for metric, n in counts.items() if n
+    ]
+    if not rows:
+        return
+    stmt = _insert(bind)
+    stmt = stmt.on_conflict_do_update(
+        index_elements=["day", "tier", "metric"],
+        set_={"value": UsageRollup.__table__.c.value + stmt.excluded.value}
+    )
+    with bind.begin() as conn:
+        conn.execute(stmt, rows)
+
+
+class Rollups:
+    def __init__(self, bind, free_tier="free", near_limit=0.8, max_pending=500, interval=5.0):
+        self.bind = bind
+        self.free_tier = free_tier
+        self.near_limit = near_limit
+        self.buffer = WriteBehindBuffer(lambda batch: apply_rollups(batch, bind), max_pending, interval)
+
+    def record(self, tier, when=None, **counts):
+        """Add counts to tier's rollup for the day of `when` (default today)."""
+        self.buffer.add((_day(when), tier or self.free_tier), **counts)
+
+    def record_reservation(self, tier, before, after, limit):
+        """Count a user crossing near_limit of the tier's limit, and reaching it."""
+        if limit <= 0:
+            return
+        counts = {}
+        if before < math.ceil(limit * self.near_limit) <= after:
+            counts["near_limit"] = 1
+        if before < limit <= after:
+            counts["at_limit"] = 1
+        if counts:
+            self.record(tier, **counts)
+
+    def record_tier_change(self, previous, tier, trial_ends_at=None, when=None):
+        """Move a user between tiers. An upgrade from free while the trial
+        is still running also counts as a trial conversion."""
+        previous = previous or self.free_tier
+        if previous == tier:
+            return
+        moment = datetime.fromtimestamp(when, timezone.utc) if when else datetime.now(timezone.utc)
+        self.record(previous, moment, users=-1)
+        self.record(tier, moment, users=1)
+        if previous == self.free_tier:
+            trial = trial_ends_at is not None and _aware(trial_ends_at) > moment
+            self.record(tier, moment, upgrades=1, trial_conversions=int(trial))
+        elif tier == self.free_tier:
+            self.record(previous, moment, cancellations=1)
+        else:
+            self.record(tier, moment, plan_changes=1)
+
+    def summary(self, days, limits):
+        """Totals over the last `days` days per tier, current users per tier
+        and the daily series. limits is {tier: usage limit}."""
+        since = _day() - timedelta(days=days - 1)
+        table = UsageRollup.__table__
+        with self.bind.connect() as conn:
+            rows = conn.execute(
+                select(table.c.day, table.c.tier, table.c.metric, table.c.value)
+                .where(table.c.day >= since)
+                .order_by(table.c.day)
+            ).all()
+            users = dict(conn.execute(
+                select(table.c.tier, func.sum(table.c.value))
+                .where(table.c.metric == "users")
+                .group_by(table.c.tier)
+            ).all())
+
+        daily = {}
+        totals = {tier: Counter() for tier in limits}
+        for day, tier, metric, value in rows:
+            daily.setdefault(day.isoformat(), {}).setdefault(tier, {})[metric] = value
+            totals.setdefault(tier, Counter())[metric] += value
+
+        overall = sum(totals.values(), Counter())
+        signups = overall["signups"]
+        return {
+            "since": since.isoformat(),
+            "days": days,
+            "tiers": {
+                tier: {
+                    "users": int(users.get(tier) or 0),
+                    "limit": limits.get(tier),
+                    "totals": dict(counts)
+                }
+                for tier, counts in totals.items()
+            },
+            "conversion": {
+                "signups": signups,
+                "upgrades": overall["upgrades"],
+                "trial_conversions": overall["trial_conversions"],
+                "trial_conversion_rate": round(overall["trial_conversions"] / signups, 4) if signups else None
+            },
+            "daily": daily
+        }
+
+    def stats(self):
+        return {"flushes": self.buffer.flushes, "failures": self.buffer.failures}
+
+
+def backfill(bind, free_tier="free", batch_size=1000):
+    """Rebuild DERIVED_METRICS from one streaming pass over users.
+
+    Every user counts as a signup (on the free tier, where signup puts
+    them) on the day they were created, and as a user of their current
+    tier. Returns the number of rollup rows written.
+    """
+    counts = Counter()
+    users = User.__table__
+    with bind.connect() as conn:
+        result = conn.execution_options(yield_per=batch_size).execute(
+            select(users.c.tier, users.c.created_at))
+        for tier, created_at in result:
+            day = _day(created_at)
+            counts[(day, free_tier, "signups")] += 1
+            counts[(day, tier or free_tier, "users")] += 1
+
+    rows = [{"day": day, "tier": tier, "metric": metric, "value": n}
+            for (day, tier, metric), n in sorted(counts.items())]
+    table = UsageRollup.__table__
+    with bind.begin() as conn:
+        conn.execute(delete(table).where(table.c.metric.in_(DERIVED_METRICS)))
+        for start in range(0, len(rows), batch_size):
+            conn.execute(table.insert(), rows[start:start + batch_size])
+    return len(rows)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Maintain the usage_rollups table.")
+    commands = parser.add_subparsers(dest="command", required=True)
+    rebuild = commands.add_parser("backfill", help="Rebuild signups/users from the users table")
+    rebuild.add_argument("--batch-size", type=int, default=1000)
+    args = parser.parse_args()
+
+    from db import engine, init_db
+    init_db()
+    written = backfill(engine, batch_size=args.batch_size)
+    print(f"Rebuilt {', '.join(DERIVED_METRICS)}: {written} rollup rows")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,23 +1,213 @@
-from flask import Flask, request, jsonify, render_template, redirect, session
-from supabase import create_client, Client
-from openai import OpenAI
+from flask import Flask, Response, request, jsonify, render_template, redirect, session, g, abort
 from dotenv import load_dotenv
-import stripe
 import os
-from datetime import datetime, timedelta
+from datetime import datetime, timedelta, timezone
 from functools import wraps
-import jwt
+from contextlib import contextmanager
+import json
+import logging
+import mimetypes
+import tempfile
+import threading
+import time
+import uuid
+import contextvars
+
+from streaming import wants_event_stream, sse_event, iter_completion_text
+from response_cache import ResponseCache, make_cache_key
+from entitlements import Entitlement, EntitlementCache, parse_timestamp, encode_entitlement, decode_entitlement
+from cachestore import SharedMemoryStore
+from db import SessionLocal, User, engine, apply_usage, migrate
+from history import save_generations, list_generations
+from batch import parse_batch, run_batch, create_job, update_job, get_job
+from resilience import Resilience, Deadline, DeadlineExceeded, CircuitOpen
+from metering import UsageMeter, WriteBehindBuffer
+from scheduler import DispatchScheduler, QueueFull
+from async_runtime import AsyncRuntime
+from metrics import Metrics
+from outbox import Outbox
+from idempotency import IdempotencyStore, record_key, fingerprint, REPLAY, RUNNING, MISMATCH
+from stripe_events import parse_price_tiers, subscription_change, apply_changes, invoice_payment
+from analytics import Rollups
+from ratelimit import SharedBuckets
+from clients import LazyClient
+from auth_tokens import TokenVerifier, JWKSKeys, InvalidToken
+from transport import TransportPools
+from tokens import count_tokens, truncate_to_tokens
+from pagecache import PageCache, IMMUTABLE, REVALIDATE
+import applog
+from werkzeug.security import safe_join
+from werkzeug.middleware.proxy_fix import ProxyFix
 
 # Load environment variables FIRST
 load_dotenv()
 
+# LOGGING (JSON lines written off the request thread, see applog.py)
+log_handler = applog.configure(max_queue=int(os.getenv("LOG_QUEUE_SIZE", 10000)))
+logger = logging.getLogger("app")
+# Share of successful requests/upstream calls logged; errors and slow ones always are
+LOG_SAMPLE_RATE = float(os.getenv("LOG_SAMPLE_RATE", 0.1))
+LOG_SLOW_MS = float(os.getenv("LOG_SLOW_MS", 2000))
+
 # Initialize Flask app
 app = Flask(__name__)
-app.secret_key = os.getenv("SECRET_KEY") or os.getenv(
-    "APP_SECRET") or "dev-secret"
+SECRET_KEY = os.getenv("SECRET_KEY") or os.getenv("APP_SECRET")
+app.secret_key = SECRET_KEY or "dev-secret"
+
+# Behind Render/nginx the client address is in X-Forwarded-For; trust that many hops.
+# Left unset, every client may share the proxy's address, so per-IP rate limits
+# stay off until it is set (0 when clients connect directly).
+TRUSTED_PROXIES = os.getenv("TRUSTED_PROXIES")
+if TRUSTED_PROXIES is None:
+    logger.warning("TRUSTED_PROXIES is not set; per-IP rate limits are off until it is "
+                   "(1 behind Render's proxy, 0 when clients connect directly)")
+TRUSTED_PROXIES = int(TRUSTED_PROXIES or 0)
+if TRUSTED_PROXIES:
+    app.wsgi_app = ProxyFix(app.wsgi_app, x_for=TRUSTED_PROXIES, x_proto=TRUSTED_PROXIES)
 
 JWT_SECRET = os.getenv("JWT_SECRET")
 
+# METRICS (request + upstream latency, scraped at /metrics)
+metrics = Metrics(flush_interval=float(os.getenv("METRICS_FLUSH_INTERVAL", 5.0)))
+
+
+def _incoming_request_id():
+    """The caller's X-Request-ID if it looks sane, else a fresh one."""
+    rid = request.headers.get("X-Request-ID", "")
+    if 0 < len(rid) <= 128 and rid.isprintable() and " " not in rid:
+        return rid
+    return uuid.uuid4().hex
+
+
+@app.before_request
+def _start_request_timer():
+    g.request_started = time.perf_counter()
+    g.request_id = _incoming_request_id()
+    applog.request_id_var.set(g.request_id)
+
+
+@app.after_request
+def _record_request_latency(response):
+    started = g.pop("request_started", None)
+    if started is not None:
+        elapsed = time.perf_counter() - started
+        status = response.status_code
+        metrics.observe(
+            "http_request_duration_seconds",
+            elapsed,
+            endpoint=request.endpoint or "unmatched",
+            method=request.method,
+            status=str(status)
+        )
+        # 429s come in floods when someone is being throttled; sample them too
+        noisy = status < 400 or status == 429
+        if not noisy or elapsed * 1000 >= LOG_SLOW_MS or applog.sampled(LOG_SAMPLE_RATE):
+            logger.log(logging.WARNING if status >= 500 else logging.INFO, "request", extra={
+                "method": request.method,
+                "path": request.path,
+                "endpoint": request.endpoint,
+                "status": status,
+                "duration_ms": round(elapsed * 1000, 1),
+                "sampled": noisy
+            })
+    if "request_id" in g:
+        response.headers["X-Request-ID"] = g.request_id
+    return response
+
+
+@app.teardown_request
+def _clear_log_context(_error=None):
+    # Sync workers reuse the thread for the next request
+    applog.request_id_var.set(None)
+    applog.user_id_var.set(None)
+
+
+@contextmanager
+def _upstream(service, operation):
+    """metrics.upstream plus a log line; failures always logged, successes sampled."""
+    started = time.perf_counter()
+    try:
+        with metrics.upstream(service, operation):
+            yield
+    except Exception as e:
+        logger.warning("upstream call failed", extra={
+            "service": service, "operation": operation,
+            "status": getattr(e, "status_code", None) or getattr(e, "http_status", None),
+            "duration_ms": round((time.perf_counter() - started) * 1000, 1),
+            "error": str(e)
+        })
+        raise
+    elapsed_ms = (time.perf_counter() - started) * 1000
+    if elapsed_ms >= LOG_SLOW_MS or applog.sampled(LOG_SAMPLE_RATE):
+        logger.info("upstream call", extra={
+            "service": service, "operation": operation,
+            "duration_ms": round(elapsed_ms, 1), "sampled": True
+        })
+
+# SHARED CACHES (one copy per host for every worker, see cachestore.py;
+# CACHE_BACKEND=local keeps a separate copy in each worker instead)
+CACHE_BACKEND = os.getenv("CACHE_BACKEND", "shared")
+SHARED_CACHE_DIR = os.getenv("SHARED_CACHE_DIR", tempfile.gettempdir())
+
+
+def _shared_store(name, max_entries, ttl, slot_size, **codec):
+    if CACHE_BACKEND != "shared":
+        return None
+    path = os.path.join(SHARED_CACHE_DIR, f"aiassistantpros-{name}.bin")
+    return SharedMemoryStore(path, max_entries, ttl, slot_size, **codec)
+
+
+# ENTITLEMENTS (tier/usage per JWT subject, cached in front of the DB)
+ENTITLEMENT_CACHE_MAX_ENTRIES = int(os.getenv("ENTITLEMENT_CACHE_MAX_ENTRIES", 10000))
+ENTITLEMENT_CACHE_TTL = int(os.getenv("ENTITLEMENT_CACHE_TTL", 30))
+entitlements = EntitlementCache(
+    max_entries=ENTITLEMENT_CACHE_MAX_ENTRIES,
+    ttl=ENTITLEMENT_CACHE_TTL,
+    store=_shared_store("entitlements", ENTITLEMENT_CACHE_MAX_ENTRIES, ENTITLEMENT_CACHE_TTL, 512,
+                        dumps=encode_entitlement, loads=decode_entitlement)
+)
+
+
+def _load_entitlement(subject, email):
+    """Read tier/usage for one user from the DB. Returns None if unknown."""
+    db = SessionLocal()
+    try:
+        user = db.query(User).filter(User.email == email).first()
+        if not user:
+            return None
+        return Entitlement(
+            subject=subject,
+            id=user.id,
+            email=user.email,
+            tier=user.tier or "free",
+            used=user.used or 0,
+            trial_ends_at=parse_timestamp(user.trial_ends_at)
+        )
+    finally:
+        db.close()
+
+
+def _session_entitlement():
+    """Entitlement for the logged-in browser session, or None."""
+    user = session.get("user")
+    if not isinstance(user, dict) or not user.get("id"):
+        return None
+    subject = user["id"]
+    entitlement = entitlements.get(
+        subject, lambda: _load_entitlement(subject, user.get("email")))
+    if entitlement is None:
+        # No profile row yet; fall back to what login stored
+        entitlement = Entitlement(
+            subject=subject,
+            id=user["id"],
+            email=user.get("email"),
+            tier=user.get("tier", "free"),
+            used=0,
+            trial_ends_at=parse_timestamp(user.get("trial_ends_at"))
+        )
+        entitlements.put(entitlement)
+    return entitlement
+
 
 def token_required(f):
     @wraps(f)
@@ -29,21 +219,18 @@ def token_required(f):
 
         try:
             token = auth_header.split(" ")[1]
-            payload = jwt.decode(
-                token,
-                app.secret_key,
-                algorithms=["HS256"]
-            )
-        except Exception:
+            payload = token_verifier.verify(token)
+        except (IndexError, InvalidToken):
             return jsonify({"error": "Invalid or expired token"}), 401
 
-        db = SessionLocal()
-        user = db.query(User).filter(User.email == payload["email"]).first()
-        db.close()
+        email = payload.get("email")
+        subject = payload.get("sub") or email
+        user = entitlements.get(subject, lambda: _load_entitlement(subject, email))
 
         if not user:
             return jsonify({"error": "User not found"}), 401
 
+        applog.user_id_var.set(user.id)
         return f(user, *args, **kwargs)
 
     return decorated
@@ -54,22 +241,106 @@ SUPABASE_KEY = os.getenv("SUPABASE_KEY") or os.getenv("SUPABASE_SERVICE_ROLE")
 
 # Validate Supabase credentials
 if not SUPABASE_URL or not SUPABASE_KEY:
-    print("[WARNING] Supabase credentials not fully configured")
-    print(f"  SUPABASE_URL: {'✓' if SUPABASE_URL else '✗'}")
-    print(f"  SUPABASE_KEY: {'✓' if SUPABASE_KEY else '✗'}")
+    logger.warning("Supabase credentials not fully configured", extra={
+        "supabase_url_set": bool(SUPABASE_URL), "supabase_key_set": bool(SUPABASE_KEY)})
     # Use dummy values for now (app will still initialize but auth/DB will fail gracefully)
     SUPABASE_URL = SUPABASE_URL or "https://placeholder.supabase.co"
     SUPABASE_KEY = SUPABASE_KEY or "placeholder-key"
 
-try:
-    supabase: Client = create_client(SUPABASE_URL, SUPABASE_KEY)
-except Exception as e:
-    print(f"[WARNING] Failed to initialize Supabase client: {str(e)}")
-    supabase = None
+
+
+# SERVING MODE (see gunicorn.conf.py): in async mode upstream calls run on a
+# shared event loop and each worker has GUNICORN_THREADS request threads
+# (same default as gunicorn.conf.py), any of which may be waiting on OpenAI
+ASYNC_MODE = os.getenv("ASYNC_MODE", "").lower() in ("1", "true", "yes")
+WORKER_THREADS = int(os.getenv("GUNICORN_THREADS", 256 if ASYNC_MODE else 1))
+# OpenAI calls in flight per worker. A sync worker has few threads, so 16
+# is plenty; an async worker keeps more in flight, but still fewer than its
+# request threads, so bursts wait in the dispatcher's weighted queues and
+# low-priority traffic is shed instead of every thread going straight upstream
+OPENAI_MAX_CONCURRENCY = int(os.getenv("OPENAI_MAX_CONCURRENCY", max(16, WORKER_THREADS // 4) if ASYNC_MODE else 16))
+
+# HTTP TRANSPORT (one keep-alive pool per upstream per worker, see transport.py)
+transport_pools = TransportPools(
+    max_connections=int(os.getenv("HTTP_POOL_MAX_CONNECTIONS", max(100, WORKER_THREADS))),
+    max_keepalive=int(os.getenv("HTTP_POOL_MAX_KEEPALIVE", max(64, WORKER_THREADS))),
+    keepalive_expiry=float(os.getenv("HTTP_KEEPALIVE_EXPIRY", 30)),
+    http2=None if os.getenv("HTTP2") is None else os.getenv("HTTP2").lower() in ("1", "true", "yes"),
+    dns_ttl=float(os.getenv("DNS_CACHE_TTL", 60))
+)
+# Timeout for Supabase calls (OpenAI and Stripe pass their own per request)
+SUPABASE_TIMEOUT = float(os.getenv("SUPABASE_TIMEOUT", 30))
+
+
+def _build_supabase():
+    from supabase import create_client, ClientOptions
+    try:
+        http_client = transport_pools.client("supabase", timeout=SUPABASE_TIMEOUT, follow_redirects=True)
+        return create_client(SUPABASE_URL, SUPABASE_KEY, options=ClientOptions(httpx_client=http_client))
+    except Exception as e:
+        logger.warning("Failed to initialize Supabase client", extra={"error": str(e)})
+        return None
+
+
+# Built on first use, once per worker (clients.py)
+supabase = LazyClient(_build_supabase, "supabase")
+
+# API TOKENS (Supabase access tokens verified locally, see auth_tokens.py)
+SUPABASE_JWT_ISSUER = f"{SUPABASE_URL.rstrip('/')}/auth/v1"
+_jwks_http = LazyClient(lambda: transport_pools.client("supabase", timeout=5), "jwks http")
+
+
+def _fetch_jwks(url):
+    response = _jwks_http.get(url)
+    response.raise_for_status()
+    return response.json()
+
+
+token_verifier = TokenVerifier(
+    secret=JWT_SECRET,
+    jwks=JWKSKeys(f"{SUPABASE_JWT_ISSUER}/.well-known/jwks.json", _fetch_jwks,
+                  refresh_interval=float(os.getenv("JWKS_REFRESH_INTERVAL", 600))),
+    issuer=SUPABASE_JWT_ISSUER,
+    audience=os.getenv("SUPABASE_JWT_AUDIENCE", "authenticated"),
+    # Tokens this API signed itself before Supabase tokens were accepted; never
+    # with the public dev fallback, which anyone could sign with
+    legacy_secret=SECRET_KEY,
+    max_entries=int(os.getenv("TOKEN_CACHE_MAX_ENTRIES", 10000))
+)
 
 # STRIPE CONFIG
-stripe.api_key = os.getenv("STRIPE_SECRET_KEY") or os.getenv("STRIPE_API_KEY")
+
+
+def _load_stripe():
+    import stripe
+    stripe.api_key = os.getenv("STRIPE_SECRET_KEY") or os.getenv("STRIPE_API_KEY")
+    if os.getenv("STRIPE_API_BASE"):
+        # Point at a local stand-in (benchmarks/fakes.py)
+        stripe.api_base = os.getenv("STRIPE_API_BASE")
+    stripe.default_http_client = _stripe_http_client(stripe)
+    return stripe
+
+
+def _stripe_http_client(stripe):
+    """stripe.HTTPXClient for sync and async calls, on the shared pools.
+
+    HTTPXClient has no option for bringing your own httpx clients, so the
+    ones it builds are replaced (same CA bundle verification).
+    """
+    import ssl
+    http_client = stripe.HTTPXClient(allow_sync_methods=True)
+    http_client._client.close()
+    verify = ssl.create_default_context(cafile=stripe.ca_bundle_path)
+    http_client._client = transport_pools.client("stripe", verify=verify)
+    http_client._client_async = transport_pools.async_client("stripe", verify=verify)
+    return http_client
+
+
+stripe = LazyClient(_load_stripe, "stripe")
 YOUR_DOMAIN = os.getenv("DOMAIN_URL", "http://127.0.0.1:5000")
+STRIPE_WEBHOOK_SECRET = os.getenv("STRIPE_WEBHOOK_SECRET")
+# Which tier each price grants, e.g. "price_a:pro,price_b:agency"
+PRICE_TIERS = parse_price_tiers(os.getenv("STRIPE_PRICE_TIERS"), os.getenv("STRIPE_PRICE_ID"))
 
 # =========================
 # TIER DEFINITIONS (SOURCE OF TRUTH)
@@ -79,30 +350,503 @@ TIERS = {
         "limit": 1,
         "can_save": False,
         "can_rerun": False,
-        "priority": "low"
+        "priority": "low",
+        "model": "gpt-4o-mini",
+        "fallback_model": "gpt-3.5-turbo",
+        "hedge": False,
+        "deadline": 30,
+        "max_batch": 0,
+        "max_input_tokens": 1000,
+        "max_output_tokens": 300,
+        "rate_per_minute": 6,
+        "burst": 3
     },
     "pro": {
         "limit": 20,
         "can_save": True,
         "can_rerun": True,
-        "priority": "high"
+        "priority": "high",
+        "model": "gpt-4o-mini",
+        "fallback_model": "gpt-3.5-turbo",
+        "hedge": True,
+        "deadline": 60,
+        "max_batch": 0,
+        "max_input_tokens": 4000,
+        "max_output_tokens": 1000,
+        "rate_per_minute": 30,
+        "burst": 10
     },
     "agency": {
         "limit": 200,
         "can_save": True,
         "can_rerun": True,
-        "priority": "highest"
+        "priority": "highest",
+        "model": "gpt-4o",
+        "fallback_model": "gpt-4o-mini",
+        "hedge": True,
+        "deadline": 90,
+        "max_batch": 200,
+        "max_input_tokens": 8000,
+        "max_output_tokens": 2000,
+        "rate_per_minute": 120,
+        "burst": 30
     }
 }
 def tier_allows(user, capability):
+    """user is an Entitlement; None means the logged-in session user."""
+    if user is None:
+        user = _session_entitlement()
+        if user is None:
+            return False
     tier = user.tier
     return TIERS.get(tier, {}).get(capability, False)
 
 # OPENAI CLIENT
-client = OpenAI(api_key=os.getenv("OPENAI_API_KEY"))
 
 
-print("[INFO] App initialized successfully")
+def _build_openai():
+    from openai import OpenAI, DefaultHttpxClient
+    # Retries, fallback and hedging are handled by openai_resilience
+    return OpenAI(api_key=os.getenv("OPENAI_API_KEY"), max_retries=OPENAI_MAX_RETRIES,
+                  http_client=transport_pools.client("openai", cls=DefaultHttpxClient))
+
+
+client = LazyClient(_build_openai, "openai")
+OPENAI_MAX_RETRIES = int(os.getenv("OPENAI_MAX_RETRIES", 0))
+GENERATE_TEMPERATURE = 0.3
+
+# =========================
+# ASYNC MODE (upstream calls on a shared event loop, see gunicorn.conf.py)
+# =========================
+runtime = AsyncRuntime()
+
+
+async def _build_async_openai():
+    from openai import AsyncOpenAI, DefaultAsyncHttpxClient
+    return AsyncOpenAI(api_key=os.getenv("OPENAI_API_KEY"), max_retries=OPENAI_MAX_RETRIES,
+                       http_client=transport_pools.async_client("openai", cls=DefaultAsyncHttpxClient))
+
+
+async def _build_async_supabase():
+    from supabase import acreate_client, AsyncClientOptions
+    http_client = transport_pools.async_client("supabase", timeout=SUPABASE_TIMEOUT, follow_redirects=True)
+    return await acreate_client(SUPABASE_URL, SUPABASE_KEY,
+                                options=AsyncClientOptions(httpx_client=http_client))
+
+
+def _chat_completion(model, prompt, **kwargs):
+    """chat.completions.create on whichever client the serving mode uses."""
+    params = dict(
+        model=model,
+        messages=[{"role": "user", "content": prompt}],
+        temperature=GENERATE_TEMPERATURE,
+        **kwargs
+    )
+    with _upstream("openai", "chat.completions"):
+        if not ASYNC_MODE:
+            return client.chat.completions.create(**params)
+        aclient = runtime.resource("openai", _build_async_openai)
+        response = runtime.run(aclient.chat.completions.create(**params))
+    if kwargs.get("stream"):
+        return runtime.iterate(response)
+    return response
+
+
+# OPENAI RESILIENCE (per-tier model + fallback, deadlines, hedging, breakers)
+OPENAI_MAX_HEDGES = int(os.getenv("OPENAI_MAX_HEDGES", 8))
+openai_resilience = Resilience(
+    max_hedges=OPENAI_MAX_HEDGES,
+    # Hedged tiers run every attempt on this pool; room for all of them.
+    # Each hedge also takes a dispatcher slot, see _spare_dispatch_slot()
+    max_workers=OPENAI_MAX_CONCURRENCY + OPENAI_MAX_HEDGES,
+    error_ratio=float(os.getenv("OPENAI_BREAKER_ERROR_RATIO", 0.5)),
+    cooldown=float(os.getenv("OPENAI_BREAKER_COOLDOWN", 15))
+)
+
+
+def _request_deadline(tier):
+    """The tier's deadline, shortened if the client says it gives up sooner."""
+    seconds = TIERS[tier]["deadline"]
+    try:
+        seconds = min(seconds, float(request.headers.get("X-Request-Timeout", seconds)))
+    except ValueError:
+        pass
+    return Deadline(seconds)
+
+
+def _tier_completion(tier, prompt, deadline, **kwargs):
+    """_chat_completion on the tier's model, falling back to its fallback_model.
+
+    Returns (response, model). Streams are never hedged.
+    """
+    config = TIERS[tier]
+    return openai_resilience.call(
+        lambda model, timeout: _chat_completion(model, prompt, timeout=timeout, **kwargs),
+        [config["model"], config.get("fallback_model")],
+        deadline,
+        hedge=config.get("hedge", False) and not kwargs.get("stream"),
+        hedge_slot=lambda: _spare_dispatch_slot(config["priority"])
+    )
+
+
+def _spare_dispatch_slot(priority):
+    """A hedge is one more OpenAI call, so it holds a dispatcher slot like any
+    other; it is only sent if one is free without waiting. Returns the
+    function that gives the slot back, or None."""
+    ticket = dispatcher.try_acquire(priority)
+    if ticket is None:
+        return None
+    return lambda: dispatcher.release(ticket)
+
+
+def _supabase_available():
+    """Whether the Supabase client this serving mode uses can be built.
+
+    Truth-testing `supabase` would build the sync client, which async mode
+    never uses.
+    """
+    if not ASYNC_MODE:
+        return bool(supabase)
+    try:
+        runtime.resource("supabase", _build_async_supabase)
+        return True
+    except Exception as e:
+        logger.warning("Failed to initialize Supabase client", extra={"error": str(e)})
+        return False
+
+
+def _supabase_call(service, operation, build):
+    """Run build(client) against the sync or async Supabase client.
+
+    build returns either a result or, for the async client, an awaitable.
+    service/operation label the upstream latency metric.
+    """
+    with _upstream(service, operation):
+        if not ASYNC_MODE:
+            return build(supabase)
+
+        # Resolve the client here: building it from inside the loop would deadlock
+        asupabase = runtime.resource("supabase", _build_async_supabase)
+
+        async def call():
+            return await build(asupabase)
+
+        return runtime.run(call())
+
+
+# =========================
+# OUTBOX (background jobs that must not block or be lost)
+# =========================
+outbox = Outbox(
+    os.getenv("OUTBOX_PATH", "outbox.db"),
+    batch_size=int(os.getenv("OUTBOX_BATCH_SIZE", 50))
+)
+
+
+def _insert_user_profiles(jobs):
+    """Batch-create profiles queued by signup(). Upsert on id makes retries harmless."""
+    rows = [payload for _, payload in jobs]
+    _supabase_call("supabase_table", "users.upsert", lambda sb: sb.table("users").upsert(
+        rows, on_conflict="id", ignore_duplicates=True).execute())
+
+
+outbox.register("user_profile", _insert_user_profiles)
+
+
+def _apply_stripe_events(jobs):
+    """Apply a batch of queued Stripe events to users.tier in one transaction."""
+    events = sorted((payload for _, payload in jobs), key=lambda e: e.get("created", 0))
+    changes = [c for c in (subscription_change(e, PRICE_TIERS) for e in events) if c]
+    payments = [p for p in (invoice_payment(e, PRICE_TIERS) for e in events) if p]
+    touched = []
+    if changes:
+        db = SessionLocal()
+        try:
+            touched = apply_changes(db, changes, TIERS)
+            db.commit()
+        except Exception:
+            db.rollback()
+            raise
+        finally:
+            db.close()
+    # Counted only once the batch has applied, so a retried batch isn't counted twice
+    for change in touched:
+        entitlements.invalidate(change.user_id)
+        entitlements.invalidate(change.email)
+        rollups.record_tier_change(change.previous_tier, change.tier, change.trial_ends_at, change.created)
+    for tier, currency, amount, created in payments:
+        rollups.record(tier, created, payments=1, **{f"revenue_{currency}": amount})
+
+
+outbox.register("stripe_event", _apply_stripe_events)
+
+
+def _save_generations(jobs):
+    """Store a batch of generations queued by generate() (see history.py)."""
+    save_generations([payload for _, payload in jobs], engine)
+
+
+outbox.register("generation", _save_generations)
+
+
+@app.before_request
+def _ensure_outbox_worker():
+    outbox.ensure_worker()
+
+
+def _create_checkout_session(**params):
+    with _upstream("stripe", "checkout.sessions.create"):
+        if not ASYNC_MODE:
+            return stripe.checkout.Session.create(**params)
+        return runtime.run(stripe.checkout.Session.create_async(**params))
+
+# USAGE METERING (reservations are atomic UPDATEs on users.used, token
+# counts are flushed to the DB in bulk)
+usage_meter = UsageMeter(WriteBehindBuffer(
+    apply_usage,
+    max_pending=int(os.getenv("USAGE_FLUSH_MAX_PENDING", 100)),
+    interval=float(os.getenv("USAGE_FLUSH_INTERVAL", 2.0))
+))
+
+# ANALYTICS (per-day, per-tier rollups for /admin/stats, flushed in bulk)
+rollups = Rollups(engine, interval=float(os.getenv("ANALYTICS_FLUSH_INTERVAL", 5.0)))
+ADMIN_EMAILS = {e.strip().lower() for e in os.getenv("ADMIN_EMAILS", "").split(",") if e.strip()}
+
+# OPENAI DISPATCH (bounded concurrency, weighted by TIERS[...]["priority"]).
+# In async mode any request thread may wait in any class's queue
+dispatcher = DispatchScheduler(max_concurrency=OPENAI_MAX_CONCURRENCY)
+
+# RESPONSE CACHE (tiers without can_rerun get cached outputs)
+RESPONSE_CACHE_MAX_ENTRIES = int(os.getenv("RESPONSE_CACHE_MAX_ENTRIES", 1024))
+RESPONSE_CACHE_TTL = int(os.getenv("RESPONSE_CACHE_TTL", 600))
+response_cache = ResponseCache(
+    max_entries=RESPONSE_CACHE_MAX_ENTRIES,
+    max_bytes=int(os.getenv("RESPONSE_CACHE_MAX_BYTES", 8 * 1024 * 1024)),
+    ttl=RESPONSE_CACHE_TTL,
+    # Outputs over a slot (compressed) stay in the worker's own cache only
+    store=_shared_store("responses", RESPONSE_CACHE_MAX_ENTRIES, RESPONSE_CACHE_TTL,
+                        int(os.getenv("RESPONSE_CACHE_SLOT_SIZE", 8192)))
+)
+
+# =========================
+# RATE LIMITING (token buckets shared by every worker on the host)
+# =========================
+RATE_LIMIT_ENABLED = os.getenv("RATE_LIMIT_ENABLED", "true").lower() in ("1", "true", "yes")
+IP_RATE_LIMIT_ENABLED = RATE_LIMIT_ENABLED and "TRUSTED_PROXIES" in os.environ
+rate_buckets = SharedBuckets(os.getenv("RATE_LIMIT_PATH"))
+
+# Per-client-IP limits for each protected endpoint: (requests per minute, burst)
+IP_RATE_LIMITS = {
+    "generate": (int(os.getenv("RATE_LIMIT_IP_GENERATE", 60)), 20),
+    "login": (int(os.getenv("RATE_LIMIT_IP_LOGIN", 10)), 5),
+    "checkout": (int(os.getenv("RATE_LIMIT_IP_CHECKOUT", 10)), 5)
+}
+
+
+def _take_token(scope, key, per_minute, burst):
+    """Returns None if allowed, else a 429 response."""
+    if not RATE_LIMIT_ENABLED:
+        return None
+    allowed, retry_after = rate_buckets.take(f"{scope}:{key}", per_minute / 60.0, burst)
+    if allowed:
+        return None
+    metrics.inc("rate_limited_total", scope=scope)
+    retry_after = max(1, int(retry_after + 0.999))
+    response = jsonify({
+        "error": "Too many requests, please slow down",
+        "retry_after": retry_after
+    })
+    response.headers["Retry-After"] = str(retry_after)
+    return response, 429
+
+
+def ip_rate_limited(endpoint, methods=("POST",)):
+    """Throttle by client IP before any token, DB or upstream work."""
+    def decorator(f):
+        @wraps(f)
+        def decorated(*args, **kwargs):
+            if IP_RATE_LIMIT_ENABLED and request.method in methods:
+                per_minute, burst = IP_RATE_LIMITS[endpoint]
+                rejected = _take_token(f"ip-{endpoint}", request.remote_addr, per_minute, burst)
+                if rejected:
+                    return rejected
+            return f(*args, **kwargs)
+        return decorated
+    return decorator
+
+
+def user_rate_limited(f):
+    """Throttle by user id at the tier's rate. Goes under token_required."""
+    @wraps(f)
+    def decorated(user, *args, **kwargs):
+        tier = TIERS.get(user.tier) or TIERS["free"]
+        rejected = _take_token(f"user-{f.__name__}", user.id or user.subject, tier["rate_per_minute"], tier["burst"])
+        if rejected:
+            return rejected
+        return f(user, *args, **kwargs)
+    return decorated
+
+# =========================
+# IDEMPOTENCY (Idempotency-Key on /generate and checkout, see idempotency.py)
+# =========================
+idempotency = IdempotencyStore(
+    os.getenv("IDEMPOTENCY_PATH", "idempotency.db"),
+    ttl=float(os.getenv("IDEMPOTENCY_TTL", 24 * 3600)),
+    lease=float(os.getenv("IDEMPOTENCY_LEASE", 120)),
+    max_entries=int(os.getenv("IDEMPOTENCY_MAX_ENTRIES", 100000))
+)
+# Headers worth replaying; the rest (request id, cookies, length) are per response
+IDEMPOTENT_HEADERS = ("Content-Type", "Location", "Cache-Control", "X-Accel-Buffering")
+
+
+def _idempotency_owner(args):
+    """Keys are per user: the API user, else the session user, else the client IP."""
+    if args and isinstance(args[0], Entitlement):
+        return args[0].subject
+    user = session.get("user") or {}
+    return user.get("id") or request.remote_addr
+
+
+def _replay(stored):
+    response = Response(stored.body, status=stored.status, headers=stored.headers)
+    response.headers["Idempotent-Replayed"] = "true"
+    return response
+
+
+def _finish_idempotent(key, response):
+    """Store a successful response under key once its body is complete."""
+    if not 200 <= response.status_code < 400:
+        idempotency.release(key)
+        return response
+    headers = {name: response.headers[name] for name in IDEMPOTENT_HEADERS if name in response.headers}
+    if not response.is_streamed:
+        idempotency.complete(key, response.status_code, headers, response.get_data())
+        return response
+
+    # Streams are stored after the last chunk; a client that disconnects
+    # early, or whose body is never read at all, releases the key so its
+    # retry runs again
+    body = response.response
+    settled = []
+
+    def recorded():
+        chunks = []
+        finished = False
+        try:
+            for chunk in body:
+                chunks.append(chunk.encode() if isinstance(chunk, str) else chunk)
+                yield chunk
+            finished = True
+        finally:
+            settled.append(True)
+            if hasattr(body, "close"):
+                body.close()
+            if finished:
+                idempotency.complete(key, response.status_code, headers, b"".join(chunks))
+            else:
+                idempotency.release(key)
+
+    def unread():
+        # Closing a generator that never started skips its finally
+        if not settled:
+            if hasattr(body, "close"):
+                body.close()
+            idempotency.release(key)
+
+    response.response = recorded()
+    response.call_on_close(unread)
+    return response
+
+
+def idempotent(scope):
+    """Run a POST once per Idempotency-Key (header, or the idempotency_key
+    form field for browser forms). A duplicate of a finished request gets
+    the stored response; one that arrives while the original is running
+    waits for it. Goes under token_required (and user_rate_limited, so a
+    client hammering one key is throttled before any SQLite write) on API
+    routes."""
+    def decorator(f):
+        @wraps(f)
+        def decorated(*args, **kwargs):
+            # Read the body first so form parsing doesn't consume it
+            body = request.get_data()
+            client_key = request.headers.get("Idempotency-Key") or request.form.get("idempotency_key")
+            if not client_key:
+                return f(*args, **kwargs)
+            if len(client_key) > 255:
+                return jsonify({"error": "Idempotency-Key must be at most 255 characters"}), 400
+
+            key = record_key(scope, _idempotency_owner(args), client_key)
+            request_fingerprint = fingerprint(request.method, request.path, request.query_string, body)
+            state, stored = idempotency.begin(key, request_fingerprint)
+            if state == RUNNING:
+                state, stored = idempotency.wait(key, request_fingerprint, idempotency.lease)
+            if state == MISMATCH:
+                return jsonify({"error": "Idempotency-Key was already used for a different request"}), 422
+            if state == REPLAY:
+                return _replay(stored)
+            if state == RUNNING:
+                response = jsonify({"error": "A request with this Idempotency-Key is still in progress"})
+                response.headers["Retry-After"] = "1"
+                return response, 409
+
+            g.idempotency_key = key
+            try:
+                response = app.make_response(f(*args, **kwargs))
+            except Exception:
+                idempotency.release(key)
+                raise
+            return _finish_idempotent(key, response)
+        return decorated
+    return decorator
+
+# =========================
+# PAGE CACHE (pages without per-user data and /static, compressed once)
+# =========================
+page_cache = PageCache(check_interval=float(os.getenv("PAGE_CACHE_CHECK_INTERVAL", 2.0)))
+
+
+def _cached_page(template):
+    """Serve a template with no per-user data, rebuilt only when the file changes."""
+    path = os.path.join(app.root_path, app.template_folder, template)
+    entry = page_cache.get(("page", template),
+                           lambda: (render_template(template).encode("utf-8"), "text/html"), [path])
+    return page_cache.respond(request, entry)
+
+
+def _static_entry(filename):
+    path = safe_join(app.static_folder, filename)
+    if path is None or not os.path.isfile(path):
+        return None
+
+    def build():
+        with open(path, "rb") as f:
+            return f.read(), mimetypes.guess_type(path)[0] or "application/octet-stream"
+    return page_cache.get(("static", filename), build, [path])
+
+
+def _static_file(filename):
+    entry = _static_entry(filename)
+    if entry is None:
+        abort(404)
+    # Fingerprinted URLs change with the content, so they never need revalidating
+    fingerprinted = request.args.get("v") == entry.version
+    return page_cache.respond(request, entry, IMMUTABLE if fingerprinted else REVALIDATE)
+
+
+app.view_functions["static"] = _static_file
+
+
+@app.url_defaults
+def _fingerprint_static(endpoint, values):
+    # url_for('static', filename=...) -> /static/<file>?v=<content hash>
+    if endpoint == "static" and "filename" in values:
+        entry = _static_entry(values["filename"])
+        if entry is not None:
+            values["v"] = entry.version
+
+
+logger.info("App initialized")
 # Helper: normalize different Supabase sign-in responses
 def _parse_supabase_signin_result(result):
     """Return tuple (email, id, error_or_none).
@@ -167,7 +911,7 @@ def _parse_supabase_signin_result(result):
 
 @app.route("/")
 def landing():
-    return render_template("landing.html")
+    return _cached_page("landing.html")
 
 # --------------------
 # HOME PAGE (Dashboard)
@@ -176,7 +920,7 @@ def landing():
 
 @app.route("/home")
 def home():
-    return render_template("home.html")
+    return _cached_page("home.html")
 
 # --------------------
 # STRIPE CHECKOUT
@@ -184,26 +928,65 @@ def home():
 
 
 @app.route("/create-checkout-session", methods=["POST"])
+@ip_rate_limited("checkout")
+@idempotent("checkout")
 def create_checkout_session():
     try:
-        checkout_session = stripe.checkout.Session.create(
+        price_id = os.getenv("STRIPE_PRICE_ID")
+        # Tag the session so webhooks can find the user and tier later
+        user = session.get("user") or {}
+        if user.get("id"):
+            rejected = _take_token("user-checkout", user["id"], *IP_RATE_LIMITS["checkout"])
+            if rejected:
+                return rejected
+        metadata = {"user_id": user.get("id"), "tier": PRICE_TIERS.get(price_id, "pro")}
+        checkout_session = _create_checkout_session(
             payment_method_types=["card"],
             mode="subscription",  # recurring subscription
             line_items=[{
                 # your Stripe monthly price ID
-                "price": os.getenv("STRIPE_PRICE_ID"),
+                "price": price_id,
                 "quantity": 1,
             }],
+            client_reference_id=user.get("id"),
+            customer_email=user.get("email"),
+            metadata=metadata,
+            subscription_data={"metadata": metadata},
             success_url=YOUR_DOMAIN +
             "/success?session_id={CHECKOUT_SESSION_ID}",
             cancel_url=YOUR_DOMAIN + "/cancel",
+            # A retried request reuses the Checkout Session Stripe already made
+            **({"idempotency_key": g.idempotency_key} if "idempotency_key" in g else {})
         )
+        rollups.record(metadata["tier"], checkouts=1)
 
         return redirect(checkout_session.url, code=303)
 
     except Exception as e:
         return jsonify(error=str(e)), 403
 
+# --------------------
+# STRIPE WEBHOOK
+# --------------------
+
+
+@app.route("/stripe-webhook", methods=["POST"])
+def stripe_webhook():
+    if not STRIPE_WEBHOOK_SECRET:
+        return jsonify({"error": "Webhook secret not configured"}), 503
+
+    payload = request.get_data()
+    try:
+        stripe.Webhook.construct_event(
+            payload, request.headers.get("Stripe-Signature", ""), STRIPE_WEBHOOK_SECRET)
+    except (ValueError, stripe.error.SignatureVerificationError) as e:
+        return jsonify({"error": str(e)}), 400
+
+    # Queue and acknowledge; duplicates of an event id are ignored
+    event = json.loads(payload)
+    outbox.enqueue("stripe_event", event["id"], event)
+    return jsonify({"received": True})
+
 # --------------------
 # SUCCESS PAGE
 # --------------------
@@ -211,7 +994,7 @@ def create_checkout_session():
 
 @app.route("/success")
 def success():
-    return render_template("success.html")
+    return _cached_page("success.html/success.html")
 
 # --------------------
 # CANCEL PAGE
@@ -221,7 +1004,7 @@ def success():
 
 @app.route("/cancel")
 def cancel():
-    return render_template("cancel.html")
+    return _cached_page("cancel.html/cancel.html")
 
 # ============================================
 # USER AUTHENTICATION (Supabase)
@@ -244,16 +1027,16 @@ def signup():
                 return render_template("signup.html", error="Password must be at least 6 characters.")
 
             # Check if Supabase is available
-            if not supabase:
+            if not _supabase_available():
                 return render_template("signup.html", error="Authentication service not configured. Please contact support.")
 
-            response = supabase.auth.sign_up({
+            response = _supabase_call("supabase_auth", "sign_up", lambda sb: sb.auth.sign_up({
     "email": email,
     "password": password,
     "options": {
         "email_redirect_to": "https://aiassistantpros.onrender.com/login"
     }
-})
+}))
 
             # Normalize response (dict or object)
             error = None
@@ -276,25 +1059,26 @@ def signup():
                     error_msg = str(error)
                 return render_template("signup.html", error=error_msg)
             else:
-                # Create user profile in database as FREE tier with 3-day trial by default
+                # Queue user profile as FREE tier with 3-day trial by default;
+                # the outbox worker inserts it so signup doesn't wait on the DB
                 if user_id:
                     try:
-                        trial_ends_at = (datetime.utcnow() + timedelta(days=3)).isoformat()
-                        supabase.table("users").insert({
+                        now = datetime.utcnow()
+                        outbox.enqueue("user_profile", user_id, {
                             "id": user_id,
                             "email": email,
                             "tier": "free",
-                            "trial_ends_at": trial_ends_at,
-                            "created_at": "now()"
-                        }).execute()
+                            "used": 0,
+                            "trial_ends_at": (now + timedelta(days=3)).isoformat(),
+                            "created_at": now.isoformat()
+                        })
+                        rollups.record("free", signups=1, users=1)
                     except Exception as db_error:
-                        print(f"[WARNING] Could not create user profile: {str(db_error)}")
-                        # Continue anyway - profile will be created on first login
+                        logger.warning("Could not queue user profile", extra={"user_id": user_id, "error": str(db_error)})
                 
                 return redirect("/signup-success")
         except Exception as e:
-            error_msg = f"Signup error: {str(e)}"
-            print(f"[ERROR] Signup route exception: {error_msg}")
+            logger.exception("Signup failed")
             return render_template("signup.html", error="An error occurred during signup. Please try again.")
 
     # Handles GET requests — user opening page normally
@@ -303,6 +1087,7 @@ def signup():
 
 # LOGIN PAGE
 @app.route("/login", methods=["GET", "POST"])
+@ip_rate_limited("login")
 def login():
     if request.method == "POST":
         email = request.form.get("email", "").strip()
@@ -312,10 +1097,10 @@ def login():
             return render_template("login.html", error="Email and password are required.")
 
         try:
-            result = supabase.auth.sign_in_with_password({
+            result = _supabase_call("supabase_auth", "sign_in_with_password", lambda sb: sb.auth.sign_in_with_password({
                 "email": email,
                 "password": password
-            })
+            }))
 
             # Extract user info safely
             session_data = result.session
@@ -331,18 +1116,27 @@ def login():
             if user is None:
                 return render_template("login.html", error="Authentication failed. Could not load user data.")
 
+            # Resolve tier/trial once and keep it warm for dashboard/API calls
+            entitlements.invalidate(user.id)
+            entitlement = entitlements.get(
+                user.id, lambda: _load_entitlement(user.id, user.email))
+
             # Store essentials in session
             session["user"] = {
                 "id": user.id,
                 "email": user.email,
-                "tier": "free",
-                "trial_ends_at": None
+                "tier": entitlement.tier if entitlement else "free",
+                "trial_ends_at": (
+                    entitlement.trial_ends_at.isoformat()
+                    if entitlement and entitlement.trial_ends_at else None
+                )
             }
+            rollups.record(session["user"]["tier"], logins=1)
 
             return redirect("/dashboard")
 
         except Exception as e:
-            print("LOGIN ERROR:", e)
+            logger.exception("Login failed")
             return render_template("login.html", error="Login failed. Please try again.")
 
     return render_template("login.html")
@@ -353,7 +1147,7 @@ def login():
                                   
 @app.route("/signup-success")
 def signup_success():
-    return render_template("signup_success.html")
+    return _cached_page("signup_success.html")
 
 # LOGOUT
 
@@ -373,51 +1167,598 @@ def caption():
 
 
 @app.route("/generate", methods=["POST"])
+@ip_rate_limited("generate")
 @token_required
+@user_rate_limited
+@idempotent("generate")
 def generate(user):
     tier = user.tier
     limit = TIERS.get(tier, {}).get("limit", 0)   
 
-    # FREE = preview only (hard stop)
-    if tier == "free" and user.used >= 1:
-        return jsonify({
-             "error": "Free preview already used",
-             "upgrade": True
-        }), 403
+    prompt = request.json.get("prompt")
+    if not isinstance(prompt, str) or not prompt.strip():
+        return jsonify({"error": "Missing prompt"}), 400
 
-    # PAID TIERS = usage limits
-    if user.used >= limit:
+    # SIZE THE PROMPT LOCALLY (oversize prompts never reach OpenAI)
+    model = TIERS[tier]["model"]
+    prompt, usage = _size_prompt(tier, prompt, request.json.get("truncate"))
+    if prompt is None:
+        return jsonify(usage), 413
+
+    # RESERVE A USE BEFORE CALLING UPSTREAM (refunded if the call fails)
+    used = usage_meter.reserve(user.email, limit)
+    if used is None:
+        # FREE = preview only (hard stop)
+        if tier == "free":
+            return jsonify({
+                 "error": "Free preview already used",
+                 "upgrade": True
+            }), 403
+
+        # PAID TIERS = usage limits
         return jsonify({
-        "error": "Usage limit reached",
-        "upgrade": True
-    }), 403
-
-    # CONSUME USE IMMEDIATELY
-
-    user.used += 1
-    db = SessionLocal()
-    db.merge(user)
-    db.commit()
-    db.close()
+            "error": "Usage limit reached",
+            "upgrade": True
+        }), 403
+    rollups.record_reservation(tier, used - 1, used, limit)
+    user = user._replace(used=used)
+
+    max_output = TIERS[tier]["max_output_tokens"]
+    # Saved tiers keep every result unless the client opts out
+    generation_id = None
+    if tier_allows(user, "can_save") and request.json.get("save", True):
+        generation_id = uuid.uuid4().hex
+    # Tiers that can re-run expect a fresh generation every time
+    cache_key = None
+    if not tier_allows(user, "can_rerun"):
+        cache_key = make_cache_key(model, prompt, GENERATE_TEMPERATURE, max_output)
+
+    if wants_event_stream(request):
+        return _stream_generation(user, tier, limit, prompt, usage, _request_deadline(tier),
+                                  cache_key, generation_id)
+
+    deadline = _request_deadline(tier)
+    served = {"model": model}
+
+    def complete():
+        with dispatcher.slot(TIERS[tier]["priority"], deadline.remaining()):
+            response, served["model"] = _tier_completion(tier, prompt, deadline, max_tokens=max_output)
+        return response.choices[0].message.content
 
-    prompt = request.json.get("prompt")
-    if not prompt:
-        return jsonify({"error": "Missing prompt"}), 400
+    try:
+        if cache_key:
+            output = response_cache.get_or_compute(cache_key, complete, deadline.remaining())
+        else:
+            output = complete()
+    except QueueFull as e:
+        usage_meter.refund(user.email)
+        return _queue_full_response(e)
+    except CircuitOpen as e:
+        usage_meter.refund(user.email)
+        return _circuit_open_response(e)
+    except (DeadlineExceeded, TimeoutError) as e:
+        usage_meter.refund(user.email)
+        return jsonify({"error": str(e)}), 504
+    except Exception as e:
+        usage_meter.refund(user.email)
+        return jsonify({"error": str(e)}), 502
 
-    response = client.chat.completions.create(
-        model=TIERS[tier]["model"],
-        messages=[{"role": "user", "content": prompt}],
-        temperature=0.3
-    )
+    usage["completion_tokens"] = count_tokens(output, model)
+    _commit_use(user, usage["prompt_tokens"] + usage["completion_tokens"])
+    if generation_id:
+        _save_generation(generation_id, user, served["model"], prompt, output, usage)
 
     return jsonify({
+        "model": served["model"],
         "tier": tier,
         "used": user.used,
         "limit": limit,
-        "output": response.choices[0].message.content
+        "usage": usage,
+        "generation_id": generation_id,
+        "output": output
+    })
+
+
+def _size_prompt(tier, prompt, truncate=False):
+    """Fit prompt to the tier's input budget.
+
+    Returns (prompt, usage), or (None, error) if it is too long and
+    truncation wasn't requested.
+    """
+    model = TIERS[tier]["model"]
+    max_input = TIERS[tier]["max_input_tokens"]
+    prompt_tokens = count_tokens(prompt, model)
+    truncated = False
+    if prompt_tokens > max_input:
+        if not truncate:
+            return None, {
+                "error": "Prompt too long",
+                "prompt_tokens": prompt_tokens,
+                "max_input_tokens": max_input
+            }
+        prompt = truncate_to_tokens(prompt, max_input, model)
+        prompt_tokens = count_tokens(prompt, model)
+        truncated = True
+    return prompt, {"prompt_tokens": prompt_tokens, "truncated": truncated}
+
+
+def _commit_use(user, tokens=0):
+    """Count a reserved use's tokens and keep the cached entitlement in step."""
+    usage_meter.commit(user.email, tokens_used=tokens)
+    entitlements.put(user)
+    rollups.record(user.tier, generations=1, tokens=tokens)
+
+
+def _save_generation(generation_id, user, model, prompt, output, usage):
+    """Queue a finished generation for the history store; written in batches."""
+    outbox.enqueue("generation", generation_id, {
+        "key": generation_id,
+        "user_id": user.id,
+        "created_at": datetime.now(timezone.utc).isoformat(),
+        "model": model,
+        "prompt": prompt,
+        "output": output,
+        "prompt_tokens": usage["prompt_tokens"],
+        "completion_tokens": usage.get("completion_tokens", 0)
     })
 
 
+def _stream_generation(user, tier, limit, prompt, usage, deadline, cache_key=None, generation_id=None):
+    """Forward tokens to the client as they arrive, then a final usage event.
+
+    A use was reserved before we got here. It is committed once OpenAI
+    accepts the request, so a client that disconnects mid-stream is still
+    counted exactly once, and refunded if the stream cannot be opened.
+    Closing the upstream stream on disconnect stops OpenAI from generating
+    further tokens. A cache hit is replayed as a single token event; a
+    completed miss is stored so later requests can skip the upstream call.
+    """
+    model = TIERS[tier]["model"]
+    done = {"tier": tier, "used": user.used, "limit": limit, "usage": usage,
+            "generation_id": generation_id}
+
+    cached = response_cache.get(cache_key) if cache_key else None
+    if cached is not None:
+        usage["completion_tokens"] = count_tokens(cached, model)
+        _commit_use(user, usage["prompt_tokens"] + usage["completion_tokens"])
+        if generation_id:
+            _save_generation(generation_id, user, model, prompt, cached, usage)
+
+        def replay():
+            yield sse_event({"token": cached})
+            yield sse_event(done, event="done")
+        return _sse_response(replay())
+
+    # The dispatch slot is held for the whole stream
+    try:
+        ticket = dispatcher.acquire(TIERS[tier]["priority"], deadline.remaining())
+    except QueueFull as e:
+        usage_meter.refund(user.email)
+        return _queue_full_response(e)
+
+    try:
+        stream, model = _tier_completion(tier, prompt, deadline, stream=True,
+                                         max_tokens=TIERS[tier]["max_output_tokens"])
+    except Exception as e:
+        dispatcher.release(ticket)
+        usage_meter.refund(user.email)
+        if isinstance(e, CircuitOpen):
+            return _circuit_open_response(e)
+        return jsonify({"error": str(e)}), 504 if isinstance(e, DeadlineExceeded) else 502
+
+    _commit_use(user, usage["prompt_tokens"])
+
+    parts = []
+    finished = threading.Lock()
+
+    def finish():
+        # Once, from the generator's finally or, if the body was never
+        # iterated (a generator that never started skips its finally), on close
+        if not finished.acquire(blocking=False):
+            return
+        stream.close()
+        dispatcher.release(ticket)
+        # Completion tokens count even if the client left mid-stream
+        completion = usage.get("completion_tokens")
+        if completion is None:
+            completion = count_tokens("".join(parts), model)
+        usage_meter.commit(user.email, tokens_used=completion)
+        rollups.record(user.tier, tokens=completion)
+
+    def events():
+        try:
+            for text in iter_completion_text(stream):
+                parts.append(text)
+                yield sse_event({"token": text})
+            if cache_key:
+                response_cache.put(cache_key, "".join(parts))
+            usage["completion_tokens"] = count_tokens("".join(parts), model)
+            if generation_id:
+                _save_generation(generation_id, user, model, prompt, "".join(parts), usage)
+            yield sse_event(done, event="done")
+        except GeneratorExit:
+            # Client went away; fall through to close the upstream stream
+            raise
+        except Exception as e:
+            logger.warning("Stream interrupted", extra={"model": model, "error": str(e)})
+            yield sse_event({"error": str(e)}, event="error")
+        finally:
+            finish()
+
+    response = _sse_response(events())
+    response.call_on_close(finish)
+    return response
+
+
+# --------------------
+# BATCH GENERATION (agency)
+# --------------------
+BATCH_CONCURRENCY = int(os.getenv("BATCH_CONCURRENCY", 8))
+
+
+@app.route("/generate-batch", methods=["POST"])
+@ip_rate_limited("generate")
+@token_required
+@user_rate_limited
+def generate_batch(user):
+    """Run many prompts in one request.
+
+    Body: a JSON array (or {"prompts": [...]}) or JSONL of prompt strings
+    or {"id", "prompt"} objects. Quota for every valid item is reserved up
+    front, all or nothing. Results stream back as NDJSON in completion
+    order, one line per item, then a summary line. With ?async=1 the batch
+    runs in the background and the response points at /batch-jobs/<id>.
+    """
+    tier = user.tier
+    limit = TIERS.get(tier, {}).get("limit", 0)
+    max_batch = TIERS.get(tier, {}).get("max_batch", 0)
+    if not max_batch:
+        return jsonify({"error": "Batch generation requires the agency plan", "upgrade": True}), 403
+
+    try:
+        items = parse_batch(request.get_data(), request.content_type)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    if not items:
+        return jsonify({"error": "Empty batch"}), 400
+    if len(items) > max_batch:
+        return jsonify({"error": f"Batch too large (max {max_batch} prompts)"}), 413
+
+    # Invalid items get an error line and don't count against the quota
+    truncate = request.args.get("truncate", "").lower() in ("1", "true", "yes")
+    valid, rejected = [], []
+    for item in items:
+        if not isinstance(item["prompt"], str) or not item["prompt"].strip():
+            rejected.append(_batch_line(item, error="Missing prompt"))
+            continue
+        item["prompt"], item["usage"] = _size_prompt(tier, item["prompt"], truncate)
+        if item["prompt"] is None:
+            rejected.append(_batch_line(item, **item["usage"]))
+        else:
+            valid.append(item)
+
+    used = usage_meter.reserve(user.email, limit, n=len(valid)) if valid else user.used
+    if used is None:
+        return jsonify({
+            "error": "Usage limit reached",
+            "requested": len(valid),
+            "remaining": max(0, limit - usage_meter.used(user.email)),
+            "upgrade": True
+        }), 403
+    rollups.record_reservation(tier, used - len(valid), used, limit)
+    user = user._replace(used=used)
+    save = tier_allows(user, "can_save") and request.args.get("save", "1").lower() not in ("0", "false", "no")
+
+    if request.args.get("async", "").lower() in ("1", "true", "yes"):
+        job_id = uuid.uuid4().hex
+        create_job(engine, job_id, user.id, len(items))
+        # Run in a copy of this request's context so the job logs its request id
+        threading.Thread(target=contextvars.copy_context().run,
+                         args=(_run_batch_job, job_id, user, limit, valid, rejected, save),
+                         name="batch-job", daemon=True).start()
+        response = jsonify({"job_id": job_id, "status_url": f"/batch-jobs/{job_id}"})
+        response.headers["Location"] = f"/batch-jobs/{job_id}"
+        return response, 202
+
+    def lines():
+        for line in rejected:
+            yield json.dumps(line) + "\n"
+        for line in _batch_results(user, limit, valid, save):
+            yield json.dumps(line) + "\n"
+
+    return Response(applog.in_context(lines()), mimetype="application/x-ndjson", headers={"X-Accel-Buffering": "no"})
+
+
+@app.route("/batch-jobs/<job_id>")
+@token_required
+def batch_job_status(user, job_id):
+    job = get_job(engine, job_id, user.id)
+    if job is None:
+        return jsonify({"error": "Job not found"}), 404
+    return jsonify(job)
+
+
+def _batch_line(item, **fields):
+    return {"index": item["index"], "id": item["id"], **fields}
+
+
+def _batch_results(user, limit, items, save):
+    """Yield one result line per item as it finishes, then a summary line.
+
+    Each item settles its own reserved use: committed on success, refunded
+    on failure or if it is cancelled because the client went away.
+    """
+    tier = user.tier
+    model = TIERS[tier]["model"]
+    max_output = TIERS[tier]["max_output_tokens"]
+
+    def generate_one(item):
+        # Settle the item's use here, not in the consumer, so items still
+        # running when the client disconnects are accounted for too
+        deadline = Deadline(TIERS[tier]["deadline"])
+        try:
+            with dispatcher.slot(TIERS[tier]["priority"], deadline.remaining()):
+                response, served_model = _tier_completion(tier, item["prompt"], deadline, max_tokens=max_output)
+            output = response.choices[0].message.content
+        except Exception:
+            usage_meter.refund(user.email)
+            raise
+        usage = dict(item["usage"], completion_tokens=count_tokens(output, model))
+        usage_meter.commit(user.email, tokens_used=usage["prompt_tokens"] + usage["completion_tokens"])
+        rollups.record(tier, generations=1, tokens=usage["prompt_tokens"] + usage["completion_tokens"])
+        generation_id = None
+        if save:
+            generation_id = uuid.uuid4().hex
+            _save_generation(generation_id, user, served_model, item["prompt"], output, usage)
+        return _batch_line(item, output=output, usage=usage, generation_id=generation_id)
+
+    succeeded = failed = 0
+    for item, line, error in run_batch(items, generate_one, BATCH_CONCURRENCY,
+                                       on_cancel=lambda item: usage_meter.refund(user.email)):
+        if error is not None:
+            failed += 1
+            line = _batch_line(item, error=str(error))
+            if isinstance(error, QueueFull):
+                line["retry_after"] = error.retry_after
+        else:
+            succeeded += 1
+        yield line
+
+    user = user._replace(used=user.used - failed)
+    entitlements.put(user)
+    yield {"done": True, "succeeded": succeeded, "failed": failed,
+           "tier": tier, "used": user.used, "limit": limit}
+
+
+def _run_batch_job(job_id, user, limit, items, rejected, save):
+    results = list(rejected)
+    failed = len(rejected)
+    succeeded = 0
+    last_update = time.monotonic()
+    try:
+        for line in _batch_results(user, limit, items, save):
+            if line.get("done"):
+                continue
+            results.append(line)
+            if "error" in line:
+                failed += 1
+            else:
+                succeeded += 1
+            if time.monotonic() - last_update > 2.0:
+                update_job(engine, job_id, succeeded, failed)
+                last_update = time.monotonic()
+    except Exception as e:
+        logger.exception("Batch job failed", extra={"job_id": job_id})
+    results.sort(key=lambda line: line["index"])
+    update_job(engine, job_id, succeeded, failed, results)
+
+
+def _queue_full_response(error):
+    response = jsonify({
+        "error": "Server busy, please retry shortly",
+        "retry_after": error.retry_after
+    })
+    response.headers["Retry-After"] = str(error.retry_after)
+    return response, 429
+
+
+def _circuit_open_response(error):
+    response = jsonify({
+        "error": "AI service temporarily unavailable, please retry shortly",
+        "retry_after": error.retry_after
+    })
+    response.headers["Retry-After"] = str(error.retry_after)
+    return response, 503
+
+
+def _sse_response(events):
+    return Response(applog.in_context(events), mimetype="text/event-stream", headers={
+        "Cache-Control": "no-cache",
+        "X-Accel-Buffering": "no"
+    })
+
+
+# --------------------
+# SAVED GENERATIONS (can_save tiers)
+# --------------------
+
+
+@app.route("/history")
+@token_required
+def history(user):
+    """?limit=&cursor= pages newest first; ?q= restricts to a full-text match."""
+    if not tier_allows(user, "can_save"):
+        return jsonify({"error": "Saved history requires a paid plan", "upgrade": True}), 403
+    try:
+        limit = min(max(int(request.args.get("limit", 20)), 1), 100)
+        items, next_cursor = list_generations(
+            engine, user.id, limit, request.args.get("cursor"), request.args.get("q"))
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    return jsonify({"items": items, "next_cursor": next_cursor})
+
+
+@app.route("/admin/stats")
+@token_required
+def admin_stats(user):
+    """?days= of usage, conversion and revenue rollups (ADMIN_EMAILS only).
+    Reads the small rollups table, never users or generations."""
+    if (user.email or "").lower() not in ADMIN_EMAILS:
+        return jsonify({"error": "Admin access required"}), 403
+    try:
+        days = min(max(int(request.args.get("days", 30)), 1), 366)
+    except ValueError:
+        return jsonify({"error": "days must be a whole number"}), 400
+    return jsonify(rollups.summary(days, {name: tier["limit"] for name, tier in TIERS.items()}))
+
+
+def _collect_cache_metrics():
+    cache = response_cache.stats()
+    users = entitlements.stats()
+    samples = [
+        ("response_cache_hits_total", "counter", {}, cache["hits"]),
+        ("response_cache_misses_total", "counter", {}, cache["misses"]),
+        ("response_cache_coalesced_total", "counter", {}, cache["coalesced"]),
+        ("response_cache_bytes", "gauge", {}, cache["bytes"]),
+        ("entitlement_cache_hits_total", "counter", {}, users["hits"]),
+        ("entitlement_cache_misses_total", "counter", {}, users["misses"])
+    ]
+    for name, cache in (("entitlements", entitlements.store), ("responses", response_cache.store)):
+        if isinstance(cache, SharedMemoryStore):
+            stats = cache.stats()
+            labels = {"cache": name}
+            samples += [
+                ("shared_cache_hits_total", "counter", labels, stats["hits"]),
+                ("shared_cache_misses_total", "counter", labels, stats["misses"]),
+                ("shared_cache_evictions_total", "counter", labels, stats["evictions"]),
+                ("shared_cache_too_large_total", "counter", labels, stats["too_large"]),
+                ("shared_cache_read_retries_total", "counter", labels, stats["read_retries"])
+            ]
+    return samples
+
+
+def _collect_dispatch_metrics():
+    stats = dispatcher.stats()
+    samples = [("dispatch_active", "gauge", {}, stats["active"])]
+    for priority, c in stats["classes"].items():
+        labels = {"priority": priority}
+        samples += [
+            ("dispatch_queued", "gauge", labels, c["queued"]),
+            ("dispatch_admitted_total", "counter", labels, c["admitted"]),
+            ("dispatch_rejected_total", "counter", labels, c["rejected"] + c["timed_out"])
+        ]
+    return samples
+
+
+def _collect_outbox_metrics():
+    samples = []
+    for kind, counts in outbox.stats().items():
+        for status in ("pending", "dead"):
+            samples.append(("outbox_jobs", "gauge", {"kind": kind, "status": status}, counts.get(status, 0)))
+    return samples
+
+
+metrics.register_collector(_collect_cache_metrics)
+metrics.register_collector(_collect_dispatch_metrics)
+metrics.register_collector(_collect_outbox_metrics)
+
+
+def _collect_log_metrics():
+    return [
+        ("log_records_written_total", "counter", {}, log_handler.written),
+        ("log_records_dropped_total", "counter", {}, log_handler.dropped)
+    ]
+
+
+metrics.register_collector(_collect_log_metrics)
+
+
+def _collect_idempotency_metrics():
+    stats = idempotency.stats()
+    return [
+        ("idempotency_records", "gauge", {"state": "running"}, stats["running"]),
+        ("idempotency_records", "gauge", {"state": "done"}, stats["done"]),
+        ("idempotency_replayed_total", "counter", {}, stats["replayed"]),
+        ("idempotency_joined_total", "counter", {}, stats["joined"])
+    ]
+
+
+metrics.register_collector(_collect_idempotency_metrics)
+
+
+def _collect_analytics_metrics():
+    stats = rollups.stats()
+    return [
+        ("analytics_flushes_total", "counter", {}, stats["flushes"]),
+        ("analytics_flush_failures_total", "counter", {}, stats["failures"])
+    ]
+
+
+metrics.register_collector(_collect_analytics_metrics)
+
+
+def _collect_token_metrics():
+    stats = token_verifier.stats()
+    samples = [
+        ("auth_token_cache_hits_total", "counter", {}, stats["hits"]),
+        ("auth_token_cache_misses_total", "counter", {}, stats["misses"]),
+        ("auth_token_rejected_total", "counter", {}, stats["rejected"])
+    ]
+    if "jwks" in stats:
+        samples += [
+            ("jwks_keys", "gauge", {}, stats["jwks"]["keys"]),
+            ("jwks_refresh_failures_total", "counter", {}, stats["jwks"]["failures"])
+        ]
+    return samples
+
+
+metrics.register_collector(_collect_token_metrics)
+
+
+def _collect_transport_metrics():
+    stats = transport_pools.stats()
+    samples = [
+        ("dns_cache_hits_total", "counter", {}, stats["dns_cache"]["hits"]),
+        ("dns_cache_misses_total", "counter", {}, stats["dns_cache"]["misses"])
+    ]
+    for pool, p in stats["pools"].items():
+        labels = {"pool": pool}
+        samples += [
+            ("http_pool_requests_total", "counter", labels, p["requests"]),
+            ("http_pool_connections_opened_total", "counter", labels, p["connections_opened"]),
+            ("http_pool_connect_seconds_total", "counter", labels, p["connect_seconds"]),
+            ("http_pool_wait_seconds_total", "counter", labels, p["wait_seconds"]),
+            ("http_pool_open_connections", "gauge", labels, p["open_connections"])
+        ]
+    return samples
+
+
+metrics.register_collector(_collect_transport_metrics)
+
+
+def _collect_resilience_metrics():
+    stats = openai_resilience.stats()
+    samples = [
+        ("openai_hedged_requests_total", "counter", {}, stats["hedges"]),
+        ("openai_hedge_wins_total", "counter", {}, stats["hedge_wins"]),
+        ("openai_fallbacks_total", "counter", {}, stats["fallbacks"])
+    ]
+    for model, m in stats["models"].items():
+        samples += [
+            ("openai_circuit_open", "gauge", {"model": model}, int(m["state"] != "closed")),
+            ("openai_circuit_trips_total", "counter", {"model": model}, m["trips"])
+        ]
+    return samples
+
+
+metrics.register_collector(_collect_resilience_metrics)
+
+
+@app.route("/metrics")
+def metrics_endpoint():
+    return Response(metrics.render(), mimetype="text/plain; version=0.0.4")
+
+
 # ==========================
 # PREMIUM DASHBOARD
 # ==========================
@@ -428,53 +1769,35 @@ def dashboard():
         if "user" not in session:
             return redirect("/login")
 
-        user = session.get("user") or {}
-        user_email = user.get("email")
-        user_tier = user.get("tier", "free")
-        trial_ends_at = user.get("trial_ends_at")
+        user = _session_entitlement()
+        if user is None:
+            return redirect("/login")
 
         # Calculate days left
         trial_days_left = None
-        if trial_ends_at and user_tier == "free":
-            try:
-                trial_end = datetime.fromisoformat(trial_ends_at)
-                days_left = (trial_end - datetime.utcnow()).days
-                trial_days_left = max(0, days_left + 1)
-            except:
-                print("[WARNING] Could not calculate trial days")
+        if user.tier == "free":
+            trial_days_left = user.trial_days_left()
 
         return render_template(
             "dashboard_unified.html",
-            user_email=user_email,
-            user_tier=user_tier,
+            user=user,
+            TIERS=TIERS,
+            user_email=user.email,
+            user_tier=user.tier,
             trial_days_left=trial_days_left
         )
 
     except Exception as e:
-        print("[ERROR] Dashboard exception:", e)
+        logger.exception("Dashboard failed")
         return render_template("login.html", error="An error occurred. Please log in again.")
 # Helper to check if user is premium or has active trial
 def is_premium():
-    if "user" not in session:
+    user = _session_entitlement()
+    if user is None:
         return False
-    user = session.get("user") or {}
-    
-    # Check if user is premium subscriber
-    tier = user.get("tier", "free") if isinstance(user, dict) else "free"
-    if tier == "premium":
-        return True
-    
-    # Check if user has active trial
-    trial_ends_at = user.get("trial_ends_at") if isinstance(user, dict) else None
-    if trial_ends_at:
-        try:
-            trial_end = datetime.fromisoformat(trial_ends_at)
-            if datetime.utcnow() < trial_end:
-                return True
-        except Exception as e:
-            print(f"[WARNING] Could not parse trial_ends_at: {str(e)}")
-    
-    return False
+
+    # Paid subscriber (tier written by the Stripe webhook) or active trial
+    return (user.tier != "free" and user.tier in TIERS) or user.trial_active()
 
 
 # Redirect free users to subscribe
@@ -491,7 +1814,7 @@ def subscribe():
 
 @app.errorhandler(500)
 def internal_error(error):
-    print(f"[ERROR] 500 Internal Server Error: {str(error)}")
+    logger.error("Internal server error", exc_info=getattr(error, "original_exception", None) or error)
     return render_template("500.html", error=str(error)), 500
 
 
@@ -518,5 +1841,7 @@ def not_found(error):
 # RUN THE APP
 # =====================================================
 if __name__ == "__main__":
+    # The dev server is a single process, so it can apply the schema itself
+    migrate()
     port = int(os.environ.get("PORT", 5000))
     app.run(host="0.0.0.0", port=port)
\ No newline at end of file
@@ -0,0 +1,172 @@
+"""Structured JSON logging that never blocks the request thread.
+
+configure() puts a QueueLogHandler on the root logger. Emitting a record
+tags it with the current request id and user, then does one put_nowait
+onto a bounded queue. A writer thread in each process (started lazily,
+so it survives gunicorn forks) formats records as one JSON object per
+line and writes them in batches. When the queue is full the record is
+dropped and counted rather than making the caller wait; the writer
+reports how many were lost.
+
+The request id lives in a ContextVar so code outside Flask (upstream
+call timing, background pools that copy the context, streamed bodies
+wrapped in in_context()) can log it too.
+Use sampled() to thin out high-volume success logs.
+"""
+import atexit
+import contextvars
+import json
+import logging
+import os
+import queue
+import random
+import sys
+import threading
+import traceback
+from datetime import datetime, timezone
+
+request_id_var = contextvars.ContextVar("request_id", default=None)
+user_id_var = contextvars.ContextVar("user_id", default=None)
+
+# Attributes every LogRecord has; anything else came in through `extra=`
+_STANDARD = set(vars(logging.LogRecord("", 0, "", 0, "", (), None))) | {"message", "asctime"}
+
+
+def sampled(rate):
+    """True for roughly `rate` of calls, e.g. `if failed or sampled(0.1): log...`."""
+    return rate >= 1 or random.random() < rate
+
+
+def in_context(iterable):
+    """Iterate iterable inside a copy of the current context.
+
+    Flask tears the request down before a streamed body is iterated; wrap
+    the generator in the view so its logs keep the request id.
+    """
+    ctx = contextvars.copy_context()
+    iterator = iter(iterable)
+
+    def run():
+        try:
+            while True:
+                try:
+                    item = ctx.run(next, iterator)
+                except StopIteration:
+                    return
+                yield item
+        finally:
+            close = getattr(iterator, "close", None)
+            if close:
+                ctx.run(close)
+    return run()
+
+
+def to_json(record):
+    entry = {
+        "ts": datetime.fromtimestamp(record.created, timezone.utc).isoformat(timespec="milliseconds"),
+        "level": record.levelname,
+        "logger": record.name,
+        "msg": record.getMessage()
+    }
+    for key, value in vars(record).items():
+        if key not in _STANDARD and not key.startswith("_"):
+            entry[key] = value
+    if record.exc_info:
+        entry["exc"] = "".join(traceback.format_exception(*record.exc_info)).rstrip()
+    return json.dumps(entry, default=str)
+
+
+class QueueLogHandler(logging.Handler):
+    def __init__(self, stream=None, max_queue=10000, batch_size=256):
+        super().__init__()
+        self.stream = stream
+        self.batch_size = batch_size
+        self.dropped = 0
+        self.written = 0
+        self._reported_dropped = 0
+        self._queue = queue.Queue(maxsize=max_queue)
+        self._pid = None
+        self._start_lock = threading.Lock()
+        atexit.register(self.drain)
+
+    def emit(self, record):
+        self._ensure_writer()
+        record.request_id = request_id_var.get()
+        if record.__dict__.get("user_id") is None:
+            record.user_id = user_id_var.get()
+        try:
+            self._queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+    def _ensure_writer(self):
+        if self._pid == os.getpid():
+            return
+        with self._start_lock:
+            if self._pid == os.getpid():
+                return
+            self._pid = os.getpid()
+            threading.Thread(target=self._run, name="log-writer", daemon=True).start()
+
+    def _write(self, records):
+        lines = []
+        for record in records:
+            try:
+                lines.append(to_json(record))
+            except Exception:
+                lines.append(json.dumps({"level": "ERROR", "msg": "Unserializable log record",
+                                         "logger": getattr(record, "name", None)}))
+        if self.dropped != self._reported_dropped:
+            lost = self.dropped - self._reported_dropped
+            self._reported_dropped = self.dropped
+            lines.append(json.dumps({"ts": datetime.now(timezone.utc).isoformat(timespec="milliseconds"),
+                                     "level": "WARNING", "logger": __name__,
+                                     "msg": "Log records dropped, queue full", "dropped": lost,
+                                     "dropped_total": self.dropped}))
+        stream = self.stream or sys.stdout
+        stream.write("\n".join(lines) + "\n")
+        stream.flush()
+        self.written += len(records)
+
+    def _take_batch(self, block=True):
+        records = []
+        try:
+            records.append(self._queue.get(block=block))
+            while len(records) < self.batch_size:
+                records.append(self._queue.get_nowait())
+        except queue.Empty:
+            pass
+        return records
+
+    def _run(self):
+        while True:
+            records = self._take_batch()
+            try:
+                self._write(records)
+            except Exception:
+                # Nowhere left to log to; count them as lost
+                self.dropped += len(records)
+
+    def drain(self):
+        """Write whatever is queued on the calling thread (atexit, tests)."""
+        while True:
+            records = self._take_batch(block=False)
+            if not records:
+                return
+            self._write(records)
+
+
+def configure(level=None, **handler_options):
+    """Route all logging through one QueueLogHandler; returns it."""
+    root = logging.getLogger()
+    for existing in root.handlers:
+        if isinstance(existing, QueueLogHandler):
+            return existing
+    handler = QueueLogHandler(**handler_options)
+    root.addHandler(handler)
+    root.setLevel(level or os.getenv("LOG_LEVEL", "INFO"))
+    # httpx (and openai's httpx2 fork) logs every request at INFO; upstream
+    # calls are logged by the app
+    for name in ("httpx", "httpx2"):
+        logging.getLogger(name).setLevel(logging.WARNING)
+    return handler
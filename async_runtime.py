@@ -0,0 +1,80 @@
+"""Shared event loop for upstream I/O (ASYNC_MODE).
+
+Each worker process runs one asyncio loop on a background thread. OpenAI,
+Supabase and Stripe calls are submitted to it as coroutines, so every
+in-flight call shares the same async HTTP connection pools and costs a
+parked request thread plus a coroutine, not a blocked process. Paired
+with gunicorn's gthread worker (see gunicorn.conf.py) a handful of
+processes can hold hundreds of slow upstream calls open at once.
+
+The loop and the clients bound to it are created lazily per process, so
+the runtime is safe to import before gunicorn forks.
+"""
+import asyncio
+import os
+import threading
+
+
+class AsyncRuntime:
+    def __init__(self):
+        self._loop = None
+        self._pid = None
+        self._resources = {}
+        self._lock = threading.Lock()
+
+    def loop(self):
+        if self._pid == os.getpid():
+            return self._loop
+        with self._lock:
+            if self._pid != os.getpid():
+                loop = asyncio.new_event_loop()
+                thread = threading.Thread(target=loop.run_forever, name="async-runtime", daemon=True)
+                thread.start()
+                self._resources = {}
+                self._loop = loop
+                self._pid = os.getpid()
+        return self._loop
+
+    def run(self, coro, timeout=None):
+        """Run a coroutine on the shared loop and wait for its result."""
+        future = asyncio.run_coroutine_threadsafe(coro, self.loop())
+        try:
+            return future.result(timeout)
+        except BaseException:
+            future.cancel()
+            raise
+
+    def resource(self, name, factory):
+        """Return a per-process object built by `await factory()` on the loop."""
+        loop = self.loop()
+        resource = self._resources.get(name)
+        if resource is None:
+            with self._lock:
+                resource = self._resources.get(name)
+                if resource is None:
+                    resource = asyncio.run_coroutine_threadsafe(factory(), loop).result()
+                    self._resources[name] = resource
+        return resource
+
+    def iterate(self, async_iterable):
+        """Wrap an async stream so request threads can consume it synchronously."""
+        return SyncStream(self, async_iterable)
+
+
+class SyncStream:
+    def __init__(self, runtime, stream):
+        self._runtime = runtime
+        self._stream = stream
+        self._iterator = stream.__aiter__()
+
+    def __iter__(self):
+        while True:
+            try:
+                yield self._runtime.run(self._iterator.__anext__())
+            except StopAsyncIteration:
+                return
+
+    def close(self):
+        close = getattr(self._stream, "close", None)
+        if close is not None:
+            self._runtime.run(close())
@@ -0,0 +1,201 @@
+"""Local verification of bearer tokens for the JSON API.
+
+Supabase access tokens are JWTs. Projects on the legacy shared secret
+sign them HS256 with the project's JWT secret (JWT_SECRET); projects on
+signing keys use ES256/RS256 keys published at the project's JWKS URL.
+TokenVerifier checks either kind locally: signature, `exp`, the issuer
+(`<SUPABASE_URL>/auth/v1`) and the audience ("authenticated"), so an API
+request never waits on auth.get_user.
+
+- JWKS keys are fetched on first use, then refreshed by a background
+  thread in each process. A token whose `kid` isn't known yet triggers
+  an immediate refetch (at most once per `min_refetch` seconds, so junk
+  kids can't hammer the endpoint). That is how a rotated-in key is
+  picked up. Keys dropped from the JWKS stop verifying on the next
+  refresh, cached tokens included.
+- Verified tokens are remembered in an LRU keyed by a hash of the token
+  until their `exp`, so a repeat request costs a dict lookup (plus, for
+  JWKS-signed tokens, a check that their key is still published).
+- Tokens signed with the app's own secret (what this API issued before
+  Supabase tokens were accepted) still verify, with `exp` enforced when
+  present.
+
+Asymmetric keys need PyJWT's crypto extra (the cryptography package);
+without it JWKS keys are skipped with a warning and only HS256 works.
+"""
+import hashlib
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict
+
+import jwt
+
+logger = logging.getLogger(__name__)
+
+ASYMMETRIC_ALGORITHMS = ("ES256", "RS256", "EdDSA")
+# Cache lifetime for tokens that carry no exp (legacy app tokens)
+NO_EXP_TTL = 300
+# Cache entries for tokens checked against a secret rather than a JWKS key
+_SECRET_SIGNED = object()
+
+
+class InvalidToken(Exception):
+    pass
+
+
+class JWKSKeys:
+    def __init__(self, url, fetch, refresh_interval=600.0, min_refetch=30.0):
+        """fetch(url) returns the parsed JWKS document."""
+        self.url = url
+        self.refresh_interval = refresh_interval
+        self.min_refetch = min_refetch
+        self.refreshes = 0
+        self.failures = 0
+        self._fetch = fetch
+        self._keys = {}  # kid -> PyJWK
+        self._fetched_at = None
+        self._lock = threading.Lock()
+        self._pid = None
+
+    def get(self, kid):
+        """The key for kid, refetching the JWKS if it isn't known yet."""
+        self._ensure_refresher()
+        key = self._keys.get(kid)
+        if key is None and self._may_refetch():
+            with self._lock:
+                # Another thread may have refetched while this one waited
+                if kid not in self._keys and self._may_refetch():
+                    self._refresh()
+            key = self._keys.get(kid)
+        return key
+
+    def has(self, kid):
+        """Whether kid is among the current keys, without refetching."""
+        return kid in self._keys
+
+    def _may_refetch(self):
+        return self._fetched_at is None or time.monotonic() - self._fetched_at >= self.min_refetch
+
+    def _refresh(self):
+        self._fetched_at = time.monotonic()
+        try:
+            document = self._fetch(self.url)
+        except Exception as e:
+            self.failures += 1
+            logger.warning("Could not fetch JWKS, keeping current keys", extra={"url": self.url, "error": str(e)})
+            return
+        keys = {}
+        for entry in document.get("keys", []):
+            try:
+                key = jwt.PyJWK(entry)
+            except Exception as e:
+                logger.warning("Skipping unusable JWKS key", extra={"kid": entry.get("kid"), "error": str(e)})
+                continue
+            keys[entry.get("kid")] = key
+        self._keys = keys
+        self.refreshes += 1
+
+    def _ensure_refresher(self):
+        if self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self._pid = os.getpid()
+            threading.Thread(target=self._run, name="jwks-refresh", daemon=True).start()
+
+    def _run(self):
+        while True:
+            time.sleep(self.refresh_interval)
+            with self._lock:
+                self._refresh()
+
+    def stats(self):
+        return {"keys": len(self._keys), "refreshes": self.refreshes, "failures": self.failures}
+
+
+class TokenVerifier:
+    def __init__(self, secret=None, jwks=None, issuer=None, audience="authenticated",
+                 legacy_secret=None, max_entries=10000, leeway=0):
+        self.secret = secret
+        self.jwks = jwks
+        self.issuer = issuer
+        self.audience = audience
+        self.legacy_secret = legacy_secret
+        self.max_entries = max_entries
+        self.leeway = leeway
+        self.hits = 0
+        self.misses = 0
+        self.rejected = 0
+        self._entries = OrderedDict()  # sha256(token) -> (valid_until, claims, kid)
+        self._lock = threading.Lock()
+
+    def verify(self, token):
+        """Claims of a valid token. Raises InvalidToken."""
+        digest = hashlib.sha256(token.encode()).digest()
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get(digest)
+            if entry is not None and entry[0] > now and (entry[2] is _SECRET_SIGNED or self.jwks.has(entry[2])):
+                self._entries.move_to_end(digest)
+                self.hits += 1
+                return entry[1]
+            self.misses += 1
+
+        try:
+            claims, kid = self._decode(token)
+        except (jwt.PyJWTError, InvalidToken) as e:
+            self.rejected += 1
+            raise InvalidToken(str(e)) from e
+
+        valid_until = claims["exp"] + self.leeway if "exp" in claims else now + NO_EXP_TTL
+        with self._lock:
+            self._entries[digest] = (valid_until, claims, kid)
+            self._entries.move_to_end(digest)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+        return claims
+
+    def _decode(self, token):
+        """(claims, kid of the JWKS key that verified them, or _SECRET_SIGNED)."""
+        header = jwt.get_unverified_header(token)
+        alg = header.get("alg")
+        if alg in ASYMMETRIC_ALGORITHMS:
+            if self.jwks is None:
+                raise InvalidToken("Asymmetric tokens are not accepted")
+            key = self.jwks.get(header.get("kid"))
+            if key is None:
+                raise InvalidToken("Unknown signing key")
+            return self._decode_supabase(token, key.key, key.algorithm_name), header.get("kid")
+        if alg != "HS256":
+            raise InvalidToken(f"Unsupported algorithm {alg}")
+        if self.secret:
+            try:
+                return self._decode_supabase(token, self.secret, "HS256"), _SECRET_SIGNED
+            except jwt.InvalidSignatureError:
+                if not self.legacy_secret:
+                    raise
+        if not self.legacy_secret:
+            raise InvalidToken("No key for HS256 tokens")
+        return jwt.decode(token, self.legacy_secret, algorithms=["HS256"], leeway=self.leeway,
+                          options={"verify_aud": False}), _SECRET_SIGNED
+
+    def _decode_supabase(self, token, key, algorithm):
+        return jwt.decode(
+            token, key,
+            algorithms=[algorithm],
+            audience=self.audience,
+            issuer=self.issuer,
+            leeway=self.leeway,
+            options={"require": ["exp", "sub"]}
+        )
+
+    def stats(self):
+        with self._lock:
+            size = len(self._entries)
+        stats = {"hits": self.hits, "misses": self.misses, "rejected": self.rejected, "entries": size}
+        if self.jwks is not None:
+            stats["jwks"] = self.jwks.stats()
+        return stats
@@ -0,0 +1,129 @@
+"""Batch generation: input parsing, bounded fan-out and async job records.
+
+A batch arrives as a JSON array (or {"prompts": [...]}) or as JSONL, one
+item per line. Items are strings or objects with a "prompt" and an
+optional client "id". Valid items are run on a small thread pool and
+results come back in completion order, so one slow prompt doesn't hold
+up the rest. Async jobs are rows in the shared database, so any worker
+can answer a status request; the worker that accepted the job runs it
+and heartbeats the row as results come in.
+"""
+import contextvars
+import json
+import zlib
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from datetime import datetime, timedelta, timezone
+
+from sqlalchemy import select, update
+
+from db import BatchJob
+
+JSONL_TYPES = ("application/x-ndjson", "application/jsonl", "application/x-jsonlines", "text/plain")
+# A running job whose heartbeat is older than this lost its worker
+STALE_AFTER = timedelta(minutes=5)
+
+
+def parse_batch(raw, content_type):
+    """Return [{"index", "id", "prompt"}]. Raises ValueError for an unreadable body."""
+    mimetype = (content_type or "").split(";")[0].strip().lower()
+    text = raw.decode("utf-8")
+    if mimetype in JSONL_TYPES:
+        entries = []
+        for n, line in enumerate(text.splitlines(), 1):
+            if line.strip():
+                try:
+                    entries.append(json.loads(line))
+                except ValueError:
+                    raise ValueError(f"Line {n} is not valid JSON")
+    else:
+        try:
+            entries = json.loads(text)
+        except ValueError:
+            raise ValueError("Body is not valid JSON")
+        if isinstance(entries, dict):
+            entries = entries.get("prompts")
+        if not isinstance(entries, list):
+            raise ValueError("Expected a JSON array of prompts")
+
+    items = []
+    for index, entry in enumerate(entries):
+        if isinstance(entry, dict):
+            items.append({"index": index, "id": entry.get("id"), "prompt": entry.get("prompt")})
+        else:
+            items.append({"index": index, "id": None, "prompt": entry})
+    return items
+
+
+def run_batch(items, fn, max_workers, on_cancel=None):
+    """Yield (item, result, error) in completion order, at most max_workers at once.
+
+    Closing the generator early cancels items that haven't started and
+    calls on_cancel(item) for each; items already running finish in the
+    background.
+    """
+    if not items:
+        return
+    executor = ThreadPoolExecutor(max_workers=max(1, min(max_workers, len(items))),
+                                  thread_name_prefix="batch")
+    pending = {executor.submit(contextvars.copy_context().run, fn, item): item for item in items}
+    try:
+        while pending:
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                item = pending.pop(future)
+                error = future.exception()
+                yield item, (None if error else future.result()), error
+    finally:
+        for future, item in pending.items():
+            if future.cancel() and on_cancel:
+                on_cancel(item)
+        executor.shutdown(wait=False)
+
+
+# --------------------
+# ASYNC JOBS
+# --------------------
+
+def _now():
+    return datetime.now(timezone.utc)
+
+
+def create_job(engine, job_id, user_id, total):
+    with engine.begin() as conn:
+        conn.execute(BatchJob.__table__.insert().values(
+            id=job_id, user_id=user_id, status="running", total=total,
+            succeeded=0, failed=0, created_at=_now(), updated_at=_now()))
+
+
+def update_job(engine, job_id, succeeded, failed, results=None):
+    """Record progress; passing results marks the job done."""
+    values = {"succeeded": succeeded, "failed": failed, "updated_at": _now()}
+    if results is not None:
+        values["status"] = "done"
+        values["results"] = zlib.compress("".join(json.dumps(r) + "\n" for r in results).encode("utf-8"))
+    with engine.begin() as conn:
+        conn.execute(update(BatchJob).where(BatchJob.id == job_id).values(**values))
+
+
+def get_job(engine, job_id, user_id):
+    """Job status dict for its owner, or None."""
+    with engine.connect() as conn:
+        job = conn.execute(select(BatchJob).where(
+            BatchJob.id == job_id, BatchJob.user_id == user_id)).first()
+    if job is None:
+        return None
+    status = job.status
+    updated_at = job.updated_at if job.updated_at.tzinfo else job.updated_at.replace(tzinfo=timezone.utc)
+    if status == "running" and _now() - updated_at > STALE_AFTER:
+        status = "lost"
+    info = {
+        "job_id": job.id,
+        "status": status,
+        "total": job.total,
+        "succeeded": job.succeeded,
+        "failed": job.failed,
+        "created_at": job.created_at.isoformat()
+    }
+    if job.results is not None:
+        info["results"] = [json.loads(line) for line in zlib.decompress(job.results).decode("utf-8").splitlines()]
+    return info
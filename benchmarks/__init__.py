@@ -0,0 +1 @@
+"""Offline load tests and benchmarks. See benchmarks/loadtest.py."""
@@ -0,0 +1,141 @@
+#!/usr/bin/env python3
+"""Cache stores: per-process dicts versus the shared-memory table.
+
+Two measurements:
+
+    ops        get/set cost in one process, for LocalStore and for
+               SharedMemoryStore with the entitlement codec app.py uses
+    workers    N worker processes (like gunicorn workers) each look up
+               entitlements for users picked at random from a skewed
+               population; a miss costs a simulated DB round trip. With
+               per-process dicts every worker warms its own copy, with
+               the shared store one worker's load is a hit for the rest.
+               Then the workers are replaced by fresh ones (as gunicorn's
+               max_requests recycling does) and run again: per-process
+               dicts start cold, the shared store is still warm.
+
+    python -m benchmarks.cachestore
+    python -m benchmarks.cachestore --workers 8 --users 20000 --lookups 20000 --miss-ms 2
+"""
+import argparse
+import json
+import multiprocessing
+import os
+import random
+import tempfile
+import time
+from datetime import datetime, timedelta, timezone
+
+from cachestore import LocalStore, SharedMemoryStore
+from entitlements import Entitlement, EntitlementCache, decode_entitlement, encode_entitlement
+
+TRIAL = datetime.now(timezone.utc) + timedelta(days=3)
+
+
+def _entitlement(i):
+    return Entitlement(f"user-{i}", f"user-{i}", f"user{i}@example.com", "pro", i % 20, TRIAL)
+
+
+def _store(kind, path, entries):
+    if kind == "local":
+        return LocalStore(entries, ttl=600)
+    return SharedMemoryStore(path, entries, ttl=600, slot_size=512,
+                             dumps=encode_entitlement, loads=decode_entitlement)
+
+
+def bench_ops(kind, path, n):
+    # Room to spare, so this measures lookups rather than set conflicts
+    store = _store(kind, path, 2 * n)
+    values = [_entitlement(i) for i in range(n)]
+    started = time.perf_counter()
+    for value in values:
+        store.set(value.subject, value)
+    set_us = (time.perf_counter() - started) / n * 1e6
+    started = time.perf_counter()
+    for value in values:
+        store.get(value.subject)
+    get_us = (time.perf_counter() - started) / n * 1e6
+    started = time.perf_counter()
+    for i in range(n):
+        store.get(f"absent-{i}")
+    miss_us = (time.perf_counter() - started) / n * 1e6
+    return {"store": kind, "set_us": round(set_us, 2), "get_us": round(get_us, 2), "miss_us": round(miss_us, 2)}
+
+
+def _worker(kind, path, users, lookups, miss_ms, seed, results):
+    cache = EntitlementCache(store=_store(kind, path, users))
+    rng = random.Random(seed)
+    loads = 0
+
+    def load(i):
+        nonlocal loads
+        loads += 1
+        time.sleep(miss_ms / 1000)
+        return _entitlement(i)
+
+    started = time.perf_counter()
+    for _ in range(lookups):
+        # Skewed like real traffic: a few active users make most requests
+        i = min(int(rng.paretovariate(1.2)) - 1, users - 1)
+        cache.get(f"user-{i}", lambda: load(i))
+    results.put((loads, time.perf_counter() - started))
+
+
+def _run_workers(kind, path, workers, users, lookups, miss_ms, first_seed):
+    context = multiprocessing.get_context("fork")
+    results = context.Queue()
+    procs = [context.Process(target=_worker, args=(kind, path, users, lookups, miss_ms, seed, results))
+             for seed in range(first_seed, first_seed + workers)]
+    started = time.perf_counter()
+    for p in procs:
+        p.start()
+    rows = [results.get() for _ in procs]
+    for p in procs:
+        p.join()
+    return sum(r[0] for r in rows), time.perf_counter() - started
+
+
+def bench_workers(kind, path, workers, users, lookups, miss_ms):
+    loads, elapsed = _run_workers(kind, path, workers, users, lookups, miss_ms, 0)
+    restarted_loads, _ = _run_workers(kind, path, workers, users, lookups, miss_ms, workers)
+    total = workers * lookups
+    return {
+        "store": kind,
+        "lookups_per_s": round(total / elapsed),
+        "hit_rate": round(1 - loads / total, 4),
+        "db_loads": loads,
+        "db_loads_restarted": restarted_loads
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--workers", type=int, default=4)
+    parser.add_argument("--users", type=int, default=10000)
+    parser.add_argument("--lookups", type=int, default=10000, help="Per worker")
+    parser.add_argument("--miss-ms", type=float, default=1.0, help="Simulated DB round trip on a miss")
+    parser.add_argument("--json", help="Also write results to this file")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        ops = [bench_ops(kind, os.path.join(tmp, "ops.bin"), args.users) for kind in ("local", "shared")]
+        workers = [bench_workers(kind, os.path.join(tmp, "workers.bin"), args.workers, args.users,
+                                 args.lookups, args.miss_ms) for kind in ("local", "shared")]
+
+    print(f"Single process, {args.users} entitlements\n")
+    print(f"{'store':<8}{'set us':>9}{'get us':>9}{'miss us':>9}")
+    for row in ops:
+        print(f"{row['store']:<8}{row['set_us']:>9}{row['get_us']:>9}{row['miss_us']:>9}")
+    print(f"\n{args.workers} workers x {args.lookups} lookups over {args.users} users, "
+          f"{args.miss_ms} ms per miss\n")
+    print(f"{'store':<8}{'lookups/s':>11}{'hit rate':>10}{'DB loads':>10}{'after restart':>15}")
+    for row in workers:
+        print(f"{row['store']:<8}{row['lookups_per_s']:>11}{row['hit_rate']:>10}{row['db_loads']:>10}"
+              f"{row['db_loads_restarted']:>15}")
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump({"ops": ops, "workers": workers}, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,304 @@
+#!/usr/bin/env python3
+"""Local stand-ins for the Supabase, OpenAI and Stripe HTTP APIs.
+
+Each fake is a small threaded HTTP server that answers just enough of the
+real API for app.py and the official SDKs to work against it:
+
+    Supabase  POST /auth/v1/signup, POST /auth/v1/token, GET /auth/v1/user,
+              GET /auth/v1/.well-known/jwks.json (the `jwks` attribute),
+              GET/POST/PATCH /rest/v1/<table>
+    OpenAI    POST /v1/chat/completions (JSON or SSE streaming)
+    Stripe    POST /v1/checkout/sessions
+
+OpenAI latency is configurable (time to first token plus per-token delay)
+and can inject a fraction of 500 errors, so slow or flaky upstreams can be
+reproduced offline. For deterministic tests, `latency_sequence` gives the
+latency of the next requests in order and `fail_models` makes every call
+for those models fail.
+
+Run standalone to poke at the app by hand:
+
+    python -m benchmarks.fakes --openai-latency 0.8
+"""
+import argparse
+import base64
+import hashlib
+import hmac
+import json
+import random
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+FAKE_JWT_SECRET = "benchmark-supabase-jwt-secret-000000000000"
+
+
+def _b64(raw):
+    return base64.urlsafe_b64encode(raw).rstrip(b"=").decode()
+
+
+def make_jwt(claims, secret=FAKE_JWT_SECRET):
+    """HS256-sign claims without needing PyJWT in the fake process."""
+    header = _b64(json.dumps({"alg": "HS256", "typ": "JWT"}).encode())
+    body = _b64(json.dumps(claims).encode())
+    signature = hmac.new(secret.encode(), f"{header}.{body}".encode(), hashlib.sha256).digest()
+    return f"{header}.{body}.{_b64(signature)}"
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    server_version = "FakeUpstream/1.0"
+
+    def log_message(self, *args):
+        pass
+
+    def read_json(self):
+        length = int(self.headers.get("Content-Length") or 0)
+        raw = self.rfile.read(length) if length else b""
+        if not raw:
+            return {}
+        try:
+            return json.loads(raw)
+        except ValueError:
+            return {k: v[0] for k, v in parse_qs(raw.decode()).items()}
+
+    def send_json(self, status, payload, headers=None):
+        body = json.dumps(payload).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def send_chunk(self, data):
+        self.wfile.write(b"%x\r\n%s\r\n" % (len(data), data))
+        self.wfile.flush()
+
+
+# --------------------
+# SUPABASE
+# --------------------
+
+class SupabaseHandler(_Handler):
+    def _user(self, email, user_id=None):
+        return {
+            "id": user_id or str(uuid.uuid5(uuid.NAMESPACE_URL, email)),
+            "aud": "authenticated",
+            "role": "authenticated",
+            "email": email,
+            "app_metadata": {"provider": "email"},
+            "user_metadata": {},
+            "created_at": "2024-01-01T00:00:00Z"
+        }
+
+    def _session(self, user):
+        now = int(time.time())
+        claims = {
+            "sub": user["id"],
+            "email": user["email"],
+            "aud": "authenticated",
+            "role": "authenticated",
+            "iss": f"{self.server.base_url}/auth/v1",
+            "iat": now,
+            "exp": now + 3600
+        }
+        return {
+            "access_token": make_jwt(claims),
+            "token_type": "bearer",
+            "expires_in": 3600,
+            "expires_at": now + 3600,
+            "refresh_token": uuid.uuid4().hex,
+            "user": user
+        }
+
+    def do_GET(self):
+        path = urlparse(self.path).path
+        time.sleep(self.server.latency)
+        if path == "/auth/v1/user":
+            return self.send_json(200, self._user("bench@example.com"))
+        if path == "/auth/v1/.well-known/jwks.json":
+            with self.server.lock:
+                self.server.jwks_requests = getattr(self.server, "jwks_requests", 0) + 1
+            return self.send_json(200, getattr(self.server, "jwks", {"keys": []}))
+        if path.startswith("/rest/v1/"):
+            table = path[len("/rest/v1/"):]
+            rows = list(self.server.tables.get(table, {}).values())
+            return self.send_json(200, rows, {"Content-Range": f"0-{len(rows)}/*"})
+        self.send_json(404, {"message": "not found"})
+
+    def do_POST(self):
+        parsed = urlparse(self.path)
+        body = self.read_json()
+        time.sleep(self.server.latency)
+        if parsed.path == "/auth/v1/signup":
+            return self.send_json(200, self._user(body.get("email", "new@example.com")))
+        if parsed.path == "/auth/v1/token":
+            user = self._user(body.get("email", "bench@example.com"))
+            return self.send_json(200, self._session(user))
+        if parsed.path.startswith("/rest/v1/"):
+            table = parsed.path[len("/rest/v1/"):]
+            rows = body if isinstance(body, list) else [body]
+            with self.server.lock:
+                store = self.server.tables.setdefault(table, {})
+                for row in rows:
+                    store[row.get("id") or uuid.uuid4().hex] = row
+            return self.send_json(201, rows)
+        self.send_json(404, {"message": "not found"})
+
+    def do_PATCH(self):
+        body = self.read_json()
+        time.sleep(self.server.latency)
+        self.send_json(200, [body])
+
+
+# --------------------
+# OPENAI
+# --------------------
+
+class OpenAIHandler(_Handler):
+    def do_POST(self):
+        if urlparse(self.path).path != "/v1/chat/completions":
+            return self.send_json(404, {"error": {"message": "not found"}})
+        body = self.read_json()
+        server = self.server
+        with server.lock:
+            server.requests = getattr(server, "requests", 0) + 1
+            sequence = getattr(server, "latency_sequence", None)
+            latency = sequence.pop(0) if sequence else server.latency
+        time.sleep(latency)
+        if (server.error_rate and random.random() < server.error_rate) or \
+                body.get("model") in getattr(server, "fail_models", ()):
+            return self.send_json(500, {"error": {"message": "injected failure", "type": "server_error"}})
+
+        words = [f"tok{i} " for i in range(server.tokens)]
+        usage = {"prompt_tokens": 12, "completion_tokens": len(words), "total_tokens": 12 + len(words)}
+        model = body.get("model", "gpt-fake")
+        if not body.get("stream"):
+            time.sleep(server.token_delay * len(words))
+            return self.send_json(200, {
+                "id": "chatcmpl-fake",
+                "object": "chat.completion",
+                "created": int(time.time()),
+                "model": model,
+                "choices": [{
+                    "index": 0,
+                    "message": {"role": "assistant", "content": "".join(words)},
+                    "finish_reason": "stop"
+                }],
+                "usage": usage
+            })
+
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+        try:
+            for word in words:
+                chunk = {
+                    "id": "chatcmpl-fake",
+                    "object": "chat.completion.chunk",
+                    "created": int(time.time()),
+                    "model": model,
+                    "choices": [{"index": 0, "delta": {"content": word}, "finish_reason": None}]
+                }
+                self.send_chunk(f"data: {json.dumps(chunk)}\n\n".encode())
+                time.sleep(server.token_delay)
+            if (body.get("stream_options") or {}).get("include_usage"):
+                chunk = {"id": "chatcmpl-fake", "object": "chat.completion.chunk",
+                         "created": int(time.time()), "model": model, "choices": [], "usage": usage}
+                self.send_chunk(f"data: {json.dumps(chunk)}\n\n".encode())
+            self.send_chunk(b"data: [DONE]\n\n")
+            self.wfile.write(b"0\r\n\r\n")
+        except (BrokenPipeError, ConnectionResetError):
+            pass
+
+
+# --------------------
+# STRIPE
+# --------------------
+
+class StripeHandler(_Handler):
+    def do_POST(self):
+        self.read_json()
+        time.sleep(self.server.latency)
+        if urlparse(self.path).path == "/v1/checkout/sessions":
+            session_id = f"cs_test_{uuid.uuid4().hex}"
+            return self.send_json(200, {
+                "id": session_id,
+                "object": "checkout.session",
+                "mode": "subscription",
+                "url": f"https://checkout.stripe.test/pay/{session_id}"
+            })
+        self.send_json(404, {"error": {"message": "not found"}})
+
+
+class FakeServer:
+    """Run one fake on a background thread. Extra kwargs become server attributes."""
+
+    def __init__(self, handler, port=0, latency=0.0, **attrs):
+        self.httpd = ThreadingHTTPServer(("127.0.0.1", port), handler)
+        self.httpd.daemon_threads = True
+        self.httpd.latency = latency
+        self.httpd.lock = threading.Lock()
+        self.httpd.tables = {}
+        self.httpd.base_url = f"http://127.0.0.1:{self.httpd.server_port}"
+        for key, value in attrs.items():
+            setattr(self.httpd, key, value)
+        self._thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+
+    @property
+    def url(self):
+        return self.httpd.base_url
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+
+def start_fakes(openai_latency=0.5, token_delay=0.01, tokens=40, error_rate=0.0,
+                supabase_latency=0.05, stripe_latency=0.15):
+    """Start all three fakes and return them keyed by service name."""
+    return {
+        "supabase": FakeServer(SupabaseHandler, latency=supabase_latency).start(),
+        "openai": FakeServer(OpenAIHandler, latency=openai_latency, token_delay=token_delay,
+                             tokens=tokens, error_rate=error_rate).start(),
+        "stripe": FakeServer(StripeHandler, latency=stripe_latency).start()
+    }
+
+
+def app_environment(fakes):
+    """Environment variables that point app.py at the fakes."""
+    return {
+        "SUPABASE_URL": fakes["supabase"].url,
+        "SUPABASE_KEY": make_jwt({"role": "anon", "iss": "supabase"}),
+        "OPENAI_API_KEY": "sk-fake",
+        "OPENAI_BASE_URL": fakes["openai"].url + "/v1",
+        "STRIPE_SECRET_KEY": "sk_test_fake",
+        "STRIPE_API_BASE": fakes["stripe"].url,
+        "STRIPE_PRICE_ID": "price_fake"
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--openai-latency", type=float, default=0.5)
+    parser.add_argument("--token-delay", type=float, default=0.01)
+    parser.add_argument("--tokens", type=int, default=40)
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    args = parser.parse_args()
+
+    fakes = start_fakes(args.openai_latency, args.token_delay, args.tokens, args.error_rate)
+    for key, value in app_environment(fakes).items():
+        print(f"export {key}={value}")
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        pass
@@ -0,0 +1,345 @@
+#!/usr/bin/env python3
+"""Offline load test for app.py.
+
+Boots the app under gunicorn against the local fakes in benchmarks/fakes.py
+and a throwaway SQLite users table. It then drives a traffic mix from N
+keep-alive client threads and reports latency percentiles and throughput
+per route, once for each worker configuration.
+
+    python -m benchmarks.loadtest --configs sync:4 gthread:2x32 async:2x256
+    python -m benchmarks.loadtest --mix generate --openai-latency 1.5 --duration 30
+    python -m benchmarks.loadtest --replay captured.jsonl
+
+Worker configs are `sync:<workers>`, `gthread:<workers>x<threads>` or
+`async:<workers>x<threads>` (ASYNC_MODE=1 with gthread workers).
+
+Replay files are JSONL. A line with a "path" is sent as-is:
+    {"method": "POST", "path": "/generate", "json": {"prompt": "hi"}, "auth": true}
+Any other line with a "prompt" or "body" field (e.g. requests.jsonl) is
+replayed as an authenticated POST /generate with that text as the prompt.
+"""
+import argparse
+import http.client
+import itertools
+import json
+import os
+import random
+import signal
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import uuid
+from collections import defaultdict
+from urllib.parse import urlencode
+
+from sqlalchemy import create_engine
+
+from benchmarks.fakes import app_environment, make_jwt, start_fakes
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+APP_SECRET = "benchmark-app-secret-0000000000000000"
+
+MIXES = {
+    "default": [(40, "landing"), (10, "login"), (30, "generate"), (10, "generate_stream"), (10, "checkout")],
+    "generate": [(75, "generate"), (25, "generate_stream")],
+    "pages": [(70, "landing"), (30, "home")],
+    "auth": [(60, "login"), (40, "signup")]
+}
+
+
+# --------------------
+# REQUEST BUILDERS
+# --------------------
+
+def build_request(kind, prompt=None):
+    """Return (label, method, path, body_dict_or_None, form, needs_auth)."""
+    if kind == "landing":
+        return ("GET /", "GET", "/", None, False, False)
+    if kind == "home":
+        return ("GET /home", "GET", "/home", None, False, False)
+    if kind == "login":
+        return ("POST /login", "POST", "/login",
+                {"email": "bench@example.com", "password": "benchmark"}, True, False)
+    if kind == "signup":
+        return ("POST /signup", "POST", "/signup",
+                {"email": f"{uuid.uuid4().hex[:10]}@example.com", "password": "benchmark"}, True, False)
+    if kind == "checkout":
+        return ("POST /create-checkout-session", "POST", "/create-checkout-session", None, True, False)
+    prompt = prompt or f"Write a caption about {random.choice(['coffee', 'yoga', 'travel', 'pets'])}"
+    if kind == "generate_stream":
+        return ("POST /generate?stream=1", "POST", "/generate?stream=1", {"prompt": prompt}, False, True)
+    return ("POST /generate", "POST", "/generate", {"prompt": prompt}, False, True)
+
+
+def load_replay(path):
+    requests = []
+    with open(path) as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            entry = json.loads(line)
+            if "path" in entry:
+                form = "form" in entry
+                body = entry.get("form") if form else entry.get("json")
+                method = entry.get("method") or ("POST" if body is not None else "GET")
+                label = f"{method} {entry['path']}"
+                requests.append((label, method, entry["path"], body, form, entry.get("auth", False)))
+            elif entry.get("prompt") or entry.get("body"):
+                requests.append(build_request("generate", entry.get("prompt") or entry.get("body")))
+    if not requests:
+        raise SystemExit(f"No replayable requests in {path}")
+    return requests
+
+
+def request_source(mix=None, replay=None):
+    if replay:
+        cycle = itertools.cycle(load_replay(replay))
+        lock = threading.Lock()
+
+        def next_request():
+            with lock:
+                return next(cycle)
+        return next_request
+
+    weights, kinds = zip(*MIXES[mix])
+    return lambda: build_request(random.choices(kinds, weights)[0])
+
+
+# --------------------
+# APP UNDER TEST
+# --------------------
+
+def seed_database(path, n_users, tier):
+    # db.py refuses to import without a DATABASE_URL; the app under test gets
+    # its own in start_app(), this one only has to let the import through
+    os.environ.setdefault("DATABASE_URL", f"sqlite:///{path}")
+    from db import Base, User
+    from history import init_search
+    engine = create_engine(f"sqlite:///{path}")
+    # What `python db.py migrate` does on a deploy
+    Base.metadata.create_all(engine)
+    init_search(engine)
+    users = [{"id": f"bench-{i}", "email": f"bench{i}@example.com", "tier": tier, "used": 0}
+             for i in range(n_users)]
+    with engine.begin() as conn:
+        conn.execute(User.__table__.insert(), users)
+    engine.dispose()
+    now = int(time.time())
+    return [make_jwt({"sub": u["id"], "email": u["email"], "iat": now, "exp": now + 86400}, APP_SECRET)
+            for u in users]
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def parse_config(spec):
+    mode, _, size = spec.partition(":")
+    workers, _, threads = (size or "2").partition("x")
+    env = {"WEB_CONCURRENCY": workers, "GUNICORN_THREADS": threads or "1", "ASYNC_MODE": "0"}
+    if mode == "sync":
+        env["GUNICORN_WORKER_CLASS"] = "sync"
+    elif mode == "gthread":
+        env["GUNICORN_WORKER_CLASS"] = "gthread"
+    elif mode == "async":
+        env["ASYNC_MODE"] = "1"
+    else:
+        raise SystemExit(f"Unknown worker config {spec!r}")
+    return env
+
+
+def start_app(config_env, fake_env, db_path, port):
+    env = dict(os.environ)
+    env.update(fake_env)
+    env.update(config_env)
+    env.update({
+        "PORT": str(port),
+        "DATABASE_URL": f"sqlite:///{db_path}",
+        "SECRET_KEY": APP_SECRET,
+        "OPENAI_MAX_CONCURRENCY": env.get("OPENAI_MAX_CONCURRENCY", "1024"),
+        # Every simulated client shares 127.0.0.1; measure capacity, not the limiter
+        "RATE_LIMIT_ENABLED": env.get("RATE_LIMIT_ENABLED", "0"),
+        "PYTHONUNBUFFERED": "1"
+    })
+    proc = subprocess.Popen(
+        [sys.executable, "-m", "gunicorn", "-c", "gunicorn.conf.py", "app:app"],
+        cwd=REPO_ROOT, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+        start_new_session=True
+    )
+    deadline = time.time() + 60
+    while time.time() < deadline:
+        if proc.poll() is not None:
+            raise SystemExit("gunicorn exited during startup")
+        try:
+            conn = http.client.HTTPConnection("127.0.0.1", port, timeout=2)
+            conn.request("GET", "/")
+            conn.getresponse().read()
+            conn.close()
+            return proc
+        except OSError:
+            time.sleep(0.2)
+    stop_app(proc)
+    raise SystemExit("gunicorn did not come up within 60s")
+
+
+def stop_app(proc):
+    # Workers can linger on non-daemon SDK timer threads; don't wait forever
+    os.killpg(proc.pid, signal.SIGTERM)
+    try:
+        proc.wait(timeout=10)
+    except subprocess.TimeoutExpired:
+        os.killpg(proc.pid, signal.SIGKILL)
+        proc.wait()
+
+
+# --------------------
+# LOAD GENERATION
+# --------------------
+
+def run_load(port, next_request, tokens, concurrency, duration, warmup):
+    results = defaultdict(list)  # label -> [(latency, status)]
+    lock = threading.Lock()
+    start = time.monotonic()
+    measure_from = start + warmup
+    stop_at = measure_from + duration
+
+    def client():
+        conn = http.client.HTTPConnection("127.0.0.1", port, timeout=120)
+        local = defaultdict(list)
+        while True:
+            now = time.monotonic()
+            if now >= stop_at:
+                break
+            label, method, path, body, form, auth = next_request()
+            headers = {}
+            payload = None
+            if body is not None:
+                if form:
+                    payload = urlencode(body)
+                    headers["Content-Type"] = "application/x-www-form-urlencoded"
+                else:
+                    payload = json.dumps(body)
+                    headers["Content-Type"] = "application/json"
+            if auth:
+                headers["Authorization"] = f"Bearer {random.choice(tokens)}"
+            began = time.monotonic()
+            try:
+                conn.request(method, path, body=payload, headers=headers)
+                response = conn.getresponse()
+                response.read()
+                status = response.status
+                if response.getheader("Connection", "").lower() == "close":
+                    conn.close()
+            except (OSError, http.client.HTTPException):
+                status = 0
+                conn.close()
+                conn = http.client.HTTPConnection("127.0.0.1", port, timeout=120)
+            if began >= measure_from:
+                local[label].append((time.monotonic() - began, status))
+        conn.close()
+        with lock:
+            for label, samples in local.items():
+                results[label].extend(samples)
+
+    threads = [threading.Thread(target=client) for _ in range(concurrency)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    return results
+
+
+def percentile(sorted_values, pct):
+    if not sorted_values:
+        return 0.0
+    index = min(len(sorted_values) - 1, int(round(pct / 100 * (len(sorted_values) - 1))))
+    return sorted_values[index]
+
+
+def summarize(config, results, duration):
+    rows = []
+    for label in sorted(results):
+        samples = results[label]
+        latencies = sorted(s[0] for s in samples)
+        statuses = defaultdict(int)
+        for _, status in samples:
+            statuses[status] += 1
+        rows.append({
+            "config": config,
+            "route": label,
+            "requests": len(samples),
+            "rps": round(len(samples) / duration, 2),
+            "p50_ms": round(1000 * percentile(latencies, 50), 2),
+            "p95_ms": round(1000 * percentile(latencies, 95), 2),
+            "p99_ms": round(1000 * percentile(latencies, 99), 2),
+            "statuses": dict(sorted(statuses.items()))
+        })
+    return rows
+
+
+def print_table(rows):
+    header = f"{'config':<16}{'route':<34}{'n':>7}{'rps':>9}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}  statuses"
+    print(header)
+    print("-" * len(header))
+    for r in rows:
+        print(f"{r['config']:<16}{r['route']:<34}{r['requests']:>7}{r['rps']:>9}"
+              f"{r['p50_ms']:>10}{r['p95_ms']:>10}{r['p99_ms']:>10}  {r['statuses']}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--configs", nargs="+", default=["sync:2", "gthread:2x32", "async:2x256"])
+    parser.add_argument("--mix", choices=sorted(MIXES), default="default")
+    parser.add_argument("--replay", help="JSONL file of requests to replay instead of a mix")
+    parser.add_argument("--concurrency", type=int, default=32)
+    parser.add_argument("--duration", type=float, default=15.0)
+    parser.add_argument("--warmup", type=float, default=2.0)
+    parser.add_argument("--users", type=int, default=200)
+    parser.add_argument("--tier", default="agency")
+    parser.add_argument("--openai-latency", type=float, default=0.5)
+    parser.add_argument("--token-delay", type=float, default=0.01)
+    parser.add_argument("--tokens", type=int, default=40)
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    parser.add_argument("--json", help="Also write results to this file")
+    args = parser.parse_args()
+
+    sys.path.insert(0, REPO_ROOT)
+    next_request = request_source(args.mix, args.replay)
+    fakes = start_fakes(args.openai_latency, args.token_delay, args.tokens, args.error_rate)
+    fake_env = app_environment(fakes)
+
+    all_rows = []
+    try:
+        for config in args.configs:
+            with tempfile.TemporaryDirectory() as tmp:
+                db_path = os.path.join(tmp, "bench.db")
+                tokens = seed_database(db_path, args.users, args.tier)
+                port = free_port()
+                proc = start_app(parse_config(config), fake_env, db_path, port)
+                try:
+                    results = run_load(port, next_request, tokens, args.concurrency,
+                                       args.duration, args.warmup)
+                finally:
+                    stop_app(proc)
+            rows = summarize(config, results, args.duration)
+            all_rows.extend(rows)
+            print_table(rows)
+            total = sum(r["requests"] for r in rows)
+            print(f"{config}: {total} requests, {total / args.duration:.1f} req/s overall\n")
+    finally:
+        for fake in fakes.values():
+            fake.stop()
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(all_rows, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,153 @@
+#!/usr/bin/env python3
+"""Worker startup cost: import time and resident memory.
+
+Two measurements, both offline against benchmarks/fakes.py:
+
+1. `import app` in a fresh interpreter, repeated --runs times. "lazy" is
+   the app as shipped; "eager" also builds the OpenAI, Supabase and Stripe
+   clients straight after import. That is what every worker paid
+   before clients.py, so the two rows are the before/after comparison.
+2. A real gunicorn boot: time until the first response, and per-worker RSS
+   after serving pages only and again after every worker has served
+   /generate (so its clients exist).
+
+    python -m benchmarks.startup
+    python -m benchmarks.startup --runs 10 --workers 4
+"""
+import argparse
+import http.client
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+from benchmarks.fakes import app_environment, start_fakes
+from benchmarks.loadtest import REPO_ROOT, free_port, parse_config, seed_database, start_app, stop_app
+
+IMPORT_PROBE = """
+import json, sys, time
+started = time.perf_counter()
+import app
+imported = time.perf_counter() - started
+if sys.argv[1] == "eager":
+    app.client.get(); app.supabase.get(); app.stripe.get()
+total = time.perf_counter() - started
+rss_kb = 0
+with open("/proc/self/status") as f:
+    for line in f:
+        if line.startswith("VmRSS:"):
+            rss_kb = int(line.split()[1])
+print(json.dumps({"import_s": imported, "total_s": total, "rss_kb": rss_kb,
+                  "sdks": sorted(m for m in ("openai", "stripe", "supabase") if m in sys.modules)}))
+"""
+
+
+def rss_kb(pid):
+    try:
+        with open(f"/proc/{pid}/status") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    return 0
+
+
+def worker_pids(master_pid):
+    try:
+        with open(f"/proc/{master_pid}/task/{master_pid}/children") as f:
+            return [int(pid) for pid in f.read().split()]
+    except OSError:
+        return []
+
+
+def measure_imports(mode, runs, env):
+    samples = []
+    for _ in range(runs):
+        out = subprocess.run([sys.executable, "-c", IMPORT_PROBE, mode], cwd=REPO_ROOT, env=env,
+                             capture_output=True, text=True, check=True).stdout
+        samples.append(json.loads(out.strip().splitlines()[-1]))
+    return {
+        "mode": mode,
+        "import_ms": round(1000 * statistics.median(s["import_s"] for s in samples), 1),
+        "ready_ms": round(1000 * statistics.median(s["total_s"] for s in samples), 1),
+        "rss_mb": round(statistics.median(s["rss_kb"] for s in samples) / 1024, 1),
+        "sdks_loaded": samples[0]["sdks"]
+    }
+
+
+def _hit(port, method, path, body=None, headers=None):
+    conn = http.client.HTTPConnection("127.0.0.1", port, timeout=30)
+    conn.request(method, path, body=body, headers=headers or {})
+    conn.getresponse().read()
+    conn.close()
+
+
+def measure_workers(fake_env, workers, tokens_per_worker=8):
+    with tempfile.TemporaryDirectory() as tmp:
+        db_path = os.path.join(tmp, "bench.db")
+        tokens = seed_database(db_path, tokens_per_worker * workers, "agency")
+        port = free_port()
+        started = time.monotonic()
+        proc = start_app(parse_config(f"sync:{workers}"), fake_env, db_path, port)
+        boot_ms = round(1000 * (time.monotonic() - started), 1)
+        try:
+            for _ in range(4 * workers):
+                _hit(port, "GET", "/")
+            pids = worker_pids(proc.pid)
+            pages_rss = [rss_kb(pid) for pid in pids]
+            # Sync workers take connections in turn, so enough calls reach all of them
+            for token in tokens:
+                _hit(port, "POST", "/generate", json.dumps({"prompt": "hello"}),
+                     {"Content-Type": "application/json", "Authorization": f"Bearer {token}"})
+            generate_rss = [rss_kb(pid) for pid in worker_pids(proc.pid)]
+        finally:
+            stop_app(proc)
+    return {
+        "workers": len(pids),
+        "boot_to_first_response_ms": boot_ms,
+        "worker_rss_mb_pages": round(statistics.mean(pages_rss) / 1024, 1) if pages_rss else None,
+        "worker_rss_mb_after_generate": round(statistics.mean(generate_rss) / 1024, 1) if generate_rss else None
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--workers", type=int, default=2)
+    parser.add_argument("--json", help="Also write results to this file")
+    args = parser.parse_args()
+
+    sys.path.insert(0, REPO_ROOT)
+    fakes = start_fakes(openai_latency=0.0, token_delay=0.0)
+    fake_env = app_environment(fakes)
+    env = dict(os.environ)
+    env.update(fake_env)
+    env["DATABASE_URL"] = f"sqlite:///{os.path.join(tempfile.gettempdir(), 'startup-bench.db')}"
+    env["RATE_LIMIT_ENABLED"] = "0"
+
+    try:
+        imports = [measure_imports(mode, args.runs, env) for mode in ("eager", "lazy")]
+        boot = measure_workers(fake_env, args.workers)
+    finally:
+        for fake in fakes.values():
+            fake.stop()
+
+    print(f"{'mode':<8}{'import ms':>11}{'ready ms':>10}{'RSS MB':>9}  SDKs imported")
+    for row in imports:
+        print(f"{row['mode']:<8}{row['import_ms']:>11}{row['ready_ms']:>10}{row['rss_mb']:>9}  "
+              f"{', '.join(row['sdks_loaded']) or '-'}")
+    print(f"\ngunicorn sync:{boot['workers']}: first response after {boot['boot_to_first_response_ms']} ms, "
+          f"worker RSS {boot['worker_rss_mb_pages']} MB serving pages, "
+          f"{boot['worker_rss_mb_after_generate']} MB after /generate")
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump({"imports": imports, "gunicorn": boot}, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
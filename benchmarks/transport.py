@@ -0,0 +1,176 @@
+#!/usr/bin/env python3
+"""Upstream HTTP transport: connection reuse under concurrent load.
+
+Starts the OpenAI fake from benchmarks/fakes.py (over TLS with a throwaway
+self-signed certificate when openssl is available, since handshakes are
+most of what pooling saves) and sends the same number of chat completion
+requests from N threads through each client setup:
+
+    no-keepalive   a connection (and DNS lookup) per request
+    requests       a default requests.Session, pool of 10 per host; what
+                   the Stripe SDK used before transport.py
+    pooled         TransportPools as configured in app.py
+    pooled-sized   TransportPools with keep-alive sized to the thread count
+
+Connections are counted by the server, so every row is measured the same
+way. Requests go to "localhost" so the DNS cache has something to do.
+
+    python -m benchmarks.transport
+    python -m benchmarks.transport --threads 64 --requests 4000 --latency 0.05
+"""
+import argparse
+import json
+import multiprocessing
+import os
+import shutil
+import ssl
+import statistics
+import subprocess
+import tempfile
+import threading
+import time
+
+import requests
+
+from benchmarks.fakes import FakeServer, OpenAIHandler
+from transport import TransportPools
+
+
+class _CountingHandler(OpenAIHandler):
+    def setup(self):
+        # One handler instance per TCP connection
+        with self.server.connections.get_lock():
+            self.server.connections.value += 1
+        super().setup()
+
+
+def _self_signed(directory):
+    cert, key = os.path.join(directory, "cert.pem"), os.path.join(directory, "key.pem")
+    subprocess.run(["openssl", "req", "-x509", "-newkey", "rsa:2048", "-nodes", "-days", "1",
+                    "-subj", "/CN=localhost", "-addext", "subjectAltName=DNS:localhost",
+                    "-keyout", key, "-out", cert], check=True, capture_output=True)
+    return cert, key
+
+
+def _serve(latency, cert, key, connections, ready):
+    server = FakeServer(_CountingHandler, latency=latency, token_delay=0.0, tokens=20,
+                        error_rate=0.0, connections=connections)
+    if cert:
+        context = ssl.create_default_context(ssl.Purpose.CLIENT_AUTH)
+        context.load_cert_chain(cert, key)
+        # Handshake on the handler thread, not in the accept loop
+        server.httpd.socket = context.wrap_socket(server.httpd.socket, server_side=True,
+                                                  do_handshake_on_connect=False)
+    ready.put(server.httpd.server_port)
+    server.httpd.serve_forever()
+
+
+def start_server(latency, tls_dir=None):
+    """Run the fake in its own process so it doesn't share the client's GIL.
+
+    Returns (process, base_url, verify, connection counter).
+    """
+    cert = key = None
+    if tls_dir:
+        cert, key = _self_signed(tls_dir)
+    connections = multiprocessing.Value("i", 0)
+    ready = multiprocessing.Queue()
+    process = multiprocessing.Process(target=_serve, args=(latency, cert, key, connections, ready), daemon=True)
+    process.start()
+    port = ready.get(timeout=10)
+    scheme = "https" if cert else "http"
+    return process, f"{scheme}://localhost:{port}", cert or True, connections
+
+
+BODY = {"model": "gpt-4o-mini", "messages": [{"role": "user", "content": "hi"}]}
+
+
+def _drive(send, threads, total):
+    latencies = []
+    lock = threading.Lock()
+    counter = iter(range(total))
+
+    def worker():
+        mine = []
+        while True:
+            with lock:
+                if next(counter, None) is None:
+                    break
+            started = time.perf_counter()
+            send()
+            mine.append(time.perf_counter() - started)
+        with lock:
+            latencies.extend(mine)
+
+    started = time.perf_counter()
+    pool = [threading.Thread(target=worker) for _ in range(threads)]
+    for t in pool:
+        t.start()
+    for t in pool:
+        t.join()
+    elapsed = time.perf_counter() - started
+    latencies.sort()
+    return {
+        "req_per_s": round(total / elapsed, 1),
+        "p50_ms": round(1000 * statistics.median(latencies), 2),
+        "p99_ms": round(1000 * latencies[int(len(latencies) * 0.99) - 1], 2)
+    }
+
+
+def run_scenario(name, base_url, verify, connections, threads, total):
+    url = base_url + "/v1/chat/completions"
+    connections.value = 0
+    pools = None
+    if name == "requests":
+        session = requests.Session()
+        send = lambda: session.post(url, json=BODY, verify=verify).raise_for_status()  # noqa: E731
+    else:
+        if name == "no-keepalive":
+            pools = TransportPools(max_keepalive=0, dns_ttl=0)
+        elif name == "pooled-sized":
+            pools = TransportPools(max_connections=threads, max_keepalive=threads)
+        else:
+            pools = TransportPools()
+        context = ssl.create_default_context(cafile=verify) if isinstance(verify, str) else verify
+        client = pools.client("bench", verify=context)
+        send = lambda: client.post(url, json=BODY).raise_for_status()  # noqa: E731
+
+    row = {"scenario": name, **_drive(send, threads, total), "connections": connections.value}
+    if pools is not None:
+        stats = pools.stats()
+        row["avg_wait_ms"] = stats["pools"]["bench:sync"]["avg_wait_ms"]
+        row["dns_lookups"] = stats["dns_cache"]["misses"] if pools.dns_ttl > 0 else "off"
+    return row
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--threads", type=int, default=32)
+    parser.add_argument("--requests", type=int, default=2000)
+    parser.add_argument("--latency", type=float, default=0.02, help="Fake OpenAI response time (s)")
+    parser.add_argument("--no-tls", action="store_true")
+    parser.add_argument("--json", help="Also write results to this file")
+    args = parser.parse_args()
+
+    tls = not args.no_tls and shutil.which("openssl")
+    with tempfile.TemporaryDirectory() as tmp:
+        process, base_url, verify, connections = start_server(args.latency, tmp if tls else None)
+        try:
+            rows = [run_scenario(name, base_url, verify, connections, args.threads, args.requests)
+                    for name in ("no-keepalive", "requests", "pooled", "pooled-sized")]
+        finally:
+            process.terminate()
+
+    print(f"{args.requests} requests from {args.threads} threads over {'https' if tls else 'http'}, "
+          f"{int(args.latency * 1000)} ms upstream\n")
+    print(f"{'scenario':<14}{'req/s':>9}{'p50 ms':>9}{'p99 ms':>9}{'conns':>8}{'wait ms':>9}{'DNS':>6}")
+    for row in rows:
+        print(f"{row['scenario']:<14}{row['req_per_s']:>9}{row['p50_ms']:>9}{row['p99_ms']:>9}"
+              f"{row['connections']:>8}{row.get('avg_wait_ms', '-'):>9}{row.get('dns_lookups', '-'):>6}")
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(rows, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,340 @@
+"""Cache stores: a per-process dict, or one memory-mapped table per host.
+
+Both implement the same small API (get, set, delete, clear, stats), so
+EntitlementCache and ResponseCache don't care which one they are given.
+
+LocalStore is an LRU/TTL dict in the worker's own memory. Every gunicorn
+worker has its own copy, each one cold after a restart.
+
+SharedMemoryStore keeps entries in a memory-mapped file that every
+worker on the host maps, laid out like the rate limiter's buckets: a key
+hashes to one set of `ways` fixed-size slots. A slot holds a header (key
+hash, sequence number, length, expiry, last use) and a payload of the
+full key followed by the encoded value. So:
+
+- Reads take no lock. A writer makes the slot's sequence number odd,
+  writes, then makes it even again. A reader that sees an odd number, or
+  a different number after copying the payload, retries (a seqlock). The
+  full key is compared as well as the hash, so a collision or a stale
+  layout is a miss, never a wrong value.
+- Writes lock only their set: a striped thread lock plus an fcntl byte
+  range lock, as in ratelimit.py. A write replaces the key's own slot, an
+  empty or expired one, or else the least recently used one in the set.
+  Reads refresh a slot's last use at most once a second.
+- Values are encoded compactly (a type tag and UTF-8 text, raw bytes or
+  JSON, zlib-compressed once they are large enough to benefit). Callers
+  can pass their own dumps/loads; nothing is pickled, since anything
+  that can write the file could otherwise run code in every worker.
+  Entries that don't fit a slot are not stored.
+
+Hit and miss counters are per process.
+"""
+import fcntl
+import hashlib
+import json
+import mmap
+import os
+import struct
+import threading
+import time
+import zlib
+from collections import OrderedDict
+
+# --------------------
+# VALUE ENCODING
+# --------------------
+
+_STR, _BYTES, _JSON = 1, 2, 3
+_COMPRESSED = 0x80
+# Smaller values rarely get shorter under zlib
+COMPRESS_MIN = 256
+
+
+def encode_value(value):
+    if isinstance(value, bytes):
+        tag, raw = _BYTES, value
+    elif isinstance(value, str):
+        tag, raw = _STR, value.encode("utf-8")
+    else:
+        tag, raw = _JSON, json.dumps(value, separators=(",", ":")).encode("utf-8")
+    if len(raw) >= COMPRESS_MIN:
+        packed = zlib.compress(raw, 1)
+        if len(packed) < len(raw):
+            return bytes((tag | _COMPRESSED,)) + packed
+    return bytes((tag,)) + raw
+
+
+def decode_value(blob):
+    tag, raw = blob[0], blob[1:]
+    if tag & _COMPRESSED:
+        tag, raw = tag & ~_COMPRESSED, zlib.decompress(raw)
+    if tag == _STR:
+        return raw.decode("utf-8")
+    if tag == _BYTES:
+        return bytes(raw)
+    if tag == _JSON:
+        return json.loads(raw)
+    raise ValueError(f"Unknown value tag {tag}")
+
+
+# --------------------
+# LOCAL (PER PROCESS)
+# --------------------
+
+class LocalStore:
+    def __init__(self, max_entries=10000, ttl=30):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._entries = OrderedDict()  # key -> (expires_at, value)
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key):
+        """The value, or None if missing or expired."""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] > time.monotonic():
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return entry[1]
+            if entry is not None:
+                del self._entries[key]
+            self.misses += 1
+            return None
+
+    def set(self, key, value, ttl=None):
+        with self._lock:
+            self._entries[key] = (time.monotonic() + (self.ttl if ttl is None else ttl), value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+        return True
+
+    def delete(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        with self._lock:
+            return {"backend": "local", "hits": self.hits, "misses": self.misses,
+                    "evictions": self.evictions, "entries": len(self._entries)}
+
+
+# --------------------
+# SHARED (PER HOST)
+# --------------------
+
+_MAGIC = b"AIPC"
+_VERSION = 1
+_FILE_HEADER = struct.Struct("<4sIIII")  # magic, version, sets, ways, slot_size
+_DATA_OFFSET = 64
+# key hash, seq, payload length, expires_at, used_at (epoch seconds)
+_SLOT = struct.Struct("<QIIdd")
+_HASH = struct.Struct("<Q")
+_SEQ = struct.Struct("<I")
+_LENGTH = struct.Struct("<I")
+_TIMES = struct.Struct("<dd")
+_USED = struct.Struct("<d")
+_KEY_LEN = struct.Struct("<H")
+_STRIPES = 64
+_READ_RETRIES = 8
+TOUCH_INTERVAL = 1.0
+_ABSENT = (None, 0.0, 0.0, None)
+
+
+def _hash(key):
+    # 0 marks an empty slot
+    return int.from_bytes(hashlib.blake2b(key, digest_size=8).digest(), "little") or 1
+
+
+class SharedMemoryStore:
+    def __init__(self, path, max_entries=10000, ttl=30, slot_size=512, ways=8,
+                 dumps=encode_value, loads=decode_value):
+        """slot_size is bytes per entry including a 32-byte header, the key and the value."""
+        self.path = path
+        self.ttl = ttl
+        self.ways = ways
+        self.sets = max(1, -(-max_entries // ways))
+        self.slot_size = slot_size
+        self.set_size = slot_size * ways
+        self.size = _DATA_OFFSET + self.set_size * self.sets
+        self.dumps = dumps
+        self.loads = loads
+        self._locks = [threading.Lock() for _ in range(_STRIPES)]
+        self._open_lock = threading.Lock()
+        self._pid = None
+        self._fd = None
+        self._map = None
+        self.hits = 0
+        self.misses = 0
+        self.sets_written = 0
+        self.evictions = 0
+        self.too_large = 0
+        self.retries = 0
+        self.errors = 0
+
+    def _mapping(self):
+        # Re-open after fork so each process has its own fd for fcntl locking
+        if self._pid == os.getpid():
+            return self._map
+        with self._open_lock:
+            if self._pid != os.getpid():
+                fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o600)
+                fcntl.lockf(fd, fcntl.LOCK_EX, _DATA_OFFSET, 0)
+                try:
+                    # Never shrink: another process may still map the old size
+                    if os.fstat(fd).st_size < self.size:
+                        os.ftruncate(fd, self.size)
+                    buf = mmap.mmap(fd, self.size, mmap.MAP_SHARED)
+                    header = _FILE_HEADER.pack(_MAGIC, _VERSION, self.sets, self.ways, self.slot_size)
+                    if buf[:_FILE_HEADER.size] != header:
+                        # New file or a different layout: start empty
+                        buf[_DATA_OFFSET:self.size] = bytes(self.size - _DATA_OFFSET)
+                        buf[:_FILE_HEADER.size] = header
+                finally:
+                    fcntl.lockf(fd, fcntl.LOCK_UN, _DATA_OFFSET, 0)
+                self._map = buf
+                self._fd = fd
+                self._pid = os.getpid()
+        return self._map
+
+    def _locate(self, key):
+        raw_key = key.encode("utf-8")
+        key_hash = _hash(raw_key)
+        index = key_hash % self.sets
+        return raw_key, key_hash, index, _DATA_OFFSET + index * self.set_size
+
+    def get(self, key):
+        """The value, or None if missing or expired. Takes no lock."""
+        buf = self._mapping()
+        raw_key, key_hash, _, base = self._locate(key)
+        for _ in range(_READ_RETRIES):
+            found = self._read(buf, base, key_hash)
+            if found is not None:
+                break
+            self.retries += 1
+            # Let the writer finish rather than spinning against it
+            time.sleep(0)
+        else:
+            found = _ABSENT
+
+        offset, expires_at, used_at, payload = found
+        now = time.time()
+        value = None
+        if payload is not None and expires_at > now:
+            key_len = _KEY_LEN.unpack_from(payload)[0]
+            if payload[2:2 + key_len] == raw_key:
+                try:
+                    value = self.loads(payload[2 + key_len:])
+                except Exception:
+                    self.errors += 1
+        if value is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        if now - used_at > TOUCH_INTERVAL:
+            # Unlocked on purpose: racing a writer only skews the LRU order
+            _USED.pack_into(buf, offset + 24, now)
+        return value
+
+    def _read(self, buf, base, key_hash):
+        """(offset, expires_at, used_at, payload) for key_hash, _ABSENT if
+        it isn't in the set, or None if a writer got in the way."""
+        for way in range(self.ways):
+            offset = base + way * self.slot_size
+            if _HASH.unpack_from(buf, offset)[0] != key_hash:
+                continue
+            slot_hash, seq, length, expires_at, used_at = _SLOT.unpack_from(buf, offset)
+            if slot_hash != key_hash or seq & 1:
+                return None
+            payload = buf[offset + _SLOT.size:offset + _SLOT.size + length]
+            if _SEQ.unpack_from(buf, offset + 8)[0] != seq or _HASH.unpack_from(buf, offset)[0] != key_hash:
+                return None
+            return offset, expires_at, used_at, payload
+        return _ABSENT
+
+    def set(self, key, value, ttl=None):
+        """Store value; False if it doesn't fit in a slot."""
+        buf = self._mapping()
+        raw_key, key_hash, index, base = self._locate(key)
+        payload = _KEY_LEN.pack(len(raw_key)) + raw_key + self.dumps(value)
+        if _SLOT.size + len(payload) > self.slot_size:
+            self.too_large += 1
+            return False
+        now = time.time()
+        expires_at = now + (self.ttl if ttl is None else ttl)
+
+        with self._locks[index % _STRIPES]:
+            fcntl.lockf(self._fd, fcntl.LOCK_EX, self.set_size, base)
+            try:
+                offset = self._victim(buf, base, key_hash, now)
+                self._write(buf, offset, key_hash, payload, expires_at, now)
+            finally:
+                fcntl.lockf(self._fd, fcntl.LOCK_UN, self.set_size, base)
+        self.sets_written += 1
+        return True
+
+    def _victim(self, buf, base, key_hash, now):
+        # Caller holds the set lock
+        best_offset, best_rank = base, None
+        for way in range(self.ways):
+            offset = base + way * self.slot_size
+            slot_hash, _, _, expires_at, used_at = _SLOT.unpack_from(buf, offset)
+            if slot_hash == key_hash:
+                return offset
+            # Empty, then expired, then least recently used
+            rank = (0, 0) if slot_hash == 0 else (1, 0) if expires_at <= now else (2, used_at)
+            if best_rank is None or rank < best_rank:
+                best_offset, best_rank = offset, rank
+        if best_rank[0] == 2:
+            self.evictions += 1
+        return best_offset
+
+    def _write(self, buf, offset, key_hash, payload, expires_at, now):
+        seq = _SEQ.unpack_from(buf, offset + 8)[0]
+        _SEQ.pack_into(buf, offset + 8, (seq + 1) & 0xFFFFFFFF)
+        buf[offset + _SLOT.size:offset + _SLOT.size + len(payload)] = payload
+        _HASH.pack_into(buf, offset, key_hash)
+        _LENGTH.pack_into(buf, offset + 12, len(payload))
+        _TIMES.pack_into(buf, offset + 16, expires_at, now)
+        _SEQ.pack_into(buf, offset + 8, (seq + 2) & 0xFFFFFFFF)
+
+    def delete(self, key):
+        buf = self._mapping()
+        _, key_hash, index, base = self._locate(key)
+        with self._locks[index % _STRIPES]:
+            fcntl.lockf(self._fd, fcntl.LOCK_EX, self.set_size, base)
+            try:
+                for way in range(self.ways):
+                    offset = base + way * self.slot_size
+                    if _HASH.unpack_from(buf, offset)[0] == key_hash:
+                        seq = _SEQ.unpack_from(buf, offset + 8)[0]
+                        _SEQ.pack_into(buf, offset + 8, (seq + 1) & 0xFFFFFFFF)
+                        _HASH.pack_into(buf, offset, 0)
+                        _SEQ.pack_into(buf, offset + 8, (seq + 2) & 0xFFFFFFFF)
+            finally:
+                fcntl.lockf(self._fd, fcntl.LOCK_UN, self.set_size, base)
+
+    def clear(self):
+        buf = self._mapping()
+        fcntl.lockf(self._fd, fcntl.LOCK_EX, self.size - _DATA_OFFSET, _DATA_OFFSET)
+        try:
+            for index in range(self.sets):
+                base = _DATA_OFFSET + index * self.set_size
+                for way in range(self.ways):
+                    _HASH.pack_into(buf, base + way * self.slot_size, 0)
+        finally:
+            fcntl.lockf(self._fd, fcntl.LOCK_UN, self.size - _DATA_OFFSET, _DATA_OFFSET)
+
+    def stats(self):
+        return {"backend": "shared", "hits": self.hits, "misses": self.misses,
+                "sets": self.sets_written, "evictions": self.evictions, "too_large": self.too_large,
+                "read_retries": self.retries, "errors": self.errors,
+                "capacity": self.sets * self.ways, "slot_size": self.slot_size}
@@ -0,0 +1,52 @@
+"""Upstream SDK clients built on first use.
+
+Importing openai, stripe and supabase and constructing their clients
+costs a noticeable share of a worker's boot time and memory, and workers
+that only render pages never need them. A LazyClient wraps the factory
+that imports and builds one; attribute access builds it once per process
+(under a lock, so concurrent request threads share one instance) and
+then delegates. Anything built in a `--preload` master is discarded in
+the forked worker, which gets its own connection pools.
+"""
+import os
+import threading
+
+_UNSET = object()
+
+
+class LazyClient:
+    def __init__(self, factory, name=None):
+        self._factory = factory
+        self._name = name or getattr(factory, "__name__", "client")
+        self._lock = threading.Lock()
+        self._pid = None
+        self._value = _UNSET
+
+    def get(self):
+        """Return this process's client, building it if needed. May be None."""
+        if self._pid == os.getpid():
+            return self._value
+        with self._lock:
+            if self._pid != os.getpid():
+                self._value = self._factory()
+                self._pid = os.getpid()
+        return self._value
+
+    @property
+    def loaded(self):
+        return self._pid == os.getpid()
+
+    def __getattr__(self, attr):
+        if attr.startswith("_"):
+            raise AttributeError(attr)
+        value = self.get()
+        if value is None:
+            raise RuntimeError(f"{self._name} is not available")
+        return getattr(value, attr)
+
+    def __bool__(self):
+        return self.get() is not None
+
+    def __repr__(self):
+        state = "loaded" if self.loaded else "not loaded"
+        return f"<LazyClient {self._name} ({state})>"
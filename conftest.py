@@ -0,0 +1,47 @@
+"""Point app.py at throwaway local state before any test imports it."""
+import os
+import tempfile
+import uuid
+
+import jwt
+import pytest
+
+_state_dir = tempfile.mkdtemp(prefix="aiassistantpros-tests-")
+
+os.environ["DATABASE_URL"] = f"sqlite:///{os.path.join(_state_dir, 'app.db')}"
+os.environ["OUTBOX_PATH"] = os.path.join(_state_dir, "outbox.db")
+os.environ["OPENAI_API_KEY"] = "sk-test"
+os.environ["SECRET_KEY"] = "test-secret-key-0000000000000000000000"
+os.environ["STRIPE_WEBHOOK_SECRET"] = "whsec_test"
+os.environ["STRIPE_PRICE_ID"] = "price_pro"
+os.environ["STRIPE_PRICE_TIERS"] = "price_agency:agency"
+os.environ["RATE_LIMIT_PATH"] = os.path.join(_state_dir, "ratelimit.bin")
+os.environ["IDEMPOTENCY_PATH"] = os.path.join(_state_dir, "idempotency.db")
+os.environ["SHARED_CACHE_DIR"] = _state_dir
+# Test clients connect directly, so per-IP limits apply to REMOTE_ADDR
+os.environ["TRUSTED_PROXIES"] = "0"
+# Every test client shares 127.0.0.1; refill its /generate bucket at once
+os.environ["RATE_LIMIT_IP_GENERATE"] = "60000"
+
+# Deploys run `python db.py migrate`; the app no longer touches the schema at import
+import db  # noqa: E402
+
+db.migrate()
+
+
+@pytest.fixture
+def make_user():
+    """make_user(tier="pro", **columns) adds a User row and returns
+    (user_id, email, headers), headers carrying a bearer token for it."""
+    import app as app_module
+    from db import User
+
+    def make(tier="pro", **columns):
+        user_id = str(uuid.uuid4())
+        email = f"{user_id}@example.com"
+        with app_module.SessionLocal() as session:
+            session.add(User(id=user_id, email=email, tier=tier, **{"used": 0, **columns}))
+            session.commit()
+        token = jwt.encode({"sub": user_id, "email": email}, app_module.app.secret_key, algorithm="HS256")
+        return user_id, email, {"Authorization": f"Bearer {token}"}
+    return make
@@ -0,0 +1,208 @@
+"""SQLAlchemy session factory and models.
+
+DATABASE_URL points at the same Postgres that backs the Supabase `users`
+table. Only local development (APP_ENV=development or FLASK_DEBUG) may
+leave it unset and fall back to a SQLite file; anywhere else the app
+refuses to start, since profiles would go to Supabase while usage,
+tiers and history went to a local file lost on every restart.
+
+Schema changes are not made at import, where every worker would race to
+apply them: run `python db.py migrate` once per deploy (Render's
+pre-deploy command) to create missing tables and columns and the search
+index.
+"""
+import argparse
+import logging
+import os
+
+from sqlalchemy import (BigInteger, Column, Date, DateTime, Index, Integer, LargeBinary, String, Text,
+                        bindparam, case, create_engine, func, inspect, select, text, update)
+from sqlalchemy.orm import declarative_base, sessionmaker
+from sqlalchemy.schema import CreateColumn
+from dotenv import load_dotenv
+
+# Imported before app.py loads .env, and by the command line tools
+load_dotenv()
+
+logger = logging.getLogger(__name__)
+
+DATABASE_URL = os.getenv("DATABASE_URL")
+if not DATABASE_URL:
+    local_dev = (os.getenv("APP_ENV", "").lower() == "development"
+                 or os.getenv("FLASK_DEBUG", "").lower() in ("1", "true", "yes"))
+    if not local_dev:
+        raise RuntimeError("DATABASE_URL is not set. Point it at the Supabase Postgres connection string "
+                           "(or set APP_ENV=development to use a local SQLite file).")
+    logger.warning("DATABASE_URL is not set; using the local SQLite file app.db (development only)")
+    DATABASE_URL = "sqlite:///app.db"
+
+# Render/Heroku style URLs use the old scheme name
+if DATABASE_URL.startswith("postgres://"):
+    DATABASE_URL = "postgresql://" + DATABASE_URL[len("postgres://"):]
+
+_connect_args = {}
+if DATABASE_URL.startswith("sqlite"):
+    _connect_args["check_same_thread"] = False
+
+engine = create_engine(DATABASE_URL, pool_pre_ping=True, connect_args=_connect_args)
+SessionLocal = sessionmaker(bind=engine)
+Base = declarative_base()
+
+
+class User(Base):
+    __tablename__ = "users"
+
+    id = Column(String, primary_key=True)
+    email = Column(String, unique=True, index=True, nullable=False)
+    tier = Column(String, nullable=False, default="free", server_default="free")
+    used = Column(Integer, nullable=False, default=0, server_default="0")
+    # Prompt + completion tokens across all generations
+    tokens_used = Column(Integer, nullable=False, default=0, server_default="0")
+    trial_ends_at = Column(DateTime(timezone=True))
+    stripe_customer_id = Column(String, index=True)
+    # `created` of the last Stripe event applied, to ignore stale redeliveries
+    stripe_event_at = Column(Integer)
+    created_at = Column(DateTime(timezone=True), server_default=func.now())
+
+
+class Generation(Base):
+    """A saved /generate result (tiers with can_save). See history.py."""
+    __tablename__ = "generations"
+
+    # Integer rowid doubles as the full-text index key; `key` is the public id
+    id = Column(BigInteger().with_variant(Integer, "sqlite"), primary_key=True, autoincrement=True)
+    key = Column(String, unique=True, nullable=False)
+    user_id = Column(String, nullable=False)
+    created_at = Column(DateTime(timezone=True), nullable=False)
+    model = Column(String)
+    prompt = Column(Text, nullable=False)
+    # zlib-compressed UTF-8
+    output = Column(LargeBinary, nullable=False)
+    prompt_tokens = Column(Integer, nullable=False, default=0)
+    completion_tokens = Column(Integer, nullable=False, default=0)
+
+    __table_args__ = (
+        # Keyset pagination: newest first per user
+        Index("generations_user_created", "user_id", "created_at", "id"),
+    )
+
+
+class BatchJob(Base):
+    """An async /generate-batch run; results are zlib-compressed NDJSON."""
+    __tablename__ = "batch_jobs"
+
+    id = Column(String, primary_key=True)
+    user_id = Column(String, nullable=False, index=True)
+    status = Column(String, nullable=False)
+    total = Column(Integer, nullable=False)
+    succeeded = Column(Integer, nullable=False, default=0)
+    failed = Column(Integer, nullable=False, default=0)
+    results = Column(LargeBinary)
+    created_at = Column(DateTime(timezone=True), nullable=False)
+    # Heartbeat while running
+    updated_at = Column(DateTime(timezone=True), nullable=False)
+
+
+
+class UsageRollup(Base):
+    """One per-day, per-tier counter maintained by analytics.py."""
+    __tablename__ = "usage_rollups"
+
+    day = Column(Date, primary_key=True)
+    tier = Column(String, primary_key=True)
+    metric = Column(String, primary_key=True)
+    value = Column(BigInteger().with_variant(Integer, "sqlite"), nullable=False, default=0)
+
+    __table_args__ = (
+        # Current users per tier sums one metric across every day
+        Index("usage_rollups_metric", "metric", "tier"),
+    )
+
+def init_db():
+    """Create any missing tables and add columns newer than an existing table."""
+    Base.metadata.create_all(engine)
+    inspector = inspect(engine)
+    for table in Base.metadata.sorted_tables:
+        existing = {c["name"] for c in inspector.get_columns(table.name)}
+        missing = [c for c in table.columns if c.name not in existing]
+        if not missing:
+            continue
+        with engine.begin() as conn:
+            for column in missing:
+                if isinstance(getattr(column.server_default, "arg", None), str):
+                    # The literal default backfills existing rows
+                    spec = CreateColumn(column).compile(dialect=engine.dialect)
+                else:
+                    # SQLite can't add a column defaulting to now(); leave it NULL
+                    spec = f"{column.name} {column.type.compile(engine.dialect)}"
+                conn.execute(text(f"ALTER TABLE {table.name} ADD COLUMN {spec}"))
+
+
+def apply_usage(batch, bind=None):
+    """Apply aggregated increments {email: {"used": n, "tokens_used": t}} in one transaction."""
+    table = User.__table__
+    stmt = (
+        update(table)
+        .where(table.c.email == bindparam("b_email"))
+        .values(used=func.coalesce(table.c.used, 0) + bindparam("b_used"),
+                tokens_used=func.coalesce(table.c.tokens_used, 0) + bindparam("b_tokens"))
+    )
+    params = [
+        {"b_email": email, "b_used": counts.get("used", 0), "b_tokens": counts.get("tokens_used", 0)}
+        for email, counts in batch.items()
+    ]
+    with (bind or engine).begin() as conn:
+        conn.execute(stmt, params)
+
+
+def reserve_usage(email, n, limit, bind=None):
+    """Add n to a user's `used` if it stays within limit. Returns the new
+    count, or None if it would not (or there is no such user)."""
+    table = User.__table__
+    stmt = (
+        update(table)
+        .where(table.c.email == email, func.coalesce(table.c.used, 0) + n <= limit)
+        .values(used=func.coalesce(table.c.used, 0) + n)
+        .returning(table.c.used)
+    )
+    with (bind or engine).begin() as conn:
+        return conn.execute(stmt).scalar_one_or_none()
+
+
+def refund_usage(email, n=1, bind=None):
+    """Give back n reserved uses, never going below zero."""
+    table = User.__table__
+    stmt = (
+        update(table)
+        .where(table.c.email == email)
+        .values(used=case((func.coalesce(table.c.used, 0) > n, table.c.used - n), else_=0))
+    )
+    with (bind or engine).begin() as conn:
+        conn.execute(stmt)
+
+
+def current_usage(email, bind=None):
+    table = User.__table__
+    with (bind or engine).connect() as conn:
+        return conn.execute(select(table.c.used).where(table.c.email == email)).scalar() or 0
+
+
+def migrate():
+    """Bring the schema up to date: tables, newer columns and the search index."""
+    from history import init_search
+    init_db()
+    init_search(engine)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Manage the app's database schema.")
+    commands = parser.add_subparsers(dest="command", required=True)
+    commands.add_parser("migrate", help="Create missing tables, columns and indexes")
+    parser.parse_args()
+
+    migrate()
+    print(f"Schema is up to date on {engine.url.render_as_string(hide_password=True)}")
+
+
+if __name__ == "__main__":
+    main()
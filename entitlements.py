@@ -0,0 +1,116 @@
+"""Cached user entitlements (tier, usage, trial) keyed by JWT subject.
+
+Every authenticated request needs the caller's tier and usage. Looking
+them up costs a database round trip, so resolved entitlements are kept in
+a bounded TTL cache. Writers that change usage or tier must call put() or
+invalidate() so readers never see a stale value. With the default
+per-process store that only holds on the writer's worker and the others
+converge within the TTL; with a SharedMemoryStore every worker on the
+host sees the change at once.
+"""
+import struct
+from collections import namedtuple
+from datetime import datetime, timezone
+
+from cachestore import LocalStore
+
+
+def _now_like(moment):
+    # Compare naive with naive (utc) and aware with aware
+    if moment.tzinfo is None:
+        return datetime.utcnow()
+    return datetime.now(timezone.utc)
+
+
+def parse_timestamp(value):
+    """Accept a datetime, an ISO string or None."""
+    if value is None or isinstance(value, datetime):
+        return value
+    try:
+        return datetime.fromisoformat(str(value).replace("Z", "+00:00"))
+    except ValueError:
+        return None
+
+
+class Entitlement(namedtuple("Entitlement", "subject id email tier used trial_ends_at")):
+    __slots__ = ()
+
+    def trial_active(self):
+        if not self.trial_ends_at:
+            return False
+        return _now_like(self.trial_ends_at) < self.trial_ends_at
+
+    def trial_days_left(self):
+        if not self.trial_ends_at:
+            return None
+        days_left = (self.trial_ends_at - _now_like(self.trial_ends_at)).days
+        return max(0, days_left + 1)
+
+
+# used, trial_ends_at (epoch seconds), flags; then subject, id, email and
+# tier as UTF-8 separated by NULs, with a flag bit for each one that is None
+_PACKED = struct.Struct("<qdB")
+_HAS_TRIAL, _AWARE = 1, 2
+_NONE_BITS = (4, 8, 16, 32)
+_ANY_NONE = sum(_NONE_BITS)
+
+
+def encode_entitlement(entitlement):
+    """Compact binary form for a SharedMemoryStore (see cachestore.py)."""
+    flags, timestamp = 0, 0.0
+    trial_ends_at = entitlement.trial_ends_at
+    if trial_ends_at is not None:
+        flags = _HAS_TRIAL | (_AWARE if trial_ends_at.tzinfo else 0)
+        # Naive timestamps are UTC
+        timestamp = (trial_ends_at if trial_ends_at.tzinfo else trial_ends_at.replace(tzinfo=timezone.utc)).timestamp()
+    for bit, value in zip(_NONE_BITS, entitlement[:4]):
+        if value is None:
+            flags |= bit
+    text = "\0".join(value or "" for value in entitlement[:4])
+    return _PACKED.pack(entitlement.used or 0, timestamp, flags) + text.encode("utf-8")
+
+
+def decode_entitlement(blob):
+    used, timestamp, flags = _PACKED.unpack_from(blob)
+    fields = str(blob[_PACKED.size:], "utf-8").split("\0")
+    if flags & _ANY_NONE:
+        fields = [None if flags & bit else value for bit, value in zip(_NONE_BITS, fields)]
+    trial_ends_at = None
+    if flags & _HAS_TRIAL:
+        trial_ends_at = datetime.fromtimestamp(timestamp, timezone.utc)
+        if not flags & _AWARE:
+            trial_ends_at = trial_ends_at.replace(tzinfo=None)
+    return Entitlement(*fields, used, trial_ends_at)
+
+
+class EntitlementCache:
+    def __init__(self, max_entries=10000, ttl=30, store=None):
+        """store is a cachestore store; a per-process LocalStore by default."""
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.store = store or LocalStore(max_entries, ttl)
+
+    def get(self, subject, loader):
+        """Return the cached entitlement, calling loader() on a miss.
+
+        A loader returning None is not cached so a user created moments
+        later is picked up on the next request.
+        """
+        entitlement = self.store.get(subject)
+        if entitlement is not None:
+            return entitlement
+        entitlement = loader()
+        if entitlement is not None:
+            self.put(entitlement)
+        return entitlement
+
+    def put(self, entitlement):
+        self.store.set(entitlement.subject, entitlement)
+
+    def invalidate(self, subject):
+        self.store.delete(subject)
+
+    def stats(self):
+        stats = self.store.stats()
+        return {"hits": stats["hits"], "misses": stats["misses"], "entries": stats.get("entries"),
+                "backend": stats["backend"]}
@@ -0,0 +1,36 @@
+# Gunicorn settings for Render (Procfile: gunicorn -c gunicorn.conf.py app:app)
+import glob
+import os
+import tempfile
+
+bind = f"0.0.0.0:{os.getenv('PORT', '5000')}"
+workers = int(os.getenv("WEB_CONCURRENCY", 2))
+
+# OpenAI calls can take well over gunicorn's 30s default
+timeout = int(os.getenv("GUNICORN_TIMEOUT", 120))
+graceful_timeout = 30
+keepalive = 5
+
+if os.getenv("ASYNC_MODE", "").lower() in ("1", "true", "yes"):
+    # Request threads only wait on the shared event loop (async_runtime.py),
+    # so each process can park hundreds of them cheaply.
+    worker_class = "gthread"
+    threads = int(os.getenv("GUNICORN_THREADS", 256))
+else:
+    worker_class = os.getenv("GUNICORN_WORKER_CLASS", "sync")
+    threads = int(os.getenv("GUNICORN_THREADS", 1))
+
+
+def on_starting(server):
+    # Shared directory where each worker drops its metrics snapshot (metrics.py).
+    # Workers inherit the variable; stale snapshots from a previous run are
+    # cleared. The directory may be shared with other state (e.g. /tmp), so
+    # only metrics files are removed, never the directory itself.
+    metrics_dir = os.environ.setdefault(
+        "METRICS_DIR", os.path.join(tempfile.gettempdir(), f"aiassistantpros-metrics-{os.getpid()}"))
+    os.makedirs(metrics_dir, exist_ok=True)
+    for path in glob.glob(os.path.join(metrics_dir, "metrics-*.json*")):
+        try:
+            os.remove(path)
+        except OSError:
+            pass
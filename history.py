@@ -0,0 +1,142 @@
+"""Saved generations: compressed storage, keyset pagination and full-text search.
+
+Rows are written in batches by the outbox worker (kind "generation"), never
+on the request thread. Outputs are stored zlib-compressed. Listing walks
+the (user_id, created_at, id) index from a cursor instead of OFFSET, so
+page N costs the same as page 1 however much a user has saved.
+
+Search uses the database's own full-text index: a tsvector column with a
+GIN index on Postgres, or a contentless FTS5 table on SQLite. Neither
+keeps a second copy of the text. Both are fed from the uncompressed text
+at insert time.
+"""
+import base64
+import json
+import re
+import zlib
+from datetime import datetime
+
+from sqlalchemy import select, text, tuple_
+
+from db import Generation
+
+_WORD = re.compile(r"\w+", re.UNICODE)
+
+
+def compress_output(output):
+    return zlib.compress(output.encode("utf-8"), 6)
+
+
+def decompress_output(blob):
+    return zlib.decompress(blob).decode("utf-8")
+
+
+def encode_cursor(created_at, row_id):
+    raw = json.dumps([created_at.isoformat(), row_id]).encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip("=")
+
+
+def decode_cursor(cursor):
+    """Returns (created_at, id). Raises ValueError on a malformed cursor."""
+    try:
+        raw = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4))
+        created_at, row_id = json.loads(raw)
+        return datetime.fromisoformat(created_at), int(row_id)
+    except Exception:
+        raise ValueError("Invalid cursor")
+
+
+def init_search(engine):
+    """Create the dialect's full-text index if it doesn't exist yet."""
+    with engine.begin() as conn:
+        if engine.dialect.name == "postgresql":
+            conn.execute(text("ALTER TABLE generations ADD COLUMN IF NOT EXISTS search tsvector"))
+            conn.execute(text(
+                "CREATE INDEX IF NOT EXISTS generations_search ON generations USING GIN (search)"))
+        elif engine.dialect.name == "sqlite":
+            conn.execute(text(
+                "CREATE VIRTUAL TABLE IF NOT EXISTS generations_fts "
+                "USING fts5(user_id, body, content='', tokenize='porter unicode61')"))
+
+
+def save_generations(rows, engine):
+    """Insert generation payloads (as queued by app.py) and index them.
+
+    Keys already stored are skipped, so a retried batch is harmless.
+    """
+    with engine.begin() as conn:
+        keys = [row["key"] for row in rows]
+        existing = set(conn.execute(
+            select(Generation.key).where(Generation.key.in_(keys))).scalars())
+        new = [row for row in rows if row["key"] not in existing]
+        if not new:
+            return 0
+        conn.execute(Generation.__table__.insert(), [{
+            "key": row["key"],
+            "user_id": row["user_id"],
+            "created_at": datetime.fromisoformat(row["created_at"]),
+            "model": row.get("model"),
+            "prompt": row["prompt"],
+            "output": compress_output(row["output"]),
+            "prompt_tokens": row.get("prompt_tokens", 0),
+            "completion_tokens": row.get("completion_tokens", 0)
+        } for row in new])
+
+        ids = dict(conn.execute(
+            select(Generation.key, Generation.id).where(Generation.key.in_([r["key"] for r in new]))).all())
+        index_rows = [{"id": ids[row["key"]], "user_id": row["user_id"],
+                       "body": row["prompt"] + "\n" + row["output"]} for row in new]
+        if engine.dialect.name == "postgresql":
+            conn.execute(text("UPDATE generations SET search = to_tsvector('english', :body) WHERE id = :id"),
+                         index_rows)
+        elif engine.dialect.name == "sqlite":
+            conn.execute(text("INSERT INTO generations_fts (rowid, user_id, body) VALUES (:id, :user_id, :body)"),
+                         index_rows)
+    return len(new)
+
+
+def _fts5_query(user_id, query):
+    # Quote every word so user input can't use FTS5 operators; words are ANDed
+    words = " ".join(f'"{w}"' for w in _WORD.findall(query))
+    return f'user_id : "{user_id}" AND body : ({words})'
+
+
+def list_generations(engine, user_id, limit=20, cursor=None, query=None):
+    """One page of a user's generations, newest first.
+
+    Returns (items, next_cursor); next_cursor is None on the last page.
+    With query, only generations whose prompt or output match are listed.
+    """
+    stmt = select(Generation).where(Generation.user_id == user_id)
+    if cursor:
+        created_at, row_id = decode_cursor(cursor)
+        stmt = stmt.where(tuple_(Generation.created_at, Generation.id) < tuple_(created_at, row_id))
+
+    if query:
+        if not _WORD.search(query):
+            return [], None
+        if engine.dialect.name == "postgresql":
+            stmt = stmt.where(text("search @@ plainto_tsquery('english', :q)")).params(q=query)
+        else:
+            stmt = stmt.where(Generation.id.in_(
+                select(text("rowid")).select_from(text("generations_fts"))
+                .where(text("generations_fts MATCH :q")))).params(q=_fts5_query(user_id, query))
+
+    stmt = stmt.order_by(Generation.created_at.desc(), Generation.id.desc()).limit(limit + 1)
+    with engine.connect() as conn:
+        rows = conn.execute(stmt).all()
+
+    items = [{
+        "id": row.key,
+        "created_at": row.created_at.isoformat(),
+        "model": row.model,
+        "prompt": row.prompt,
+        "output": decompress_output(row.output),
+        "prompt_tokens": row.prompt_tokens,
+        "completion_tokens": row.completion_tokens
+    } for row in rows[:limit]]
+    next_cursor = None
+    if len(rows) > limit:
+        last = rows[limit - 1]
+        next_cursor = encode_cursor(last.created_at, last.id)
+    return items, next_cursor
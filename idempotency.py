@@ -0,0 +1,238 @@
+"""Idempotency keys: run a request once, replay it for retries.
+
+Records live in a SQLite file shared by every worker on the host (like
+the outbox), keyed by a hash of (scope, owner, client key). A request
+that claims a new key runs normally. A duplicate that arrives while the
+original is running waits for it and gets its response: a same-process
+duplicate is woken by an Event, one in another worker polls with plain
+reads and only takes the write lock once the claim is gone or expired. A
+duplicate of a finished request gets the stored response straight away.
+
+Only successful (2xx/3xx) responses are stored; anything else releases
+the key so the client's retry runs for real. A running claim expires
+after `lease` seconds, so a worker that dies mid-request doesn't block
+the key forever. Finished records are kept for `ttl` seconds, and the
+table is trimmed to `max_entries` by a background thread in each worker,
+in small batches so no request waits behind a long write lock.
+"""
+import hashlib
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS idempotency (
+    key TEXT PRIMARY KEY,
+    fingerprint TEXT NOT NULL,
+    state TEXT NOT NULL,
+    status INTEGER,
+    headers TEXT,
+    body BLOB,
+    created_at REAL NOT NULL,
+    expires_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idempotency_expires ON idempotency (expires_at);
+CREATE INDEX IF NOT EXISTS idempotency_created ON idempotency (created_at);
+CREATE INDEX IF NOT EXISTS idempotency_state ON idempotency (state);
+"""
+
+logger = logging.getLogger(__name__)
+
+NEW, REPLAY, RUNNING, MISMATCH = "new", "replay", "running", "mismatch"
+
+
+def record_key(scope, owner, client_key):
+    return hashlib.sha256(f"{scope}\0{owner}\0{client_key}".encode()).hexdigest()
+
+
+def fingerprint(*parts):
+    digest = hashlib.sha256()
+    for part in parts:
+        digest.update(part if isinstance(part, bytes) else str(part).encode())
+        digest.update(b"\0")
+    return digest.hexdigest()
+
+
+class StoredResponse:
+    __slots__ = ("status", "headers", "body")
+
+    def __init__(self, status, headers, body):
+        self.status = status
+        self.headers = headers
+        self.body = body
+
+
+class IdempotencyStore:
+    def __init__(self, path, ttl=24 * 3600, lease=120.0, max_entries=100000,
+                 poll_interval=0.05, prune_interval=60.0, prune_batch=1000):
+        self.path = path
+        self.ttl = ttl
+        self.lease = lease
+        self.max_entries = max_entries
+        self.poll_interval = poll_interval
+        self.prune_interval = prune_interval
+        self.prune_batch = prune_batch
+        self.replayed = 0
+        self.joined = 0
+        self._initialized = False
+        self._events = {}  # key -> Event for claims running in this process
+        self._lock = threading.Lock()
+        self._pid = None
+        self._done = 0  # finished records as of the last prune
+
+    def _connect(self):
+        conn = sqlite3.connect(self.path, timeout=10, isolation_level=None)
+        if not self._initialized:
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.executescript(SCHEMA)
+            self._initialized = True
+        return conn
+
+    def begin(self, key, request_fingerprint):
+        """Claim key. Returns (NEW, None), (REPLAY, StoredResponse),
+        (RUNNING, None) or (MISMATCH, None) if the key was used for a
+        different request."""
+        self._ensure_pruner()
+        now = time.time()
+        conn = self._connect()
+        try:
+            conn.execute("BEGIN IMMEDIATE")
+            row = self._select(conn, key)
+            if row is None or row[5] <= now:
+                # New, or a finished record past its TTL, or an abandoned claim
+                conn.execute(
+                    "INSERT OR REPLACE INTO idempotency (key, fingerprint, state, created_at, expires_at) "
+                    "VALUES (?, ?, 'running', ?, ?)", (key, request_fingerprint, now, now + self.lease))
+                conn.execute("COMMIT")
+                with self._lock:
+                    self._events[key] = threading.Event()
+                return NEW, None
+            conn.execute("COMMIT")
+        except Exception:
+            if conn.in_transaction:
+                conn.execute("ROLLBACK")
+            raise
+        finally:
+            conn.close()
+        return self._existing(row, request_fingerprint)
+
+    def _select(self, conn, key):
+        return conn.execute(
+            "SELECT fingerprint, state, status, headers, body, expires_at FROM idempotency WHERE key = ?",
+            (key,)).fetchone()
+
+    def _existing(self, row, request_fingerprint):
+        if row[0] != request_fingerprint:
+            return MISMATCH, None
+        if row[1] == "done":
+            self.replayed += 1
+            return REPLAY, StoredResponse(row[2], json.loads(row[3]), row[4])
+        return RUNNING, None
+
+    def wait(self, key, request_fingerprint, timeout):
+        """Wait for a running key. Returns what begin() returns once it
+        finishes: usually (REPLAY, response), or (NEW, None) if the original
+        failed and this caller now holds the key. (RUNNING, None) on timeout."""
+        self.joined += 1
+        deadline = time.monotonic() + timeout
+        while True:
+            with self._lock:
+                event = self._events.get(key)
+            if event is not None:
+                # Same process: woken as soon as the original finishes
+                event.wait(max(0.0, deadline - time.monotonic()))
+            else:
+                time.sleep(self.poll_interval)
+            conn = self._connect()
+            try:
+                row = self._select(conn, key)
+            finally:
+                conn.close()
+            if row is None or row[5] <= time.time():
+                # Released or abandoned: race the other waiters for the claim
+                state, response = self.begin(key, request_fingerprint)
+            else:
+                state, response = self._existing(row, request_fingerprint)
+            if state != RUNNING or time.monotonic() >= deadline:
+                return state, response
+
+    def complete(self, key, status, headers, body):
+        now = time.time()
+        conn = self._connect()
+        try:
+            conn.execute(
+                "UPDATE idempotency SET state = 'done', status = ?, headers = ?, body = ?, expires_at = ? "
+                "WHERE key = ?", (status, json.dumps(headers), body, now + self.ttl, key))
+        finally:
+            conn.close()
+        self._wake(key)
+
+    def release(self, key):
+        """Forget a claim so the next request with the key runs again."""
+        conn = self._connect()
+        try:
+            conn.execute("DELETE FROM idempotency WHERE key = ? AND state = 'running'", (key,))
+        finally:
+            conn.close()
+        self._wake(key)
+
+    def _wake(self, key):
+        with self._lock:
+            event = self._events.pop(key, None)
+        if event is not None:
+            event.set()
+
+    def _ensure_pruner(self):
+        """Start this process's prune thread (once per pid, so safe across forks)."""
+        if self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self._pid = os.getpid()
+            threading.Thread(target=self._run_pruner, name="idempotency-pruner", daemon=True).start()
+
+    def _run_pruner(self):
+        while True:
+            try:
+                self.prune()
+            except Exception:
+                logger.exception("Idempotency prune failed")
+            time.sleep(self.prune_interval)
+
+    def prune(self):
+        """Drop expired records, then the oldest beyond max_entries, a batch at a time."""
+        conn = self._connect()
+        try:
+            now = time.time()
+            while conn.execute(
+                    "DELETE FROM idempotency WHERE key IN (SELECT key FROM idempotency "
+                    "WHERE expires_at <= ? LIMIT ?)", (now, self.prune_batch)).rowcount:
+                pass
+            # Both lookups walk the created_at index instead of sorting the table
+            cutoff = conn.execute(
+                "SELECT created_at FROM idempotency ORDER BY created_at DESC LIMIT 1 OFFSET ?",
+                (self.max_entries,)).fetchone()
+            if cutoff is not None:
+                while conn.execute(
+                        "DELETE FROM idempotency WHERE key IN (SELECT key FROM idempotency "
+                        "WHERE created_at <= ? ORDER BY created_at LIMIT ?)",
+                        (cutoff[0], self.prune_batch)).rowcount:
+                    pass
+            self._done = conn.execute("SELECT COUNT(*) FROM idempotency WHERE state = 'done'").fetchone()[0]
+        finally:
+            conn.close()
+
+    def stats(self):
+        """Running claims are counted through the state index. The done count
+        is the one the last prune took, so sampling this stays cheap."""
+        conn = self._connect()
+        try:
+            running = conn.execute("SELECT COUNT(*) FROM idempotency WHERE state = 'running'").fetchone()[0]
+        finally:
+            conn.close()
+        return {"running": running, "done": self._done,
+                "replayed": self.replayed, "joined": self.joined}
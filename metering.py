@@ -0,0 +1,116 @@
+"""Usage metering: atomic reserve/commit enforcement plus write-behind persistence.
+
+UsageMeter decides whether a request may run. A reservation is one
+conditional UPDATE on the user's row (used = used + n, only while that
+stays within the limit), so every gunicorn worker, on every host, counts
+against the same number and two concurrent requests can never both take
+the last unit. A failed upstream call refunds its reservation with a
+decrement. There is no per-process counter to drift from the database:
+lowering `used` there takes effect on the next request.
+
+WriteBehindBuffer takes committed increments off the request path (the
+tokens a generation used, which nothing enforces on). They are
+aggregated per key and handed to a flush function in one batch, either
+every `interval` seconds or as soon as `max_pending` increments have
+piled up. Because the flush applies increments (tokens_used =
+tokens_used + n) rather than writing absolute values, workers never
+overwrite each other.
+"""
+import atexit
+import logging
+import os
+import threading
+from collections import Counter
+
+from db import current_usage, refund_usage, reserve_usage
+
+logger = logging.getLogger(__name__)
+
+
+class UsageMeter:
+    def __init__(self, buffer, bind=None):
+        """bind is the engine holding the users table (db.engine by default)."""
+        self.buffer = buffer
+        self.bind = bind
+
+    def reserve(self, email, limit, n=1):
+        """Reserve n uses. Returns the new usage count, or None if that
+        would exceed limit (or there is no such user)."""
+        return reserve_usage(email, n, limit, self.bind)
+
+    def refund(self, email, n=1):
+        refund_usage(email, n, self.bind)
+
+    def commit(self, key, **increments):
+        """Record what a reserved use consumed (e.g. tokens_used); persisted
+        later by the buffer. The use itself was counted by reserve()."""
+        self.buffer.add(key, **increments)
+
+    def used(self, email):
+        return current_usage(email, self.bind)
+
+
+class WriteBehindBuffer:
+    def __init__(self, flush_fn, max_pending=100, interval=2.0):
+        self.flush_fn = flush_fn
+        self.max_pending = max_pending
+        self.interval = interval
+        self._pending = {}  # key -> Counter of field increments
+        self._pending_count = 0
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._flush_lock = threading.Lock()
+        self._pid = None
+        self.flushes = 0
+        self.failures = 0
+        atexit.register(self.flush)
+
+    def add(self, key, **increments):
+        self._ensure_worker()
+        with self._lock:
+            counts = self._pending.get(key)
+            if counts is None:
+                counts = self._pending[key] = Counter()
+            counts.update(increments)
+            self._pending_count += 1
+            full = self._pending_count >= self.max_pending
+        if full:
+            self._wake.set()
+
+    def flush(self):
+        """Hand everything pending to flush_fn. Failed batches are re-queued."""
+        with self._flush_lock:
+            with self._lock:
+                batch, self._pending = self._pending, {}
+                self._pending_count = 0
+            if not batch:
+                return 0
+            try:
+                self.flush_fn(batch)
+                self.flushes += 1
+                return len(batch)
+            except Exception as e:
+                self.failures += 1
+                logger.warning("Usage flush failed, will retry", extra={"error": str(e)})
+                with self._lock:
+                    for key, counts in batch.items():
+                        self._pending.setdefault(key, Counter()).update(counts)
+                        self._pending_count += 1
+                return 0
+
+    def _ensure_worker(self):
+        # One flusher thread per process; re-created after a gunicorn fork
+        if self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self._pid = os.getpid()
+            thread = threading.Thread(target=self._run, name="usage-flusher", daemon=True)
+            thread.start()
+
+    def _run(self):
+        while True:
+            self._wake.wait(self.interval)
+            self._wake.clear()
+            self.flush()
@@ -0,0 +1,295 @@
+"""Request and upstream latency metrics with a Prometheus text exporter.
+
+Recording is an in-memory bucket increment under one lock, so it is cheap
+enough for every request. To aggregate across gunicorn workers each
+process periodically writes its own snapshot to METRICS_DIR
+(metrics-<pid>-<token>.json, replaced atomically; the random token keeps
+a recycled pid from overwriting an old worker's file); a scrape on any
+worker merges every snapshot in the directory with its own live numbers.
+
+Counters and histograms from workers that have exited are kept so totals
+stay monotonic; gauges are only taken from live processes. A snapshot
+whose process is gone, or that hasn't been rewritten for `stale_after`
+seconds, is folded into metrics-retired.json and deleted, so the
+directory holds one file per live worker plus that one.
+"""
+import fcntl
+import glob
+import json
+import logging
+import os
+import threading
+import time
+import uuid
+from bisect import bisect_left
+from contextlib import contextmanager
+
+logger = logging.getLogger(__name__)
+
+RETIRED = "metrics-retired.json"
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+HELP = {
+    "http_request_duration_seconds": "Flask request latency by endpoint, method and status",
+    "upstream_request_duration_seconds": "Latency of calls to Supabase, OpenAI and Stripe"
+}
+
+
+def _key(name, labels):
+    return json.dumps([name, sorted(labels.items())])
+
+
+def _add_counts(target, snapshot):
+    """Sum a snapshot's histograms and counters into target (a snapshot)."""
+    for key, row in snapshot["histograms"].items():
+        merged = target["histograms"].setdefault(key, [0] * len(row))
+        for i, value in enumerate(row):
+            merged[i] += value
+    for key, value in snapshot["counters"].items():
+        target["counters"][key] = target["counters"].get(key, 0) + value
+
+
+def _read(path):
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def _write(path, snapshot):
+    tmp = path + ".tmp"
+    with open(tmp, "w") as f:
+        json.dump(snapshot, f)
+    os.replace(tmp, path)
+
+
+def _escape(value):
+    """A label value as Prometheus text format wants it."""
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+        return True
+    except OSError:
+        return False
+
+
+class Metrics:
+    def __init__(self, flush_interval=5.0, stale_after=None):
+        self.flush_interval = flush_interval
+        # Live workers rewrite their snapshot every flush_interval; a file this
+        # old belongs to a dead worker even if its pid has been reused
+        self.stale_after = stale_after or max(300.0, 20 * flush_interval)
+        self._histograms = {}  # key -> [bucket counts..., +Inf count, sum]
+        self._counters = {}
+        self._collectors = []
+        self._lock = threading.Lock()
+        self._pid = None
+        self._token = uuid.uuid4().hex[:12]
+
+    # --------------------
+    # RECORDING
+    # --------------------
+
+    def observe(self, name, seconds, **labels):
+        self._ensure_flusher()
+        key = _key(name, labels)
+        index = bisect_left(BUCKETS, seconds)
+        with self._lock:
+            row = self._histograms.get(key)
+            if row is None:
+                row = self._histograms[key] = [0] * (len(BUCKETS) + 2)
+            row[index] += 1
+            row[-1] += seconds
+
+    def inc(self, name, value=1, **labels):
+        self._ensure_flusher()
+        key = _key(name, labels)
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    @contextmanager
+    def upstream(self, service, operation):
+        """Time one upstream call, labelled ok/error (or the HTTP status on error)."""
+        started = time.perf_counter()
+        status = "ok"
+        try:
+            yield
+        except Exception as e:
+            status = str(getattr(e, "status_code", None) or getattr(e, "http_status", None) or "error")
+            raise
+        finally:
+            self.observe("upstream_request_duration_seconds", time.perf_counter() - started,
+                         service=service, operation=operation, status=status)
+
+    def register_collector(self, fn):
+        """fn() returns [(name, "counter"|"gauge", labels, value)] sampled at snapshot time."""
+        self._collectors.append(fn)
+
+    # --------------------
+    # CROSS-WORKER SNAPSHOTS
+    # --------------------
+
+    def _dir(self):
+        return os.getenv("METRICS_DIR")
+
+    def snapshot(self):
+        with self._lock:
+            histograms = {k: list(v) for k, v in self._histograms.items()}
+            counters = dict(self._counters)
+        gauges = {}
+        for collector in self._collectors:
+            try:
+                samples = collector()
+            except Exception:
+                continue
+            for name, kind, labels, value in samples:
+                target = counters if kind == "counter" else gauges
+                key = _key(name, labels)
+                target[key] = target.get(key, 0) + value
+        return {"pid": os.getpid(), "histograms": histograms, "counters": counters, "gauges": gauges}
+
+    def _path(self, directory):
+        return os.path.join(directory, f"metrics-{os.getpid()}-{self._token}.json")
+
+    @contextmanager
+    def _dir_lock(self, directory, exclusive):
+        """Retiring a snapshot and reading the directory exclude each other,
+        so a scrape never sees a snapshot both retired and still on disk."""
+        with open(os.path.join(directory, "metrics.lock"), "a") as f:
+            fcntl.flock(f, fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH)
+            try:
+                yield
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+    def flush(self):
+        directory = self._dir()
+        if not directory:
+            return
+        os.makedirs(directory, exist_ok=True)
+        _write(self._path(directory), self.snapshot())
+        self.retire_stale(directory)
+
+    def _is_live(self, path, snapshot):
+        try:
+            fresh = time.time() - os.path.getmtime(path) < self.stale_after
+        except OSError:
+            return False
+        pid = snapshot.get("pid")
+        return fresh and bool(pid) and _pid_alive(pid)
+
+    def retire_stale(self, directory):
+        """Fold snapshots of exited (or long silent) workers into RETIRED."""
+        own = self._path(directory)
+        with self._dir_lock(directory, exclusive=True):
+            stale = []
+            for path in glob.glob(os.path.join(directory, "metrics-*-*.json")):
+                snapshot = _read(path)
+                if path != own and snapshot is not None and not self._is_live(path, snapshot):
+                    stale.append((path, snapshot))
+            if not stale:
+                return
+            retired_path = os.path.join(directory, RETIRED)
+            retired = _read(retired_path) or {"pid": None, "histograms": {}, "counters": {}, "gauges": {}}
+            for _, snapshot in stale:
+                _add_counts(retired, snapshot)
+            _write(retired_path, retired)
+            for path, _ in stale:
+                os.remove(path)
+
+    def _ensure_flusher(self):
+        if self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self._pid = os.getpid()
+            self._token = uuid.uuid4().hex[:12]
+            # Counts inherited from a preloading parent belong to the parent
+            self._histograms = {}
+            self._counters = {}
+        if self._dir():
+            threading.Thread(target=self._run, name="metrics-flusher", daemon=True).start()
+
+    def _run(self):
+        while True:
+            time.sleep(self.flush_interval)
+            try:
+                self.flush()
+            except Exception as e:
+                logger.warning("Could not write metrics snapshot", extra={"error": str(e)})
+
+    def _all_snapshots(self):
+        own = self.snapshot()
+        snapshots = [own]
+        directory = self._dir()
+        if not directory or not os.path.isdir(directory):
+            return snapshots
+        own_path = self._path(directory)
+        with self._dir_lock(directory, exclusive=False):
+            paths = glob.glob(os.path.join(directory, "metrics-*.json"))
+            for path in paths:
+                if path == own_path:
+                    continue
+                snapshot = _read(path)
+                if snapshot is None:
+                    continue
+                if not self._is_live(path, snapshot):
+                    snapshot["gauges"] = {}
+                snapshots.append(snapshot)
+        return snapshots
+
+    # --------------------
+    # EXPORT
+    # --------------------
+
+    def render(self):
+        """Prometheus text exposition of every worker's metrics, summed."""
+        histograms, counters, gauges = {}, {}, {}
+        merged = {"histograms": histograms, "counters": counters}
+        for snapshot in self._all_snapshots():
+            _add_counts(merged, snapshot)
+            for key, value in snapshot["gauges"].items():
+                gauges[key] = gauges.get(key, 0) + value
+
+        lines = []
+        typed = set()
+
+        def header(name, kind):
+            if name not in typed:
+                typed.add(name)
+                if name in HELP:
+                    lines.append(f"# HELP {name} {HELP[name]}")
+                lines.append(f"# TYPE {name} {kind}")
+
+        def fmt(labels, extra=None):
+            pairs = list(labels) + ([extra] if extra else [])
+            if not pairs:
+                return ""
+            inner = ",".join('{}="{}"'.format(k, _escape(v)) for k, v in pairs)
+            return "{" + inner + "}"
+
+        for key in sorted(histograms):
+            name, labels = json.loads(key)
+            row = histograms[key]
+            header(name, "histogram")
+            cumulative = 0
+            for bound, count in zip(BUCKETS, row):
+                cumulative += count
+                lines.append(f"{name}_bucket{fmt(labels, ('le', bound))} {cumulative}")
+            cumulative += row[len(BUCKETS)]
+            lines.append(f"{name}_bucket{fmt(labels, ('le', '+Inf'))} {cumulative}")
+            lines.append(f"{name}_sum{fmt(labels)} {row[-1]}")
+            lines.append(f"{name}_count{fmt(labels)} {cumulative}")
+
+        for kind, values in (("counter", counters), ("gauge", gauges)):
+            for key in sorted(values):
+                name, labels = json.loads(key)
+                header(name, kind)
+                lines.append(f"{name}{fmt(labels)} {values[key]}")
+
+        return "\n".join(lines) + "\n"
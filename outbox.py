@@ -0,0 +1,198 @@
+"""Durable local outbox for work that should not run on the request thread.
+
+Jobs are rows in a SQLite file shared by every worker on the host. A
+request enqueues a job and returns; a background thread in each worker
+claims due jobs of each registered kind in batches and hands them to the
+kind's handler. A batch that raises is split in half and each half is
+retried at once, down to single jobs, so one bad row doesn't hold back
+the rest of its batch. A job that fails on its own is retried with
+exponential backoff until `max_attempts`, after which it is parked as
+dead for inspection.
+
+(kind, key) is unique and finished rows are kept for `retention`
+seconds, so enqueueing the same key twice is a no-op. A finished row's
+payload is cleared, since only its key is needed for that. Handlers must still
+be idempotent because a worker can crash after the handler succeeded but
+before the batch was marked done.
+"""
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    kind TEXT NOT NULL,
+    key TEXT NOT NULL,
+    payload TEXT NOT NULL,
+    status TEXT NOT NULL DEFAULT 'pending',
+    attempts INTEGER NOT NULL DEFAULT 0,
+    available_at REAL NOT NULL,
+    claimed_at REAL,
+    last_error TEXT,
+    created_at REAL NOT NULL,
+    UNIQUE (kind, key)
+);
+CREATE INDEX IF NOT EXISTS jobs_due ON jobs (kind, status, available_at);
+CREATE INDEX IF NOT EXISTS jobs_status ON jobs (status, created_at);
+"""
+
+
+class Outbox:
+    def __init__(self, path, batch_size=50, poll_interval=1.0, max_attempts=8,
+                 lease=60.0, retention=7 * 24 * 3600):
+        self.path = path
+        self.batch_size = batch_size
+        self.poll_interval = poll_interval
+        self.max_attempts = max_attempts
+        self.lease = lease
+        self.retention = retention
+        self._handlers = {}
+        self._wake = threading.Event()
+        self._lock = threading.Lock()
+        self._pid = None
+        self._initialized = False
+
+    def _connect(self):
+        conn = sqlite3.connect(self.path, timeout=10, isolation_level=None)
+        if not self._initialized:
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.executescript(SCHEMA)
+            self._initialized = True
+        return conn
+
+    def register(self, kind, handler):
+        """handler(list of (key, payload)) persists a batch, raising on failure."""
+        self._handlers[kind] = handler
+
+    def enqueue(self, kind, key, payload):
+        """Record a job. Returns False if (kind, key) was already enqueued."""
+        now = time.time()
+        conn = self._connect()
+        try:
+            cursor = conn.execute(
+                "INSERT OR IGNORE INTO jobs (kind, key, payload, available_at, created_at) "
+                "VALUES (?, ?, ?, ?, ?)",
+                (kind, key, json.dumps(payload), now, now)
+            )
+            added = cursor.rowcount == 1
+        finally:
+            conn.close()
+        if added:
+            self.ensure_worker()
+            self._wake.set()
+        return added
+
+    # --------------------
+    # PROCESSING
+    # --------------------
+
+    def _claim(self, conn, kind):
+        now = time.time()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            rows = conn.execute(
+                "SELECT id, key, payload, attempts FROM jobs "
+                "WHERE kind = ? AND status = 'pending' AND available_at <= ? "
+                "AND (claimed_at IS NULL OR claimed_at < ?) "
+                "ORDER BY available_at LIMIT ?",
+                (kind, now, now - self.lease, self.batch_size)
+            ).fetchall()
+            if rows:
+                conn.executemany("UPDATE jobs SET claimed_at = ? WHERE id = ?",
+                                 [(now, row[0]) for row in rows])
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        return rows
+
+    def _handle(self, kind, handler, rows):
+        """Run rows through handler, bisecting a failed batch until the error
+        is pinned on single jobs. Returns (done rows, [(failed row, error)])."""
+        try:
+            handler([(row[1], json.loads(row[2])) for row in rows])
+            return rows, []
+        except Exception as e:
+            if len(rows) == 1:
+                return [], [(rows[0], e)]
+            logger.warning("Outbox batch failed, splitting it", extra={"kind": kind, "jobs": len(rows), "error": str(e)})
+        middle = len(rows) // 2
+        done, failed = self._handle(kind, handler, rows[:middle])
+        more_done, more_failed = self._handle(kind, handler, rows[middle:])
+        return done + more_done, failed + more_failed
+
+    def process_once(self):
+        """Run one batch of every registered kind. Returns the number of jobs done."""
+        done = 0
+        conn = self._connect()
+        try:
+            for kind, handler in list(self._handlers.items()):
+                rows = self._claim(conn, kind)
+                if not rows:
+                    continue
+                succeeded, failed = self._handle(kind, handler, rows)
+                now = time.time()
+                updates = []
+                for row, e in failed:
+                    logger.warning("Outbox job failed", extra={"kind": kind, "key": row[1], "error": str(e)})
+                    attempts = row[3] + 1
+                    status = "dead" if attempts >= self.max_attempts else "pending"
+                    updates.append((status, now + min(300, 2 ** attempts), str(e)[:500], row[0]))
+                with conn:
+                    conn.executemany(
+                        "UPDATE jobs SET attempts = attempts + 1, status = ?, available_at = ?, "
+                        "claimed_at = NULL, last_error = ? WHERE id = ?",
+                        updates
+                    )
+                    conn.executemany(
+                        "UPDATE jobs SET status = 'done', payload = '', claimed_at = NULL, last_error = NULL "
+                        "WHERE id = ?",
+                        [(row[0],) for row in succeeded])
+                done += len(succeeded)
+            conn.execute("DELETE FROM jobs WHERE status = 'done' AND created_at < ?",
+                         (time.time() - self.retention,))
+        finally:
+            conn.close()
+        return done
+
+    def ensure_worker(self):
+        """Start this process's drain thread (once per pid, so safe across forks)."""
+        if self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self._pid = os.getpid()
+            threading.Thread(target=self._run, name="outbox-worker", daemon=True).start()
+
+    def _run(self):
+        while True:
+            self._wake.wait(self.poll_interval)
+            self._wake.clear()
+            try:
+                # Keep draining while full batches come back
+                while self.process_once() >= self.batch_size:
+                    pass
+            except Exception as e:
+                logger.exception("Outbox worker error")
+
+    def stats(self):
+        """Pending and dead jobs per kind. Done rows are not counted, so this
+        stays cheap however many are kept for dedupe."""
+        conn = self._connect()
+        try:
+            rows = conn.execute(
+                "SELECT kind, status, COUNT(*) FROM jobs WHERE status IN ('pending', 'dead') "
+                "GROUP BY kind, status").fetchall()
+        finally:
+            conn.close()
+        stats = {}
+        for kind, status, count in rows:
+            stats.setdefault(kind, {})[status] = count
+        return stats
@@ -0,0 +1,130 @@
+"""Rendered-once cache for pages and static files with no per-user content.
+
+Each entry keeps the body as-is plus gzip and brotli variants, compressed
+once at build time (`brotli` is in requirements.txt; without it only gzip
+is served).
+Every variant has its own strong ETag, so a conditional GET is answered
+with a 304 without touching the body. Entries remember the mtimes of the
+files they were built from and are rebuilt when any of them changes; the
+files are re-stat'ed at most every `check_interval` seconds, so a hit is
+a dict lookup plus header work.
+"""
+import gzip
+import hashlib
+import os
+import threading
+import time
+
+from flask import Response
+
+try:
+    import brotli
+except ImportError:  # optional
+    brotli = None
+
+# Requests asking for a fingerprinted asset (?v=<version>) can keep it forever
+IMMUTABLE = "public, max-age=31536000, immutable"
+REVALIDATE = "public, no-cache"
+
+
+def _mtimes(paths):
+    mtimes = {}
+    for path in paths:
+        try:
+            mtimes[path] = os.stat(path).st_mtime_ns
+        except OSError:
+            mtimes[path] = None
+    return mtimes
+
+
+def accepted_encodings(header):
+    """Content codings the client accepts (q > 0), from an Accept-Encoding header."""
+    accepted = set()
+    for part in (header or "").split(","):
+        coding, _, params = part.strip().partition(";")
+        coding = coding.strip().lower()
+        q = params.strip()
+        if q.startswith("q="):
+            try:
+                if float(q[2:]) <= 0:
+                    continue
+            except ValueError:
+                continue
+        if coding:
+            accepted.add(coding)
+    return accepted
+
+
+class CachedPage:
+    def __init__(self, body, mimetype, sources, min_size):
+        digest = hashlib.sha256(body).hexdigest()
+        self.version = digest[:12]
+        self.mimetype = mimetype
+        self.mtimes = _mtimes(sources)
+        self.checked_at = time.monotonic()
+        self.variants = {None: (body, f'"{digest[:32]}"')}
+        if len(body) >= min_size:
+            self.variants["gzip"] = (gzip.compress(body, 9, mtime=0), f'"{digest[:32]}-gz"')
+            if brotli is not None:
+                self.variants["br"] = (brotli.compress(body, quality=11), f'"{digest[:32]}-br"')
+
+    def pick(self, accept_encoding):
+        accepted = accepted_encodings(accept_encoding)
+        for coding in ("br", "gzip"):
+            if coding in self.variants and coding in accepted:
+                return coding
+        return None
+
+
+class PageCache:
+    def __init__(self, check_interval=2.0, min_size=256):
+        self.check_interval = check_interval
+        self.min_size = min_size
+        self._entries = {}
+        self._lock = threading.Lock()
+
+    def _fresh(self, entry):
+        now = time.monotonic()
+        if now - entry.checked_at < self.check_interval:
+            return True
+        if _mtimes(entry.mtimes) != entry.mtimes:
+            return False
+        entry.checked_at = now
+        return True
+
+    def get(self, key, build, sources):
+        """Return the entry for key, (re)building it with build() -> (bytes, mimetype) if stale."""
+        entry = self._entries.get(key)
+        if entry is not None and self._fresh(entry):
+            return entry
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or not self._fresh(entry):
+                body, mimetype = build()
+                entry = CachedPage(body, mimetype, sources, self.min_size)
+                self._entries[key] = entry
+        return entry
+
+    def respond(self, request, entry, cache_control=REVALIDATE):
+        coding = entry.pick(request.headers.get("Accept-Encoding"))
+        body, etag = entry.variants[coding]
+        headers = {"ETag": etag, "Cache-Control": cache_control}
+        if len(entry.variants) > 1:
+            headers["Vary"] = "Accept-Encoding"
+
+        if_none_match = request.headers.get("If-None-Match")
+        if if_none_match:
+            tags = {tag.strip().removeprefix("W/") for tag in if_none_match.split(",")}
+            if "*" in tags or etag in tags:
+                return Response(status=304, headers=headers)
+
+        if coding:
+            headers["Content-Encoding"] = coding
+        return Response(body, mimetype=entry.mimetype, headers=headers)
+
+    def stats(self):
+        with self._lock:
+            return {
+                "entries": len(self._entries),
+                "bytes": sum(len(body) for e in self._entries.values() for body, _ in e.variants.values())
+            }
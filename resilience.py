@@ -0,0 +1,303 @@
+"""Deadlines, hedged requests, circuit breaking and model fallback for OpenAI.
+
+Resilience.call(fn, models, deadline) runs fn(model, timeout) against each
+model in turn until one succeeds:
+
+- Every attempt gets only what is left of the request's Deadline as its
+  timeout, so a slow upstream can't hold a worker past it.
+- Each model has a CircuitBreaker. Once enough recent calls fail, the
+  breaker opens and calls skip that model (straight to the fallback, or
+  CircuitOpen if every model is open) until a cooldown passes and a
+  single probe succeeds.
+- With hedge=True, if the first attempt hasn't answered within the
+  model's recent p95 latency, a second identical attempt is started and
+  whichever finishes first wins. Hedges are capped (`max_hedges` in
+  flight) so a slow upstream doesn't get double the load, and a caller
+  can pass hedge_slot to make each hedge also hold one of its own
+  concurrency slots (no free slot, no hedge).
+"""
+import contextvars
+import os
+import threading
+import time
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+# Errors that say the request itself is wrong; retrying elsewhere won't help
+NON_RETRYABLE_STATUS = {400, 401, 403, 422}
+
+
+def _no_slot():
+    pass
+
+
+class DeadlineExceeded(Exception):
+    pass
+
+
+class CircuitOpen(Exception):
+    def __init__(self, retry_after):
+        super().__init__("Upstream unavailable, failing fast")
+        self.retry_after = retry_after
+
+
+class Deadline:
+    def __init__(self, seconds):
+        self.expires_at = time.monotonic() + seconds
+
+    def remaining(self):
+        return max(0.0, self.expires_at - time.monotonic())
+
+    def check(self):
+        """Seconds left; raises DeadlineExceeded if none are."""
+        left = self.remaining()
+        if left <= 0:
+            raise DeadlineExceeded("Request deadline exceeded")
+        return left
+
+
+def _non_retryable(error):
+    return getattr(error, "status_code", None) in NON_RETRYABLE_STATUS
+
+
+class CircuitBreaker:
+    """Closed -> open when `error_ratio` of at least `min_calls` calls in the
+    last `window` seconds failed; open -> half-open after `cooldown`, where
+    one probe decides between closed and open again."""
+
+    def __init__(self, window=30.0, min_calls=10, error_ratio=0.5, cooldown=15.0):
+        self.window = window
+        self.min_calls = min_calls
+        self.error_ratio = error_ratio
+        self.cooldown = cooldown
+        self.state = "closed"
+        self.opened_at = 0.0
+        self.trips = 0
+        self._outcomes = deque()  # (time, ok)
+        self._failures = 0
+        self._probing = False
+        self._lock = threading.Lock()
+
+    def allow(self):
+        with self._lock:
+            if self.state == "closed":
+                return True
+            if self.state == "open" and time.monotonic() - self.opened_at >= self.cooldown:
+                self.state = "half_open"
+            if self.state == "half_open" and not self._probing:
+                self._probing = True
+                return True
+            return False
+
+    def retry_after(self):
+        return max(1, int(self.cooldown - (time.monotonic() - self.opened_at) + 0.999))
+
+    def record(self, ok):
+        now = time.monotonic()
+        with self._lock:
+            if self.state == "half_open":
+                self._probing = False
+                if ok:
+                    self.state = "closed"
+                    self._outcomes.clear()
+                    self._failures = 0
+                else:
+                    self._open(now)
+                return
+            self._outcomes.append((now, ok))
+            if not ok:
+                self._failures += 1
+            while self._outcomes and now - self._outcomes[0][0] > self.window:
+                if not self._outcomes.popleft()[1]:
+                    self._failures -= 1
+            if (self.state == "closed" and len(self._outcomes) >= self.min_calls
+                    and self._failures >= self.error_ratio * len(self._outcomes)):
+                self._open(now)
+
+    def _open(self, now):
+        self.state = "open"
+        self.opened_at = now
+        self.trips += 1
+
+
+class _Latencies:
+    def __init__(self, size=256, default=2.0):
+        self.default = default
+        self._samples = deque(maxlen=size)
+        self._p95 = default
+        self._since = 0
+        self._lock = threading.Lock()
+
+    def add(self, seconds):
+        with self._lock:
+            self._samples.append(seconds)
+            self._since += 1
+            if self._since >= 16:
+                ordered = sorted(self._samples)
+                self._p95 = ordered[min(len(ordered) - 1, int(len(ordered) * 0.95))]
+                self._since = 0
+
+    def p95(self):
+        # Until there's enough data, hedge late rather than early
+        return self._p95 if len(self._samples) >= 20 else self.default
+
+
+class Resilience:
+    def __init__(self, min_hedge_delay=0.25, default_hedge_delay=2.0, max_hedges=8,
+                 max_workers=64, **breaker_options):
+        self.min_hedge_delay = min_hedge_delay
+        self.default_hedge_delay = default_hedge_delay
+        self.max_hedges = max_hedges
+        self.max_workers = max_workers
+        self.breaker_options = breaker_options
+        self.hedges = 0
+        self.hedge_wins = 0
+        self.fallbacks = 0
+        self._breakers = {}
+        self._latencies = {}
+        self._hedges_in_flight = 0
+        self._lock = threading.Lock()
+        self._pool = None
+        self._pid = None
+
+    def breaker(self, model):
+        with self._lock:
+            if model not in self._breakers:
+                self._breakers[model] = CircuitBreaker(**self.breaker_options)
+                self._latencies[model] = _Latencies(default=self.default_hedge_delay)
+            return self._breakers[model]
+
+    def hedge_delay(self, model):
+        self.breaker(model)
+        return max(self.min_hedge_delay, self._latencies[model].p95())
+
+    def _executor(self):
+        # Threads don't survive fork; each worker builds its own pool
+        if self._pid != os.getpid():
+            with self._lock:
+                if self._pid != os.getpid():
+                    self._pool = ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix="hedge")
+                    self._pid = os.getpid()
+        return self._pool
+
+    # --------------------
+    # CALLS
+    # --------------------
+
+    def call(self, fn, models, deadline, hedge=False, hedge_slot=None):
+        """Run fn(model, timeout) on the first healthy model that answers in time.
+
+        hedge_slot(), if given, is asked before each hedge and returns a
+        function that frees the slot once the hedge finishes, or None to
+        skip hedging. Returns (result, model). Raises the last upstream
+        error, CircuitOpen if every model's breaker is open, or
+        DeadlineExceeded.
+        """
+        last_error = None
+        skipped = []
+        for i, model in enumerate(m for m in models if m):
+            breaker = self.breaker(model)
+            if not breaker.allow():
+                skipped.append(breaker)
+                continue
+            if i > 0:
+                self.fallbacks += 1
+            try:
+                deadline.check()
+                if hedge:
+                    result = self._hedged(fn, model, deadline, hedge_slot)
+                else:
+                    result = self._attempt(fn, model, deadline)
+                return result, model
+            except DeadlineExceeded:
+                raise
+            except Exception as e:
+                if _non_retryable(e):
+                    raise
+                last_error = e
+                if deadline.remaining() <= 0:
+                    raise DeadlineExceeded("Request deadline exceeded") from e
+        if last_error is not None:
+            raise last_error
+        raise CircuitOpen(min(b.retry_after() for b in skipped) if skipped else 1)
+
+    def _attempt(self, fn, model, deadline):
+        breaker = self.breaker(model)
+        started = time.monotonic()
+        try:
+            result = fn(model, deadline.check())
+        except Exception as e:
+            # A bad request says nothing about the upstream's health
+            breaker.record(_non_retryable(e))
+            raise
+        breaker.record(True)
+        self._latencies[model].add(time.monotonic() - started)
+        return result
+
+    def _take_hedge(self):
+        with self._lock:
+            if self._hedges_in_flight >= self.max_hedges:
+                return False
+            self._hedges_in_flight += 1
+            self.hedges += 1
+            return True
+
+    def _hedge_done(self, _future):
+        with self._lock:
+            self._hedges_in_flight -= 1
+
+    def _hedged(self, fn, model, deadline, hedge_slot=None):
+        pool = self._executor()
+        # Each attempt runs in a copy of the caller's context (request id for logs)
+        first = pool.submit(contextvars.copy_context().run, self._attempt, fn, model, deadline)
+        done, _ = wait([first], timeout=min(self.hedge_delay(model), deadline.remaining()))
+        if done:
+            return first.result()
+        if self.breaker(model).state != "closed":
+            return self._first_result([first], deadline)
+        free_slot = hedge_slot() if hedge_slot else _no_slot
+        if free_slot is None:
+            return self._first_result([first], deadline)
+        if not self._take_hedge():
+            free_slot()
+            return self._first_result([first], deadline)
+        second = pool.submit(contextvars.copy_context().run, self._attempt, fn, model, deadline)
+
+        def hedge_done(future):
+            self._hedge_done(future)
+            free_slot()
+        second.add_done_callback(hedge_done)
+        result, winner = self._first_result([first, second], deadline, with_winner=True)
+        if winner is second:
+            self.hedge_wins += 1
+        return result
+
+    def _first_result(self, futures, deadline, with_winner=False):
+        """First successful result among futures; the last error if all fail."""
+        pending = set(futures)
+        error = None
+        while pending:
+            done, pending = wait(pending, timeout=deadline.remaining(), return_when=FIRST_COMPLETED)
+            if not done:
+                raise DeadlineExceeded("Request deadline exceeded")
+            for future in done:
+                if future.exception() is None:
+                    return (future.result(), future) if with_winner else future.result()
+                error = future.exception()
+        raise error
+
+    def stats(self):
+        with self._lock:
+            breakers = dict(self._breakers)
+        return {
+            "hedges": self.hedges,
+            "hedge_wins": self.hedge_wins,
+            "fallbacks": self.fallbacks,
+            "models": {
+                model: {
+                    "state": breaker.state,
+                    "trips": breaker.trips,
+                    "hedge_delay_ms": round(1000 * self.hedge_delay(model), 1)
+                } for model, breaker in breakers.items()
+            }
+        }
@@ -0,0 +1,166 @@
+"""In-process response cache for /generate with single-flight coalescing.
+
+Entries are evicted least-recently-used first whenever either the entry
+count or the byte budget is exceeded, and expire after a fixed TTL.
+Concurrent misses for the same key share one upstream call: the first
+caller computes the value, the rest wait for it.
+
+Given a shared `store` (a SharedMemoryStore, see cachestore.py) the
+cache has a second level: a local miss is looked up there before
+computing, and every value put is written there too, so an output
+generated by one gunicorn worker is a hit for the others.
+"""
+import hashlib
+import json
+import threading
+import time
+import unicodedata
+from collections import OrderedDict
+
+
+def normalize_prompt(prompt):
+    """Collapse whitespace and unicode forms so trivially different prompts share a key."""
+    return " ".join(unicodedata.normalize("NFC", prompt).split())
+
+
+def make_cache_key(model, prompt, temperature, max_tokens=None):
+    raw = json.dumps([model, normalize_prompt(prompt), temperature, max_tokens])
+    return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+
+class _Flight:
+    __slots__ = ("event", "value", "error")
+
+    def __init__(self):
+        self.event = threading.Event()
+        self.value = None
+        self.error = None
+
+
+class ResponseCache:
+    def __init__(self, max_entries=1024, max_bytes=8 * 1024 * 1024, ttl=600, store=None):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.store = store
+        self._entries = OrderedDict()  # key -> (expires_at, size, value)
+        self._bytes = 0
+        self._inflight = {}
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+        self.evictions = 0
+        self.shared_hits = 0
+
+    def _lookup(self, key, now):
+        # Caller holds the lock
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        if entry[0] <= now:
+            self._remove(key)
+            return None
+        self._entries.move_to_end(key)
+        return entry
+
+    def _remove(self, key):
+        _, size, _ = self._entries.pop(key)
+        self._bytes -= size
+
+    def get(self, key):
+        """Return the cached value or None, counting a hit or a miss."""
+        with self._lock:
+            entry = self._lookup(key, time.monotonic())
+            if entry is not None:
+                self.hits += 1
+                return entry[2]
+        value = self._shared_get(key)
+        if value is None:
+            with self._lock:
+                self.misses += 1
+        return value
+
+    def _shared_get(self, key):
+        """Look key up in the shared store, keeping a local copy of a hit."""
+        if self.store is None:
+            return None
+        value = self.store.get(key)
+        if value is not None:
+            self._put_local(key, value)
+            with self._lock:
+                self.hits += 1
+                self.shared_hits += 1
+        return value
+
+    def put(self, key, value):
+        self._put_local(key, value)
+        if self.store is not None:
+            self.store.set(key, value)
+
+    def _put_local(self, key, value):
+        size = len(value.encode("utf-8"))
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+            self._entries[key] = (time.monotonic() + self.ttl, size, value)
+            self._bytes += size
+            while len(self._entries) > self.max_entries or self._bytes > self.max_bytes:
+                self._remove(next(iter(self._entries)))
+                self.evictions += 1
+
+    def get_or_compute(self, key, compute, timeout=None):
+        """Return the cached value, or run compute() once for all concurrent callers.
+
+        Callers that join a running compute() wait at most `timeout` seconds
+        for it, then raise TimeoutError.
+        """
+        with self._lock:
+            entry = self._lookup(key, time.monotonic())
+            if entry is not None:
+                self.hits += 1
+                return entry[2]
+            flight = self._inflight.get(key)
+            leader = flight is None
+            if leader:
+                flight = self._inflight[key] = _Flight()
+            else:
+                self.coalesced += 1
+
+        if not leader:
+            if not flight.event.wait(timeout):
+                raise TimeoutError("Timed out waiting for an identical request")
+            if flight.error is not None:
+                raise flight.error
+            return flight.value
+
+        try:
+            flight.value = self._shared_get(key)
+            if flight.value is None:
+                with self._lock:
+                    self.misses += 1
+                flight.value = compute()
+                self.put(key, flight.value)
+            return flight.value
+        except Exception as e:
+            flight.error = e
+            raise
+        finally:
+            with self._lock:
+                self._inflight.pop(key, None)
+            flight.event.set()
+
+    def stats(self):
+        with self._lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "coalesced": self.coalesced,
+                "shared_hits": self.shared_hits,
+                "evictions": self.evictions,
+                "entries": len(self._entries),
+                "bytes": self._bytes,
+                "inflight": len(self._inflight)
+            }
@@ -0,0 +1,185 @@
+"""Priority-aware dispatch scheduler for upstream (OpenAI) calls.
+
+At most `max_concurrency` calls run at once. Callers beyond that wait in
+one FIFO queue per priority class; when a slot frees up it is handed to
+the next waiter chosen by smooth weighted round-robin, so higher classes
+get proportionally more slots without starving lower ones. Each class
+has its own queue depth and wait budget, and a caller that would exceed
+either gets QueueFull immediately (or after its wait budget) with a
+Retry-After hint, which the app turns into a 429.
+"""
+import math
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+
+DEFAULT_WEIGHTS = {"highest": 8, "high": 4, "low": 1}
+DEFAULT_MAX_QUEUE = {"highest": 200, "high": 100, "low": 20}
+DEFAULT_MAX_WAIT = {"highest": 30.0, "high": 30.0, "low": 10.0}
+
+
+class QueueFull(Exception):
+    def __init__(self, priority, retry_after):
+        super().__init__(f"Dispatch queue for '{priority}' traffic is full")
+        self.priority = priority
+        self.retry_after = retry_after
+
+
+class _Waiter:
+    __slots__ = ("event", "granted")
+
+    def __init__(self):
+        self.event = threading.Event()
+        self.granted = False
+
+
+class _ClassStats:
+    __slots__ = ("admitted", "rejected", "timed_out", "wait_total", "wait_max", "recent_waits")
+
+    def __init__(self):
+        self.admitted = 0
+        self.rejected = 0
+        self.timed_out = 0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+        self.recent_waits = deque(maxlen=512)
+
+    def record_wait(self, seconds):
+        self.admitted += 1
+        self.wait_total += seconds
+        self.wait_max = max(self.wait_max, seconds)
+        self.recent_waits.append(seconds)
+
+
+class Ticket:
+    __slots__ = ("priority", "started")
+
+    def __init__(self, priority, started):
+        self.priority = priority
+        self.started = started
+
+
+class DispatchScheduler:
+    def __init__(self, max_concurrency=16, weights=None, max_queue=None, max_wait=None):
+        self.max_concurrency = max_concurrency
+        self.weights = dict(weights or DEFAULT_WEIGHTS)
+        self.max_queue = dict(max_queue or DEFAULT_MAX_QUEUE)
+        self.max_wait = dict(max_wait or DEFAULT_MAX_WAIT)
+        self._queues = {cls: deque() for cls in self.weights}
+        self._credits = {cls: 0 for cls in self.weights}
+        self._stats = {cls: _ClassStats() for cls in self.weights}
+        self._active = 0
+        self._service_time = 1.0  # EWMA of seconds a slot is held
+        self._lock = threading.Lock()
+
+    def _class_for(self, priority):
+        # Unknown priorities are treated as the lowest-weighted class
+        if priority in self._queues:
+            return priority
+        return min(self.weights, key=self.weights.get)
+
+    def _retry_after(self, priority):
+        # Rough time for the queue ahead of this caller to drain
+        depth = len(self._queues[priority]) + 1
+        return max(1, math.ceil(self._service_time * depth / self.max_concurrency))
+
+    def acquire(self, priority, timeout=None):
+        """Block until a slot is free. Raises QueueFull instead of queueing too deep or too long.
+
+        timeout (e.g. what is left of the request's deadline) can only
+        shorten the class's wait budget.
+        """
+        priority = self._class_for(priority)
+        stats = self._stats[priority]
+        queued_at = time.monotonic()
+        with self._lock:
+            if self._active < self.max_concurrency and not any(self._queues.values()):
+                self._active += 1
+                stats.record_wait(0.0)
+                return Ticket(priority, queued_at)
+            queue = self._queues[priority]
+            if len(queue) >= self.max_queue.get(priority, 0):
+                stats.rejected += 1
+                raise QueueFull(priority, self._retry_after(priority))
+            waiter = _Waiter()
+            queue.append(waiter)
+
+        wait = self.max_wait.get(priority)
+        if timeout is not None:
+            wait = timeout if wait is None else min(wait, timeout)
+        if not waiter.event.wait(wait):
+            with self._lock:
+                if not waiter.granted:
+                    queue.remove(waiter)
+                    stats.timed_out += 1
+                    raise QueueFull(priority, self._retry_after(priority))
+
+        started = time.monotonic()
+        with self._lock:
+            stats.record_wait(started - queued_at)
+        return Ticket(priority, started)
+
+    def try_acquire(self, priority):
+        """A slot if one is free and nobody is queued for it, else None. Never waits."""
+        priority = self._class_for(priority)
+        with self._lock:
+            if self._active >= self.max_concurrency or any(self._queues.values()):
+                return None
+            self._active += 1
+            self._stats[priority].record_wait(0.0)
+            return Ticket(priority, time.monotonic())
+
+    def release(self, ticket):
+        with self._lock:
+            held = time.monotonic() - ticket.started
+            self._service_time = 0.9 * self._service_time + 0.1 * held
+            waiter = self._pick_next()
+            if waiter is None:
+                self._active -= 1
+            else:
+                # Hand the slot straight to the next waiter
+                waiter.granted = True
+                waiter.event.set()
+
+    @contextmanager
+    def slot(self, priority, timeout=None):
+        ticket = self.acquire(priority, timeout)
+        try:
+            yield ticket
+        finally:
+            self.release(ticket)
+
+    def _pick_next(self):
+        # Smooth weighted round-robin over the non-empty queues; caller holds the lock
+        candidates = [cls for cls, queue in self._queues.items() if queue]
+        if not candidates:
+            return None
+        total = 0
+        for cls in candidates:
+            self._credits[cls] += self.weights[cls]
+            total += self.weights[cls]
+        chosen = max(candidates, key=self._credits.get)
+        self._credits[chosen] -= total
+        return self._queues[chosen].popleft()
+
+    def stats(self):
+        with self._lock:
+            classes = {}
+            for cls, stats in self._stats.items():
+                waits = sorted(stats.recent_waits)
+                p95 = waits[min(len(waits) - 1, int(len(waits) * 0.95))] if waits else 0.0
+                classes[cls] = {
+                    "queued": len(self._queues[cls]),
+                    "admitted": stats.admitted,
+                    "rejected": stats.rejected,
+                    "timed_out": stats.timed_out,
+                    "wait_avg_ms": round(1000 * stats.wait_total / stats.admitted, 3) if stats.admitted else 0.0,
+                    "wait_p95_ms": round(1000 * p95, 3),
+                    "wait_max_ms": round(1000 * stats.wait_max, 3)
+                }
+            return {
+                "active": self._active,
+                "max_concurrency": self.max_concurrency,
+                "classes": classes
+            }
@@ -0,0 +1,28 @@
+"""Server-Sent Events helpers for streaming OpenAI completions."""
+import json
+
+
+def wants_event_stream(request):
+    """True when the client asked for SSE via ?stream=1 or the Accept header."""
+    if request.args.get("stream", "").lower() in ("1", "true", "yes"):
+        return True
+    return request.accept_mimetypes.best == "text/event-stream"
+
+
+def sse_event(data, event=None):
+    """Format one SSE frame. Data is JSON-encoded so newlines survive."""
+    frame = ""
+    if event:
+        frame += f"event: {event}\n"
+    frame += f"data: {json.dumps(data)}\n\n"
+    return frame
+
+
+def iter_completion_text(stream):
+    """Yield the text deltas of a chat.completions stream, skipping empty ones."""
+    for chunk in stream:
+        if not chunk.choices:
+            continue
+        text = chunk.choices[0].delta.content
+        if text:
+            yield text
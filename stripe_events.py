@@ -0,0 +1,149 @@
+"""Turn Stripe subscription webhook events into users.tier updates.
+
+Events arrive through /stripe-webhook and are queued in the outbox; the
+outbox worker hands them over in batches, oldest first, and they are
+applied to the users table in a single transaction. Stripe does not
+guarantee delivery order, so an event older than the last one applied to
+a user is ignored.
+"""
+import logging
+from collections import namedtuple
+
+from sqlalchemy import or_
+
+from db import User
+
+logger = logging.getLogger(__name__)
+
+ACTIVE_STATUSES = {"active", "trialing"}
+ENDED_STATUSES = {"canceled", "unpaid", "incomplete_expired"}
+SUBSCRIPTION_EVENTS = {
+    "customer.subscription.created",
+    "customer.subscription.updated",
+    "customer.subscription.deleted"
+}
+PAYMENT_EVENTS = {"invoice.paid", "invoice.payment_succeeded"}
+
+# A user moved from previous_tier to tier by the Stripe event at `created`
+Transition = namedtuple("Transition", "user_id email previous_tier tier trial_ends_at created")
+
+
+def parse_price_tiers(spec, default_price=None, default_tier="pro"):
+    """Parse "price_a:pro,price_b:agency" into {price_id: tier}."""
+    tiers = {}
+    for item in (spec or "").split(","):
+        price, _, tier = item.strip().partition(":")
+        if price and tier:
+            tiers[price] = tier
+    if default_price and default_price not in tiers:
+        tiers[default_price] = default_tier
+    return tiers
+
+
+def _price_id(item):
+    # Invoice lines on newer API versions name the price under pricing
+    price = item.get("price") or {}
+    if isinstance(price, dict) and price.get("id"):
+        return price["id"]
+    return ((item.get("pricing") or {}).get("price_details") or {}).get("price")
+
+
+def _tier_from_items(subscription, price_tiers):
+    items = (subscription.get("items") or subscription.get("lines") or {}).get("data") or []
+    for item in items:
+        price = _price_id(item)
+        if price in price_tiers:
+            return price_tiers[price]
+    return None
+
+
+def subscription_change(event, price_tiers, default_tier="pro"):
+    """Return the tier change an event implies, or None if it doesn't change anything.
+
+    The change names the user by id (from checkout metadata), Stripe
+    customer id, or email, in that order of preference.
+    """
+    obj = (event.get("data") or {}).get("object") or {}
+    event_type = event.get("type")
+    metadata = obj.get("metadata") or {}
+
+    if event_type == "checkout.session.completed":
+        if obj.get("mode") != "subscription":
+            return None
+        return {
+            "user_id": obj.get("client_reference_id") or metadata.get("user_id"),
+            "customer_id": obj.get("customer"),
+            "email": (obj.get("customer_details") or {}).get("email") or obj.get("customer_email"),
+            "tier": metadata.get("tier") or default_tier,
+            "created": event.get("created") or 0
+        }
+
+    if event_type in SUBSCRIPTION_EVENTS:
+        status = obj.get("status")
+        if event_type == "customer.subscription.deleted" or status in ENDED_STATUSES:
+            tier = "free"
+        elif status in ACTIVE_STATUSES:
+            tier = metadata.get("tier") or _tier_from_items(obj, price_tiers) or default_tier
+        else:
+            # incomplete / past_due: leave the current tier alone
+            return None
+        return {
+            "user_id": metadata.get("user_id"),
+            "customer_id": obj.get("customer"),
+            "email": None,
+            "tier": tier,
+            "created": event.get("created") or 0
+        }
+
+    return None
+
+
+def invoice_payment(event, price_tiers, default_tier="pro"):
+    """(tier, currency, amount in minor units, created) for a paid invoice, else None."""
+    if event.get("type") not in PAYMENT_EVENTS:
+        return None
+    invoice = (event.get("data") or {}).get("object") or {}
+    if not invoice.get("amount_paid"):
+        return None
+    details = invoice.get("subscription_details") or \
+        ((invoice.get("parent") or {}).get("subscription_details")) or {}
+    tier = (details.get("metadata") or {}).get("tier") or _tier_from_items(invoice, price_tiers) or default_tier
+    return tier, (invoice.get("currency") or "usd").lower(), invoice["amount_paid"], event.get("created") or 0
+
+
+def apply_changes(db, changes, valid_tiers):
+    """Apply changes in order inside the caller's transaction.
+
+    Returns a Transition for every user touched, so caches can be
+    invalidated and tier changes counted.
+    """
+    touched = []
+    for change in changes:
+        if change["tier"] not in valid_tiers:
+            logger.warning("Ignoring Stripe change to unknown tier", extra={"tier": change["tier"]})
+            continue
+        user = None
+        if change["user_id"]:
+            user = db.query(User).filter(User.id == change["user_id"]).first()
+        if user is None and change["customer_id"]:
+            user = db.query(User).filter(User.stripe_customer_id == change["customer_id"]).first()
+        if user is None and change["email"]:
+            user = db.query(User).filter(User.email == change["email"]).first()
+        if user is None:
+            logger.warning("No user for Stripe customer", extra={"customer_id": change["customer_id"]})
+            continue
+        values = {"tier": change["tier"], "stripe_event_at": change["created"]}
+        if change["customer_id"]:
+            values["stripe_customer_id"] = change["customer_id"]
+        # Check the event time in the UPDATE itself so a worker applying a
+        # newer event concurrently can't be overwritten with older state
+        applied = db.query(User).filter(
+            User.id == user.id,
+            or_(User.stripe_event_at.is_(None), User.stripe_event_at <= change["created"])
+        ).update(values, synchronize_session=False)
+        if applied:
+            touched.append(Transition(user.id, user.email, user.tier, change["tier"],
+                                      user.trial_ends_at, change["created"]))
+            # A later change to the same user in this batch must see this one
+            db.expire(user)
+    return touched
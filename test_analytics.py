@@ -0,0 +1,133 @@
+#!/usr/bin/env python3
+"""Usage/revenue rollups: incremental counters, Stripe-driven tier changes, backfill and /admin/stats."""
+import time
+from datetime import datetime, timedelta, timezone
+
+import pytest
+from sqlalchemy import create_engine
+
+import app as app_module
+from analytics import Rollups, backfill
+from db import Base, User
+
+LIMITS = {"free": 1, "pro": 20, "agency": 200}
+
+
+@pytest.fixture
+def engine(tmp_path):
+    engine = create_engine(f"sqlite:///{tmp_path / 'rollups.db'}")
+    Base.metadata.create_all(engine)
+    return engine
+
+
+def _tier(summary, tier):
+    return summary["tiers"][tier]
+
+
+def test_increments_add_up_across_flushes(engine):
+    rollups = Rollups(engine)
+    rollups.record("pro", generations=1, tokens=120)
+    rollups.record("pro", generations=1, tokens=80)
+    rollups.buffer.flush()
+    # A second worker's flush adds onto the same row
+    other = Rollups(engine)
+    other.record("pro", generations=2, tokens=10)
+    other.buffer.flush()
+
+    summary = rollups.summary(7, LIMITS)
+    assert _tier(summary, "pro")["totals"] == {"generations": 4, "tokens": 210}
+    today = datetime.now(timezone.utc).date().isoformat()
+    assert summary["daily"][today]["pro"] == {"generations": 4, "tokens": 210}
+    assert _tier(summary, "agency") == {"users": 0, "limit": 200, "totals": {}}
+
+
+def test_tier_changes_and_trial_conversion(engine):
+    rollups = Rollups(engine)
+    for _ in range(4):
+        rollups.record("free", signups=1, users=1)
+    now = time.time()
+    on_trial = datetime.now(timezone.utc) + timedelta(days=2)
+    expired = datetime.utcnow() - timedelta(days=2)
+    rollups.record_tier_change("free", "pro", on_trial, now)
+    rollups.record_tier_change("free", "agency", expired, now)
+    rollups.record_tier_change("pro", "agency", None, now)
+    rollups.record_tier_change("agency", "agency", None, now)
+    rollups.buffer.flush()
+
+    summary = rollups.summary(30, LIMITS)
+    assert {tier: _tier(summary, tier)["users"] for tier in LIMITS} == {"free": 2, "pro": 0, "agency": 2}
+    assert summary["conversion"] == {"signups": 4, "upgrades": 2, "trial_conversions": 1,
+                                     "trial_conversion_rate": 0.25}
+    assert _tier(summary, "agency")["totals"]["plan_changes"] == 1
+
+
+def test_limit_crossings_are_counted_once(engine):
+    rollups = Rollups(engine)
+    for used in range(1, 21):
+        rollups.record_reservation("pro", used - 1, used, 20)
+    rollups.record_reservation("agency", 150, 200, 200)
+    rollups.buffer.flush()
+    summary = rollups.summary(1, LIMITS)
+    assert _tier(summary, "pro")["totals"] == {"near_limit": 1, "at_limit": 1}
+    assert _tier(summary, "agency")["totals"] == {"near_limit": 1, "at_limit": 1}
+
+
+def test_backfill_rebuilds_from_users_and_keeps_events(engine):
+    rollups = Rollups(engine)
+    rollups.record("pro", logins=3, users=99)
+    rollups.buffer.flush()
+    created = datetime(2026, 1, 15, 12, tzinfo=timezone.utc)
+    with engine.begin() as conn:
+        conn.execute(User.__table__.insert(), [
+            {"id": f"u{i}", "email": f"u{i}@example.com", "tier": tier, "used": 0, "created_at": created}
+            for i, tier in enumerate(["free", "free", "pro", "agency"])
+        ])
+
+    for _ in range(2):
+        assert backfill(engine, batch_size=2) == 4
+    summary = rollups.summary(366, LIMITS)
+    assert {tier: _tier(summary, tier)["users"] for tier in LIMITS} == {"free": 2, "pro": 1, "agency": 1}
+    assert summary["daily"]["2026-01-15"]["free"] == {"signups": 4, "users": 2}
+    assert _tier(summary, "pro")["totals"]["logins"] == 3
+
+
+def _summary():
+    app_module.rollups.buffer.flush()
+    return app_module.rollups.summary(30, LIMITS)
+
+
+def test_stripe_events_feed_upgrades_and_revenue(make_user):
+    user_id, _, _ = make_user("free", trial_ends_at=datetime.utcnow() + timedelta(days=3))
+    before = _summary()
+
+    created = int(time.time())
+    app_module._apply_stripe_events([(1, {
+        "id": "evt_checkout", "type": "checkout.session.completed", "created": created,
+        "data": {"object": {"mode": "subscription", "client_reference_id": user_id,
+                            "customer": "cus_rollup", "metadata": {"tier": "agency"}}}
+    }), (2, {
+        "id": "evt_invoice", "type": "invoice.paid", "created": created,
+        "data": {"object": {"amount_paid": 4900, "currency": "usd",
+                            "lines": {"data": [{"pricing": {"price_details": {"price": "price_agency"}}}]}}}
+    })])
+    after = _summary()
+
+    agency, agency_before = _tier(after, "agency"), _tier(before, "agency")
+    assert agency["users"] == agency_before["users"] + 1
+    assert _tier(after, "free")["users"] == _tier(before, "free")["users"] - 1
+    assert agency["totals"].get("revenue_usd", 0) == agency_before["totals"].get("revenue_usd", 0) + 4900
+    assert after["conversion"]["trial_conversions"] == before["conversion"]["trial_conversions"] + 1
+
+
+def test_admin_stats_requires_an_admin(monkeypatch, make_user):
+    _, email, headers = make_user("free")
+    client = app_module.app.test_client()
+
+    assert client.get("/admin/stats", headers=headers).status_code == 403
+    monkeypatch.setattr(app_module, "ADMIN_EMAILS", {email})
+    response = client.get("/admin/stats?days=7", headers=headers)
+    assert response.status_code == 200
+    body = response.get_json()
+    assert body["days"] == 7
+    assert body["tiers"]["agency"]["limit"] == app_module.TIERS["agency"]["limit"]
+    assert client.get("/admin/stats?days=week", headers=headers).status_code == 400
@@ -0,0 +1,116 @@
+#!/usr/bin/env python3
+"""Queue-backed JSON logging: request ids, drop accounting, streamed context."""
+import io
+import json
+import logging
+import threading
+import time
+
+import pytest
+
+import app as app_module
+import applog
+
+
+class _BlockingStream(io.StringIO):
+    def __init__(self):
+        super().__init__()
+        self.release = threading.Event()
+
+    def write(self, text):
+        self.release.wait(5)
+        return super().write(text)
+
+
+def _logger(handler, name):
+    logger = logging.Logger(name)
+    logger.addHandler(handler)
+    return logger
+
+
+def test_records_are_json_with_request_id_and_extras():
+    stream = io.StringIO()
+    handler = applog.QueueLogHandler(stream=stream)
+    logger = _logger(handler, "test.json")
+
+    token = applog.request_id_var.set("req-123")
+    try:
+        logger.warning("Outbox batch failed", extra={"kind": "generation", "jobs": 3})
+    finally:
+        applog.request_id_var.reset(token)
+    logger.info("no request")
+
+    deadline = time.time() + 5
+    while handler.written < 2 and time.time() < deadline:
+        time.sleep(0.01)
+    first, second = [json.loads(line) for line in stream.getvalue().splitlines()]
+    assert first["msg"] == "Outbox batch failed"
+    assert first["level"] == "WARNING"
+    assert first["request_id"] == "req-123"
+    assert first["kind"] == "generation" and first["jobs"] == 3
+    assert second["request_id"] is None
+
+
+def test_full_queue_drops_instead_of_blocking():
+    stream = _BlockingStream()
+    handler = applog.QueueLogHandler(stream=stream, max_queue=4, batch_size=2)
+    logger = _logger(handler, "test.drops")
+
+    started = time.perf_counter()
+    for i in range(50):
+        logger.info("line %d", i)
+    assert time.perf_counter() - started < 1.0
+    # At most one batch in the stuck writer plus a full queue got through
+    assert handler.dropped >= 50 - 2 - 4
+
+    stream.release.set()
+    deadline = time.time() + 5
+    while handler._queue.qsize() and time.time() < deadline:
+        time.sleep(0.01)
+    handler.drain()
+    lines = [json.loads(line) for line in stream.getvalue().splitlines()]
+    assert sum(line.get("dropped", 0) for line in lines) == handler.dropped
+
+
+def test_in_context_keeps_request_id_for_streamed_bodies():
+    def body():
+        yield applog.request_id_var.get()
+        yield applog.request_id_var.get()
+
+    token = applog.request_id_var.set("req-stream")
+    wrapped = applog.in_context(body())
+    applog.request_id_var.reset(token)
+    assert list(wrapped) == ["req-stream", "req-stream"]
+
+
+@pytest.fixture
+def captured(monkeypatch):
+    records = []
+    capture = logging.Handler()
+    capture.emit = records.append
+    app_logger = logging.getLogger("app")
+    app_logger.addHandler(capture)
+    monkeypatch.setattr(app_module, "LOG_SAMPLE_RATE", 1.0)
+    yield records
+    app_logger.removeHandler(capture)
+
+
+def test_request_id_is_echoed_and_logged(captured):
+    client = app_module.app.test_client()
+
+    response = client.get("/metrics", headers={"X-Request-ID": "abc-123"})
+    assert response.headers["X-Request-ID"] == "abc-123"
+    generated = client.get("/metrics", headers={"X-Request-ID": "bad id"}).headers["X-Request-ID"]
+    assert generated != "bad id" and len(generated) == 32
+
+    access = [r for r in captured if r.getMessage() == "request"]
+    assert [r.request_id for r in access] == ["abc-123", generated]
+    assert access[0].status == 200 and access[0].path == "/metrics"
+    # The context is cleared once the request is torn down
+    assert applog.request_id_var.get() is None
+
+
+def test_http_client_request_logs_are_quieted():
+    # app configured logging on import; openai's httpx2 fork logs like httpx
+    for name in ("httpx", "httpx2"):
+        assert not logging.getLogger(name).isEnabledFor(logging.INFO)
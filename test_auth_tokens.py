@@ -0,0 +1,155 @@
+#!/usr/bin/env python3
+"""Local access token verification: HS256 secret, JWKS rotation, caching and the API gate."""
+import os
+import subprocess
+import sys
+import time
+import uuid
+
+import httpx
+import jwt
+import pytest
+
+import app as app_module
+from auth_tokens import InvalidToken, JWKSKeys, TokenVerifier
+from benchmarks.fakes import FAKE_JWT_SECRET, FakeServer, SupabaseHandler, make_jwt
+
+ISSUER = "https://project.supabase.co/auth/v1"
+LEGACY_SECRET = "legacy-app-secret-0000000000000000000"
+
+
+def _claims(**overrides):
+    now = int(time.time())
+    claims = {"sub": str(uuid.uuid4()), "email": "a@example.com", "aud": "authenticated",
+              "role": "authenticated", "iss": ISSUER, "iat": now, "exp": now + 3600}
+    claims.update(overrides)
+    return {k: v for k, v in claims.items() if v is not None}
+
+
+def _verifier(**kwargs):
+    options = dict(secret=FAKE_JWT_SECRET, issuer=ISSUER, legacy_secret=LEGACY_SECRET)
+    options.update(kwargs)
+    return TokenVerifier(**options)
+
+
+def test_supabase_hs256_token_checks_issuer_audience_and_expiry():
+    verifier = _verifier()
+    claims = _claims()
+    assert verifier.verify(make_jwt(claims))["sub"] == claims["sub"]
+
+    for bad in (_claims(iss="https://other.supabase.co/auth/v1"), _claims(aud="anon"),
+                _claims(exp=int(time.time()) - 10), _claims(exp=None)):
+        with pytest.raises(InvalidToken):
+            verifier.verify(make_jwt(bad))
+    with pytest.raises(InvalidToken):
+        verifier.verify(make_jwt(_claims(), secret="not-the-project-secret"))
+    assert verifier.rejected == 5
+
+
+def test_legacy_app_tokens_still_verify():
+    verifier = _verifier()
+    token = jwt.encode({"sub": "u1", "email": "u1@example.com"}, LEGACY_SECRET, algorithm="HS256")
+    assert verifier.verify(token)["sub"] == "u1"
+    expired = jwt.encode({"sub": "u1", "exp": int(time.time()) - 10}, LEGACY_SECRET, algorithm="HS256")
+    with pytest.raises(InvalidToken):
+        verifier.verify(expired)
+
+
+def test_verified_tokens_are_cached_until_exp():
+    verifier = _verifier()
+    token = make_jwt(_claims())
+    first = verifier.verify(token)
+    assert verifier.verify(token) is first
+    assert (verifier.hits, verifier.misses) == (1, 1)
+
+    # Once past exp the cached entry is ignored and the token is re-checked
+    for digest, (_, claims, kid) in list(verifier._entries.items()):
+        verifier._entries[digest] = (time.time() - 1, claims, kid)
+    verifier.verify(token)
+    assert verifier.misses == 2
+
+    small = _verifier(max_entries=2)
+    for _ in range(3):
+        small.verify(make_jwt(_claims()))
+    assert len(small._entries) == 2
+
+
+@pytest.fixture
+def jwks_server():
+    server = FakeServer(SupabaseHandler, jwks={"keys": []}).start()
+    yield server
+    server.stop()
+
+
+def _ec_key(kid):
+    ec = pytest.importorskip("cryptography.hazmat.primitives.asymmetric.ec")
+    private = ec.generate_private_key(ec.SECP256R1())
+    public = jwt.algorithms.ECAlgorithm.to_jwk(private.public_key(), as_dict=True)
+    public.update({"kid": kid, "alg": "ES256", "use": "sig"})
+    return private, public
+
+
+def test_jwks_keys_verify_and_rotate(jwks_server):
+    old_private, old_public = _ec_key("old")
+    new_private, new_public = _ec_key("new")
+    jwks_server.httpd.jwks = {"keys": [old_public]}
+    keys = JWKSKeys(jwks_server.url + "/auth/v1/.well-known/jwks.json",
+                    lambda url: httpx.get(url).json(), min_refetch=0)
+    verifier = _verifier(jwks=keys)
+
+    old_token = jwt.encode(_claims(), old_private, algorithm="ES256", headers={"kid": "old"})
+    assert verifier.verify(old_token)["iss"] == ISSUER
+    assert jwks_server.httpd.jwks_requests == 1
+
+    # Rotation: an unseen kid triggers a refetch that picks up the new key
+    jwks_server.httpd.jwks = {"keys": [new_public]}
+    new_token = jwt.encode(_claims(), new_private, algorithm="ES256", headers={"kid": "new"})
+    assert verifier.verify(new_token)["aud"] == "authenticated"
+    assert jwks_server.httpd.jwks_requests == 2
+
+    # The retired key no longer verifies fresh tokens, nor ones it cached
+    with pytest.raises(InvalidToken):
+        verifier.verify(jwt.encode(_claims(), old_private, algorithm="ES256", headers={"kid": "old"}))
+    with pytest.raises(InvalidToken):
+        verifier.verify(old_token)
+    assert verifier.verify(new_token)["aud"] == "authenticated"
+    assert verifier.hits == 1
+
+
+def test_dev_fallback_secret_does_not_verify_legacy_tokens():
+    # The secret is read at import, so import app afresh without one
+    script = ("import app, jwt; from auth_tokens import InvalidToken\n"
+              "token = jwt.encode({'sub': 'u1'}, 'dev-secret', algorithm='HS256')\n"
+              "try:\n    app.token_verifier.verify(token)\nexcept InvalidToken:\n    print('rejected')\n")
+    env = {k: v for k, v in os.environ.items() if k not in ("SECRET_KEY", "APP_SECRET")}
+    result = subprocess.run([sys.executable, "-c", script], env=env, cwd=os.path.dirname(os.path.abspath(__file__)),
+                            capture_output=True, text=True, timeout=60)
+    assert result.returncode == 0, result.stderr
+    assert result.stdout.split()[-1:] == ["rejected"]
+
+
+def test_unknown_kids_refetch_at_most_once_per_interval(jwks_server):
+    private, _ = _ec_key("stranger")
+    keys = JWKSKeys(jwks_server.url + "/auth/v1/.well-known/jwks.json",
+                    lambda url: httpx.get(url).json(), min_refetch=60)
+    verifier = _verifier(jwks=keys)
+    for _ in range(5):
+        with pytest.raises(InvalidToken):
+            verifier.verify(jwt.encode(_claims(), private, algorithm="ES256", headers={"kid": "stranger"}))
+    assert jwks_server.httpd.jwks_requests == 1
+
+
+def test_api_accepts_supabase_tokens(monkeypatch, make_user):
+    monkeypatch.setattr(app_module.token_verifier, "secret", FAKE_JWT_SECRET)
+    # The row only; the request carries a Supabase token instead of make_user's
+    user_id, email, _ = make_user("agency")
+    client = app_module.app.test_client()
+
+    token = make_jwt(_claims(sub=user_id, email=email, iss=app_module.SUPABASE_JWT_ISSUER))
+    response = client.get("/batch-jobs/missing", headers={"Authorization": f"Bearer {token}"})
+    assert response.status_code == 404
+
+    expired = make_jwt(_claims(sub=user_id, iss=app_module.SUPABASE_JWT_ISSUER, exp=int(time.time()) - 5))
+    response = client.get("/batch-jobs/missing", headers={"Authorization": f"Bearer {expired}"})
+    assert response.status_code == 401
+    assert client.get("/batch-jobs/missing", headers={"Authorization": "Bearer"}).status_code == 401
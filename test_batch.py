@@ -0,0 +1,85 @@
+#!/usr/bin/env python3
+"""Agency batch generation: parsing, quota reservation, NDJSON streaming and async jobs."""
+import json
+import time
+from types import SimpleNamespace
+
+import pytest
+
+import app as app_module
+from batch import parse_batch
+
+
+def test_parse_json_array_object_and_jsonl():
+    assert [i["prompt"] for i in parse_batch(b'["a", {"id": "x", "prompt": "b"}]', "application/json")] == ["a", "b"]
+    assert parse_batch(b'{"prompts": ["a"]}', "application/json")[0]["index"] == 0
+    jsonl = parse_batch(b'"a"\n\n{"id": 7, "prompt": "b"}\n', "application/x-ndjson")
+    assert [(i["index"], i["id"], i["prompt"]) for i in jsonl] == [(0, None, "a"), (1, 7, "b")]
+    with pytest.raises(ValueError):
+        parse_batch(b'{"prompt": "a"}', "application/json")
+    with pytest.raises(ValueError):
+        parse_batch(b'"a"\nnot json\n', "application/x-ndjson")
+
+
+@pytest.fixture
+def fake_openai(monkeypatch):
+    def fake(model, prompt, **kwargs):
+        if prompt == "fail":
+            raise RuntimeError("upstream exploded")
+        time.sleep(0.05 if prompt == "slow" else 0)
+        return SimpleNamespace(choices=[SimpleNamespace(message=SimpleNamespace(content=prompt.upper()))])
+    monkeypatch.setattr(app_module, "_chat_completion", fake)
+
+
+def test_batch_streams_ndjson_with_per_item_errors(fake_openai, make_user):
+    _, email, headers = make_user("agency")
+    body = json.dumps(["slow", "fail", {"id": "c", "prompt": "fast"}, ""])
+    response = app_module.app.test_client().post(
+        "/generate-batch?save=0", data=body, headers={**headers, "Content-Type": "application/json"})
+    assert response.mimetype == "application/x-ndjson"
+    lines = [json.loads(line) for line in response.data.decode().splitlines()]
+
+    by_index = {line["index"]: line for line in lines if "index" in line}
+    assert by_index[0]["output"] == "SLOW"
+    assert by_index[1]["error"] == "upstream exploded"
+    assert by_index[2]["id"] == "c" and by_index[2]["output"] == "FAST"
+    assert by_index[3]["error"] == "Missing prompt"
+    # Completion order: the slow item comes back after the fast one
+    order = [line["index"] for line in lines if "output" in line]
+    assert order == [2, 0]
+    assert lines[-1] == {"done": True, "succeeded": 2, "failed": 1, "tier": "agency", "used": 2, "limit": 200}
+    assert app_module.usage_meter.used(email) == 2
+
+
+def test_batch_quota_is_all_or_nothing(fake_openai, make_user):
+    _, email, headers = make_user("agency", used=198)
+    response = app_module.app.test_client().post("/generate-batch", json=["a", "b", "c"], headers=headers)
+    assert response.status_code == 403
+    assert response.get_json()["remaining"] == 2
+    assert app_module.usage_meter.used(email) == 198
+
+
+def test_batch_requires_agency(fake_openai, make_user):
+    _, _, headers = make_user("pro")
+    assert app_module.app.test_client().post("/generate-batch", json=["a"], headers=headers).status_code == 403
+
+
+def test_async_batch_job_reports_results(fake_openai, make_user):
+    _, _, headers = make_user("agency")
+    client = app_module.app.test_client()
+    accepted = client.post("/generate-batch?async=1&save=0", json=["one", "fail", "two"], headers=headers)
+    assert accepted.status_code == 202
+    status_url = accepted.get_json()["status_url"]
+
+    deadline = time.time() + 5
+    while True:
+        job = client.get(status_url, headers=headers).get_json()
+        if job["status"] == "done" or time.time() > deadline:
+            break
+        time.sleep(0.05)
+    assert job["status"] == "done"
+    assert (job["succeeded"], job["failed"]) == (2, 1)
+    assert [line.get("output") for line in job["results"]] == ["ONE", None, "TWO"]
+
+    _, _, other_headers = make_user("agency")
+    assert client.get(status_url, headers=other_headers).status_code == 404
@@ -0,0 +1,27 @@
+#!/usr/bin/env python3
+"""The offline benchmark harnesses run from a clean shell (no DATABASE_URL) end to end."""
+import os
+import subprocess
+import sys
+
+import pytest
+
+REPO_ROOT = os.path.dirname(os.path.abspath(__file__))
+
+
+def _run(module, *args):
+    # Only what a developer's shell would have; conftest's test settings must not leak in
+    env = {k: v for k, v in os.environ.items() if k in ("PATH", "HOME", "LANG", "PYENV_VERSION", "VIRTUAL_ENV")}
+    return subprocess.run([sys.executable, "-m", module, *args], cwd=REPO_ROOT, env=env,
+                          capture_output=True, text=True, timeout=300)
+
+
+@pytest.mark.parametrize("module, args, expect", [
+    ("benchmarks.loadtest", ["--configs", "sync:1", "--duration", "1", "--warmup", "0",
+                             "--users", "2", "--concurrency", "2", "--mix", "pages"], "req/s overall"),
+    ("benchmarks.startup", ["--runs", "1", "--workers", "1"], "first response after")
+])
+def test_harness_runs_offline(module, args, expect):
+    result = _run(module, *args)
+    assert result.returncode == 0, result.stderr[-2000:]
+    assert expect in result.stdout
@@ -0,0 +1,115 @@
+#!/usr/bin/env python3
+"""Cache stores: encoding, the shared-memory table across processes, and the caches built on it."""
+import multiprocessing
+import time
+from datetime import datetime, timezone
+
+import pytest
+
+from cachestore import LocalStore, SharedMemoryStore, decode_value, encode_value
+from entitlements import Entitlement, EntitlementCache, decode_entitlement, encode_entitlement
+from response_cache import ResponseCache
+
+
+@pytest.fixture
+def path(tmp_path):
+    return str(tmp_path / "cache.bin")
+
+
+def test_values_round_trip_compactly():
+    for value in ("caption ✨", b"\x00\xffraw", {"tier": "pro", "used": 3}, [1, None], "x" * 5000):
+        assert decode_value(encode_value(value)) == value
+    # Large repetitive values are stored compressed
+    assert len(encode_value("x" * 5000)) < 100
+    assert encode_value("short") == b"\x01short"
+
+
+def test_set_get_delete_and_expiry(path):
+    store = SharedMemoryStore(path, max_entries=64, ttl=30, slot_size=256)
+    assert store.set("a", "hello")
+    assert store.get("a") == "hello"
+    assert store.get("missing") is None
+    store.delete("a")
+    assert store.get("a") is None
+
+    store.set("brief", "gone soon", ttl=-1)
+    assert store.get("brief") is None
+    assert not store.set("big", bytes(range(256)) * 4)
+    assert store.stats()["too_large"] == 1
+
+
+def test_least_recently_used_slot_is_replaced(path, monkeypatch):
+    monkeypatch.setattr("cachestore.TOUCH_INTERVAL", 0.0)
+    store = SharedMemoryStore(path, max_entries=2, ways=2, slot_size=128)
+    store.set("a", 1)
+    time.sleep(0.01)
+    store.set("b", 2)
+    time.sleep(0.01)
+    assert store.get("a") == 1  # a is now more recent than b
+    store.set("c", 3)
+    assert (store.get("a"), store.get("b"), store.get("c")) == (1, None, 3)
+    assert store.stats()["evictions"] == 1
+
+
+def test_layout_change_starts_empty(path):
+    SharedMemoryStore(path, max_entries=64, slot_size=256).set("k", "v")
+    assert SharedMemoryStore(path, max_entries=64, slot_size=256).get("k") == "v"
+    assert SharedMemoryStore(path, max_entries=128, slot_size=256).get("k") is None
+
+
+def _writer(path, rounds):
+    store = SharedMemoryStore(path, max_entries=64, slot_size=512)
+    for i in range(rounds):
+        # Values of different lengths, so a torn read would not decode to either
+        store.set("hot", "a" * 50 if i % 2 else "b" * 300)
+        store.set(f"k{i % 20}", i)
+
+
+def test_readers_never_see_torn_writes_from_other_processes(path):
+    store = SharedMemoryStore(path, max_entries=64, slot_size=512)
+    store.set("hot", "a" * 50)
+    context = multiprocessing.get_context("fork")
+    writers = [context.Process(target=_writer, args=(path, 3000)) for _ in range(2)]
+    for w in writers:
+        w.start()
+    seen = set()
+    while any(w.is_alive() for w in writers):
+        seen.add(store.get("hot"))
+    for w in writers:
+        w.join()
+        assert w.exitcode == 0
+    assert seen <= {"a" * 50, "b" * 300}
+    assert store.get("k19") is not None
+
+
+def test_entitlement_changes_are_seen_by_every_worker(path):
+    def worker():
+        store = SharedMemoryStore(path, max_entries=100, slot_size=512,
+                                  dumps=encode_entitlement, loads=decode_entitlement)
+        return EntitlementCache(store=store)
+
+    first, second = worker(), worker()
+    trial = datetime(2026, 10, 20, tzinfo=timezone.utc)
+    first.put(Entitlement("sub", "id", "a@example.com", "pro", 4, trial))
+    loads = []
+    assert second.get("sub", lambda: loads.append(1)) == Entitlement("sub", "id", "a@example.com", "pro", 4, trial)
+    assert not loads
+    first.invalidate("sub")
+    assert second.get("sub", lambda: None) is None
+    assert second.stats()["backend"] == "shared"
+
+    local = EntitlementCache(max_entries=1, ttl=30)
+    assert isinstance(local.store, LocalStore)
+
+
+def test_response_computed_by_one_worker_is_a_hit_for_another(path):
+    first = ResponseCache(store=SharedMemoryStore(path, max_entries=16, slot_size=1024))
+    second = ResponseCache(store=SharedMemoryStore(path, max_entries=16, slot_size=1024))
+    calls = []
+    assert first.get_or_compute("key", lambda: calls.append(1) or "output") == "output"
+    assert second.get_or_compute("key", lambda: calls.append(1) or "output") == "output"
+    assert calls == [1]
+    assert second.stats()["shared_hits"] == 1
+    # Later reads are served from the worker's own copy
+    assert second.get("key") == "output"
+    assert second.store.stats()["hits"] == 1
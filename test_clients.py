@@ -0,0 +1,100 @@
+#!/usr/bin/env python3
+"""LazyClient: one build per process, a fresh one after fork, and a single build under concurrent first use."""
+import multiprocessing
+import os
+import threading
+import time
+import uuid
+
+import app as app_module
+from clients import LazyClient
+
+
+class Built:
+    def __init__(self):
+        self.pid = os.getpid()
+
+    def ping(self):
+        return "pong"
+
+
+def test_builds_once_per_process_and_delegates():
+    builds = []
+    lazy = LazyClient(lambda: builds.append(1) or Built(), "fake")
+    assert not lazy.loaded
+    assert "not loaded" in repr(lazy)
+
+    assert lazy.ping() == "pong"
+    assert lazy.get() is lazy.get()
+    assert lazy.loaded
+    assert builds == [1]
+
+
+def test_unavailable_client_is_falsy_and_raises_on_use():
+    lazy = LazyClient(lambda: None, "fake")
+    assert not lazy
+    try:
+        lazy.ping()
+    except RuntimeError as e:
+        assert "fake is not available" in str(e)
+    else:
+        raise AssertionError("expected RuntimeError")
+
+
+def _child(lazy, parent_client, queue):
+    client = lazy.get()
+    queue.put((client.pid == os.getpid(), id(client) != parent_client, lazy.get() is client))
+
+
+def test_forked_child_builds_its_own_client():
+    lazy = LazyClient(Built, "fake")
+    parent = lazy.get()
+    ctx = multiprocessing.get_context("fork")
+    queue = ctx.Queue()
+    process = ctx.Process(target=_child, args=(lazy, id(parent), queue))
+    process.start()
+    assert queue.get(timeout=30) == (True, True, True)
+    process.join()
+    # The parent keeps its own
+    assert lazy.get() is parent
+
+
+def test_concurrent_first_use_builds_once():
+    builds = []
+
+    def slow_build():
+        builds.append(1)
+        time.sleep(0.05)
+        return Built()
+
+    lazy = LazyClient(slow_build, "fake")
+    start = threading.Barrier(16)
+    seen = []
+
+    def use():
+        start.wait()
+        seen.append(lazy.get())
+
+    threads = [threading.Thread(target=use) for _ in range(16)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert builds == [1]
+    assert len({id(client) for client in seen}) == 1
+
+
+def test_async_signup_does_not_build_the_sync_client(monkeypatch):
+    sync_client = LazyClient(lambda: 1 / 0, "supabase")
+    monkeypatch.setattr(app_module, "supabase", sync_client)
+    monkeypatch.setattr(app_module, "ASYNC_MODE", True)
+    monkeypatch.setattr(app_module.runtime, "resource", lambda name, factory: object())
+    monkeypatch.setattr(app_module.outbox, "enqueue", lambda *a, **k: True)
+    user_id = str(uuid.uuid4())
+    monkeypatch.setattr(app_module, "_supabase_call", lambda *a, **k: {"user": {"id": user_id}})
+
+    response = app_module.app.test_client().post(
+        "/signup", data={"email": f"{user_id}@example.com", "password": "secret123"})
+    assert response.status_code == 302
+    assert response.headers["Location"].endswith("/signup-success")
+    assert not sync_client.loaded
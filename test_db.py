@@ -0,0 +1,44 @@
+#!/usr/bin/env python3
+"""`python db.py migrate`: creates the schema, adds newer columns, and is safe to re-run."""
+from sqlalchemy import create_engine, inspect, text
+
+import db
+
+
+def test_migrate_adds_new_columns_and_can_run_twice(tmp_path, monkeypatch):
+    engine = create_engine(f"sqlite:///{tmp_path / 'old.db'}")
+    monkeypatch.setattr(db, "engine", engine)
+    # A users table from before tokens_used existed
+    with engine.begin() as conn:
+        conn.execute(text("CREATE TABLE users (id VARCHAR PRIMARY KEY, email VARCHAR NOT NULL UNIQUE, "
+                          "tier VARCHAR NOT NULL, used INTEGER NOT NULL)"))
+        conn.execute(text("INSERT INTO users (id, email, tier, used) VALUES ('u1', 'a@example.com', 'free', 2)"))
+
+    db.migrate()
+    db.migrate()
+
+    inspector = inspect(engine)
+    assert "tokens_used" in {c["name"] for c in inspector.get_columns("users")}
+    assert {"generations", "generations_fts"} <= set(inspector.get_table_names())
+    with engine.connect() as conn:
+        assert conn.execute(text("SELECT used, tokens_used FROM users")).one() == (2, 0)
+
+
+def test_migrate_backfills_used_on_a_users_table_without_it(tmp_path, monkeypatch):
+    engine = create_engine(f"sqlite:///{tmp_path / 'supabase.db'}")
+    monkeypatch.setattr(db, "engine", engine)
+    # The Supabase users table as it was before usage moved into it
+    with engine.begin() as conn:
+        conn.execute(text("CREATE TABLE users (id VARCHAR PRIMARY KEY, email VARCHAR NOT NULL UNIQUE, "
+                          "tier VARCHAR NOT NULL, trial_ends_at TIMESTAMP)"))
+        conn.execute(text("INSERT INTO users (id, email, tier) VALUES ('u1', 'a@x', 'free')"))
+
+    db.migrate()
+
+    with engine.connect() as conn:
+        assert conn.execute(text("SELECT used, tokens_used FROM users")).one() == (0, 0)
+    assert db.reserve_usage("a@x", 1, 1, bind=engine) == 1
+    assert db.reserve_usage("a@x", 1, 1, bind=engine) is None
+    db.refund_usage("a@x", bind=engine)
+    assert db.current_usage("a@x", bind=engine) == 0
+
@@ -0,0 +1,83 @@
+#!/usr/bin/env python3
+"""Entitlement cache: TTL, invalidation on usage and tier changes, and the session fast path."""
+import time
+import uuid
+from datetime import datetime, timedelta, timezone
+from types import SimpleNamespace
+
+import app as app_module
+from entitlements import Entitlement, EntitlementCache
+
+
+def _entitlement(tier="pro", used=0, subject="sub"):
+    return Entitlement(subject, "id", "a@example.com", tier, used, None)
+
+
+def test_cached_until_ttl_then_reloaded():
+    cache = EntitlementCache(ttl=0.05)
+    loads = []
+
+    def load():
+        loads.append(1)
+        return _entitlement(used=len(loads))
+
+    assert cache.get("sub", load).used == 1
+    assert cache.get("sub", load).used == 1
+    time.sleep(0.06)
+    assert cache.get("sub", load).used == 2
+    assert cache.stats()["hits"] == 1
+
+
+def test_unknown_user_is_not_cached():
+    cache = EntitlementCache()
+    assert cache.get("sub", lambda: None) is None
+    assert cache.get("sub", lambda: _entitlement()) == _entitlement()
+
+
+def _user(make_user, tier="pro"):
+    user_id, _, headers = make_user(tier, trial_ends_at=datetime.utcnow() + timedelta(days=3))
+    return user_id, headers
+
+
+def test_generate_writes_new_usage_through_the_cache(monkeypatch, make_user):
+    monkeypatch.setattr(app_module, "_chat_completion", lambda model, prompt, **kwargs: SimpleNamespace(
+        choices=[SimpleNamespace(message=SimpleNamespace(content="ok"))]))
+    user_id, headers = _user(make_user)
+    client = app_module.app.test_client()
+    client.post("/generate", json={"prompt": "one", "save": False}, headers=headers)
+    assert app_module.entitlements.store.get(user_id).used == 1
+    assert client.post("/generate", json={"prompt": "two", "save": False}, headers=headers).get_json()["used"] == 2
+
+
+def test_tier_change_from_stripe_invalidates_the_cached_entry(make_user):
+    user_id, headers = _user(make_user, "free")
+    client = app_module.app.test_client()
+    client.get("/history", headers=headers)
+    assert app_module.entitlements.store.get(user_id).tier == "free"
+
+    app_module._apply_stripe_events([(1, {
+        "id": f"evt_{user_id}", "type": "checkout.session.completed", "created": int(time.time()),
+        "data": {"object": {"mode": "subscription", "client_reference_id": user_id,
+                            "customer": f"cus_{user_id}", "metadata": {"tier": "pro"}}}
+    })])
+    assert app_module.entitlements.store.get(user_id) is None
+    assert client.get("/history", headers=headers).status_code == 200
+    assert app_module.entitlements.store.get(user_id).tier == "pro"
+
+
+def test_session_helpers_read_the_cached_entitlement():
+    subject = str(uuid.uuid4())
+    with app_module.app.test_request_context():
+        assert not app_module.tier_allows(None, "can_save")
+        assert not app_module.is_premium()
+
+        # The session still says free; the cached entitlement (e.g. after a webhook) wins
+        app_module.session["user"] = {"id": subject, "email": "s@example.com", "tier": "free"}
+        app_module.entitlements.put(_entitlement("pro", subject=subject))
+        assert app_module.tier_allows(None, "can_save")
+        assert app_module.is_premium()
+
+        trial = datetime.now(timezone.utc) + timedelta(days=1)
+        app_module.entitlements.put(_entitlement("free", subject=subject)._replace(trial_ends_at=trial))
+        assert not app_module.tier_allows(None, "can_save")
+        assert app_module.is_premium()
@@ -0,0 +1,101 @@
+#!/usr/bin/env python3
+"""Saved generations: batched writes, keyset pages and full-text search on SQLite."""
+from datetime import datetime, timedelta, timezone
+from types import SimpleNamespace
+import time
+
+import pytest
+from sqlalchemy import create_engine, select
+
+import app as app_module
+from db import Base, Generation
+from history import init_search, list_generations, save_generations
+
+START = datetime(2026, 1, 1, tzinfo=timezone.utc)
+
+
+def _row(user_id, i, prompt=None, output=None):
+    return {
+        "key": f"{user_id}-{i}",
+        "user_id": user_id,
+        # Several rows share a timestamp so the id tiebreak matters
+        "created_at": (START + timedelta(seconds=i // 3)).isoformat(),
+        "model": "gpt-test",
+        "prompt": prompt or f"caption number {i}",
+        "output": output or f"output text {i} " * 20,
+        "prompt_tokens": 3,
+        "completion_tokens": 60
+    }
+
+
+@pytest.fixture
+def engine(tmp_path):
+    engine = create_engine(f"sqlite:///{tmp_path / 'history.db'}")
+    Base.metadata.create_all(engine)
+    init_search(engine)
+    return engine
+
+
+def test_keyset_pages_cover_everything_once_newest_first(engine):
+    save_generations([_row("u1", i) for i in range(95)], engine)
+    save_generations([_row("u2", i) for i in range(5)], engine)
+
+    seen, cursor = [], None
+    while True:
+        items, cursor = list_generations(engine, "u1", limit=20, cursor=cursor)
+        seen.extend(item["id"] for item in items)
+        if cursor is None:
+            break
+    assert seen == [f"u1-{i}" for i in reversed(range(95))]
+
+
+def test_outputs_are_compressed_and_retries_are_skipped(engine):
+    rows = [_row("u1", i) for i in range(3)]
+    assert save_generations(rows, engine) == 3
+    assert save_generations(rows, engine) == 0
+    with engine.connect() as conn:
+        blob = conn.execute(select(Generation.output).limit(1)).scalar_one()
+    assert len(blob) < len(rows[0]["output"])
+    items, _ = list_generations(engine, "u1")
+    assert len(items) == 3
+    assert items[-1]["output"] == rows[0]["output"]
+
+
+def test_search_matches_own_generations_only(engine):
+    save_generations([
+        _row("u1", 0, prompt="Instagram caption for a coffee shop", output="Brewing happiness daily"),
+        _row("u1", 1, prompt="Yoga retreat tagline", output="Stretch into calm"),
+        _row("u2", 2, prompt="Coffee roastery slogan", output="Roasted fresh")
+    ], engine)
+    items, _ = list_generations(engine, "u1", query="coffee")
+    assert [i["id"] for i in items] == ["u1-0"]
+    # Porter stemming, and FTS operators in user input are treated as words
+    assert [i["id"] for i in list_generations(engine, "u1", query="stretching")[0]] == ["u1-1"]
+    assert list_generations(engine, "u1", query='NOT "* (')[0] == []
+
+
+def test_bad_cursor_is_rejected(engine):
+    with pytest.raises(ValueError):
+        list_generations(engine, "u1", cursor="not-a-cursor")
+
+
+def test_generate_saves_for_can_save_tiers(monkeypatch, make_user):
+    def fake(model, prompt, **kwargs):
+        return SimpleNamespace(choices=[SimpleNamespace(message=SimpleNamespace(content="saved output"))])
+    monkeypatch.setattr(app_module, "_chat_completion", fake)
+
+    user_id, _, headers = make_user("pro")
+    client = app_module.app.test_client()
+
+    generated = client.post("/generate", json={"prompt": "a tagline for tea"}, headers=headers).get_json()
+    # The outbox worker thread may hold the job; wait for the write either way
+    deadline = time.time() + 5
+    while True:
+        app_module.outbox.process_once()
+        history = client.get("/history?q=tea", headers=headers).get_json()
+        if history["items"] or time.time() > deadline:
+            break
+        time.sleep(0.05)
+    assert [item["id"] for item in history["items"]] == [generated["generation_id"]]
+    assert history["items"][0]["output"] == "saved output"
+    assert client.get("/history?cursor=bogus", headers=headers).status_code == 400
@@ -0,0 +1,195 @@
+#!/usr/bin/env python3
+"""Idempotency-Key on /generate and checkout: replay, joining a running duplicate, release on failure."""
+import sqlite3
+import threading
+import time
+import uuid
+from types import SimpleNamespace
+
+import pytest
+from openai import OpenAI
+
+import app as app_module
+from benchmarks.fakes import FakeServer, OpenAIHandler
+from idempotency import MISMATCH, NEW, REPLAY, RUNNING, IdempotencyStore
+from resilience import Resilience
+
+
+@pytest.fixture
+def fake(monkeypatch):
+    server = FakeServer(OpenAIHandler, latency=0.0, token_delay=0.0, tokens=3, error_rate=0.0).start()
+    monkeypatch.setattr(app_module, "client", OpenAI(api_key="sk-fake", base_url=server.url + "/v1", max_retries=0))
+    monkeypatch.setattr(app_module, "openai_resilience", Resilience())
+    yield server
+    server.stop()
+
+
+@pytest.fixture
+def headers(make_user):
+    _, _, auth = make_user("pro")
+    return {**auth, "Idempotency-Key": uuid.uuid4().hex}
+
+
+def _generate(headers, **body):
+    return app_module.app.test_client().post(
+        "/generate", json={"prompt": "hello", "save": False, **body}, headers=headers)
+
+
+def test_store_states(tmp_path):
+    store = IdempotencyStore(str(tmp_path / "idem.db"), lease=60)
+    assert store.begin("k", "fp") == (NEW, None)
+    assert store.begin("k", "fp") == (RUNNING, None)
+    assert store.begin("k", "other") == (MISMATCH, None)
+    store.complete("k", 201, {"Content-Type": "text/plain"}, b"made")
+    state, stored = store.begin("k", "fp")
+    assert state == REPLAY
+    assert (stored.status, stored.headers, stored.body) == (201, {"Content-Type": "text/plain"}, b"made")
+
+    # A released claim runs again; an abandoned one is taken over after the lease
+    assert store.begin("r", "fp")[0] == NEW
+    store.release("r")
+    assert store.begin("r", "fp")[0] == NEW
+    short = IdempotencyStore(str(tmp_path / "idem.db"), lease=0)
+    assert short.begin("abandoned", "fp")[0] == NEW
+    assert short.begin("abandoned", "fp")[0] == NEW
+
+
+def _hold_then(action, delay=0.3):
+    def run():
+        time.sleep(delay)
+        action()
+    thread = threading.Thread(target=run)
+    thread.start()
+    return thread
+
+
+def test_other_worker_polls_without_taking_the_write_lock(tmp_path, monkeypatch):
+    path = str(tmp_path / "idem.db")
+    original, other = IdempotencyStore(path), IdempotencyStore(path, poll_interval=0.01)
+    assert original.begin("k", "fp")[0] == NEW
+    claims = []
+    begin = other.begin
+    monkeypatch.setattr(other, "begin", lambda *a: claims.append(a) or begin(*a))
+
+    thread = _hold_then(lambda: original.complete("k", 200, {}, b"done"))
+    state, stored = other.wait("k", "fp", timeout=5)
+    thread.join()
+    assert (state, stored.body) == (REPLAY, b"done")
+    assert claims == []
+
+    # Once the original gives up, one waiter takes over the key
+    assert original.begin("r", "fp")[0] == NEW
+    thread = _hold_then(lambda: original.release("r"))
+    assert other.wait("r", "fp", timeout=5) == (NEW, None)
+    thread.join()
+    assert claims == [("r", "fp")]
+
+
+def test_completed_duplicate_replays_without_second_call(fake, headers):
+    first = _generate(headers)
+    second = _generate(headers)
+    assert first.status_code == second.status_code == 200
+    assert second.get_json() == first.get_json()
+    assert second.headers["Idempotent-Replayed"] == "true"
+    assert fake.httpd.requests == 1
+
+    # Only one use was counted for the pair
+    third = _generate({**headers, "Idempotency-Key": uuid.uuid4().hex})
+    assert third.get_json()["used"] == first.get_json()["used"] + 1
+
+
+def test_running_duplicate_waits_for_the_original(fake, headers):
+    fake.httpd.latency = 0.3
+    joined = app_module.idempotency.joined
+    results = []
+    threads = [threading.Thread(target=lambda: results.append(_generate(headers))) for _ in range(2)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert [r.status_code for r in results] == [200, 200]
+    assert results[0].get_json() == results[1].get_json()
+    assert fake.httpd.requests == 1
+    assert app_module.idempotency.joined == joined + 1
+
+
+def test_key_reused_for_another_request_is_rejected(fake, headers):
+    assert _generate(headers).status_code == 200
+    assert _generate(headers, prompt="something else").status_code == 422
+    assert _generate({**headers, "Idempotency-Key": "x" * 256}).status_code == 400
+
+
+def test_failed_request_releases_the_key(fake, headers):
+    fake.httpd.error_rate = 1.0
+    assert _generate(headers).status_code == 502
+    fake.httpd.error_rate = 0.0
+    retry = _generate(headers)
+    assert retry.status_code == 200
+    assert "Idempotent-Replayed" not in retry.headers
+
+
+def test_streamed_response_is_replayed(fake, headers):
+    headers = {**headers, "Accept": "text/event-stream"}
+    first = _generate(headers)
+    body = first.get_data()
+    second = _generate(headers)
+    assert second.get_data() == body
+    assert second.headers["Content-Type"].startswith("text/event-stream")
+    assert fake.httpd.requests == 1
+
+
+def test_stream_never_read_releases_the_key(fake, headers):
+    headers = {**headers, "Accept": "text/event-stream"}
+    # The test client always reads the first chunk, so dispatch by hand
+    with app_module.app.test_request_context(
+            "/generate", method="POST", json={"prompt": "hello", "save": False}, headers=headers):
+        response = app_module.app.full_dispatch_request()
+    response.close()
+    assert app_module.idempotency.stats()["running"] == 0
+
+    retry = _generate(headers)
+    assert retry.status_code == 200
+    assert "Idempotent-Replayed" not in retry.headers
+
+
+def test_checkout_reuses_the_stripe_session(monkeypatch):
+    calls = []
+
+    def create(**params):
+        calls.append(params)
+        return SimpleNamespace(url=f"https://checkout.stripe.test/{len(calls)}")
+
+    monkeypatch.setattr(app_module, "_create_checkout_session", create)
+    client = app_module.app.test_client()
+    form = {"idempotency_key": uuid.uuid4().hex}
+    first = client.post("/create-checkout-session", data=form)
+    second = client.post("/create-checkout-session", data=form)
+    assert first.status_code == second.status_code == 303
+    assert second.headers["Location"] == first.headers["Location"]
+    assert len(calls) == 1
+    assert calls[0]["idempotency_key"]
+
+    # Without a key every POST still makes a session
+    client.post("/create-checkout-session")
+    assert len(calls) == 2
+
+
+def test_prune_trims_in_batches_using_indexes(tmp_path):
+    store = IdempotencyStore(str(tmp_path / "idem.db"), ttl=60, max_entries=5, prune_batch=2)
+    conn = store._connect()
+    now = time.time()
+    with conn:
+        conn.executemany(
+            "INSERT INTO idempotency (key, fingerprint, state, created_at, expires_at) VALUES (?, 'fp', ?, ?, ?)",
+            [(f"k{i}", "done" if i % 4 else "running", now + i, now + (-1 if i < 3 else 60)) for i in range(12)])
+        plan = " ".join(str(row) for row in conn.execute(
+            "EXPLAIN QUERY PLAN SELECT created_at FROM idempotency ORDER BY created_at DESC LIMIT 1 OFFSET 5"))
+    conn.close()
+    assert "idempotency_created" in plan
+
+    store.prune()
+    # k0-k2 expired; of the rest only the 5 newest stay
+    assert sorted(int(key[1:]) for key, in sqlite3.connect(store.path).execute(
+        "SELECT key FROM idempotency")) == [7, 8, 9, 10, 11]
+    assert store.stats()["done"] == 4
+    assert store.stats()["running"] == 1
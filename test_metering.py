@@ -0,0 +1,158 @@
+#!/usr/bin/env python3
+"""Usage metering under concurrency, against a local SQLite stand-in for the users table."""
+import multiprocessing
+import threading
+
+from sqlalchemy import create_engine, select, update
+
+from db import Base, User, apply_usage
+from metering import UsageMeter, WriteBehindBuffer
+
+
+def _make_db(tmp_path, users):
+    engine = create_engine(f"sqlite:///{tmp_path / 'usage.db'}",
+                           connect_args={"check_same_thread": False})
+    Base.metadata.create_all(engine)
+    with engine.begin() as conn:
+        conn.execute(User.__table__.insert(), [
+            {"id": email, "email": email, "tier": "pro", "used": used}
+            for email, used in users.items()
+        ])
+    return engine
+
+
+def _used(engine, email):
+    with engine.connect() as conn:
+        return conn.execute(select(User.used).where(User.email == email)).scalar_one()
+
+
+def _hammer(n_threads, fn):
+    barrier = threading.Barrier(n_threads)
+
+    def run():
+        barrier.wait()
+        fn()
+
+    threads = [threading.Thread(target=run) for _ in range(n_threads)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+
+def test_concurrent_reservations_never_exceed_limit(tmp_path):
+    engine = _make_db(tmp_path, {"a@x.io": 5})
+    meter = UsageMeter(WriteBehindBuffer(lambda b: apply_usage(b, bind=engine), interval=60), bind=engine)
+    granted = []
+
+    def attempt():
+        used = meter.reserve("a@x.io", limit=20)
+        if used is not None:
+            granted.append(used)
+            meter.commit("a@x.io", tokens_used=10)
+
+    _hammer(50, attempt)
+    meter.buffer.flush()
+
+    assert len(granted) == 15
+    assert sorted(granted) == list(range(6, 21))
+    assert _used(engine, "a@x.io") == 20
+
+
+def _reserve_in_process(url, barrier, results):
+    meter = UsageMeter(WriteBehindBuffer(lambda b: None, interval=60), bind=create_engine(url))
+    barrier.wait()
+    results.put(meter.reserve("w@x.io", limit=1))
+
+
+def test_workers_in_separate_processes_share_the_limit(tmp_path):
+    engine = _make_db(tmp_path, {"w@x.io": 0})
+    context = multiprocessing.get_context("fork")
+    barrier, results = context.Barrier(2), context.Queue()
+    workers = [context.Process(target=_reserve_in_process, args=(str(engine.url), barrier, results))
+               for _ in range(2)]
+    for w in workers:
+        w.start()
+    granted = sorted([results.get(timeout=10) for _ in workers], key=lambda used: used is None)
+    for w in workers:
+        w.join()
+
+    # A free user racing two requests onto two workers gets one preview
+    assert granted == [1, None]
+    assert _used(engine, "w@x.io") == 1
+
+
+def test_refunds_release_capacity(tmp_path):
+    engine = _make_db(tmp_path, {"b@x.io": 0})
+    meter = UsageMeter(WriteBehindBuffer(lambda b: apply_usage(b, bind=engine), interval=60), bind=engine)
+
+    assert meter.reserve("b@x.io", limit=1) == 1
+    assert meter.reserve("b@x.io", limit=1) is None
+    meter.refund("b@x.io")
+    assert _used(engine, "b@x.io") == 0
+    assert meter.reserve("b@x.io", limit=1) == 1
+    meter.refund("b@x.io", n=5)
+    assert meter.used("b@x.io") == 0
+    assert meter.reserve("nobody@x.io", limit=1) is None
+
+
+def test_usage_lowered_in_the_database_applies_at_once(tmp_path):
+    engine = _make_db(tmp_path, {"r@x.io": 20})
+    meter = UsageMeter(WriteBehindBuffer(lambda b: None, interval=60), bind=engine)
+    assert meter.reserve("r@x.io", limit=20) is None
+    # e.g. a monthly reset or a support refund
+    with engine.begin() as conn:
+        conn.execute(update(User.__table__).where(User.email == "r@x.io").values(used=0))
+    assert meter.reserve("r@x.io", limit=20) == 1
+
+
+def test_buffer_aggregates_per_key_and_flushes_in_one_batch(tmp_path):
+    engine = _make_db(tmp_path, {"c@x.io": 0, "d@x.io": 3})
+    batches = []
+
+    def flush(batch):
+        batches.append(dict(batch))
+        apply_usage(batch, bind=engine)
+
+    buffer = WriteBehindBuffer(flush, interval=60)
+    _hammer(40, lambda: (buffer.add("c@x.io", used=1), buffer.add("d@x.io", used=1)))
+    buffer.flush()
+
+    assert len(batches) == 1
+    assert _used(engine, "c@x.io") == 40
+    assert _used(engine, "d@x.io") == 43
+
+
+def test_failed_flush_keeps_increments_for_next_attempt(tmp_path):
+    engine = _make_db(tmp_path, {"e@x.io": 0})
+    fail = [True]
+
+    def flush(batch):
+        if fail[0]:
+            raise RuntimeError("database unavailable")
+        apply_usage(batch, bind=engine)
+
+    buffer = WriteBehindBuffer(flush, interval=60)
+    buffer.add("e@x.io", used=2)
+    assert buffer.flush() == 0
+    buffer.add("e@x.io", used=1)
+    fail[0] = False
+    assert buffer.flush() == 1
+
+    assert _used(engine, "e@x.io") == 3
+
+
+def test_size_threshold_wakes_background_flusher(tmp_path):
+    engine = _make_db(tmp_path, {"f@x.io": 0})
+    flushed = threading.Event()
+
+    def flush(batch):
+        apply_usage(batch, bind=engine)
+        flushed.set()
+
+    buffer = WriteBehindBuffer(flush, max_pending=10, interval=60)
+    for _ in range(10):
+        buffer.add("f@x.io", used=1)
+
+    assert flushed.wait(5)
+    assert _used(engine, "f@x.io") == 10
@@ -0,0 +1,133 @@
+#!/usr/bin/env python3
+"""Metrics: histogram buckets, merging worker snapshots, dead workers and label escaping."""
+import glob
+import json
+import multiprocessing
+import os
+import runpy
+import time
+
+import pytest
+
+import metrics as metrics_module
+from metrics import BUCKETS, Metrics
+
+
+@pytest.fixture
+def metrics_dir(tmp_path, monkeypatch):
+    monkeypatch.setenv("METRICS_DIR", str(tmp_path))
+    return tmp_path
+
+
+def _samples(text):
+    samples = {}
+    for line in text.splitlines():
+        if line and not line.startswith("#"):
+            name, value = line.rsplit(" ", 1)
+            samples[name] = float(value)
+    return samples
+
+
+def test_histogram_buckets_are_cumulative_and_bounds_inclusive(monkeypatch):
+    monkeypatch.delenv("METRICS_DIR", raising=False)
+    m = Metrics()
+    for seconds in (0.001, 0.005, 0.0051, 1.0, 120.0):
+        m.observe("latency", seconds, route="a")
+    samples = _samples(m.render())
+
+    assert samples['latency_bucket{route="a",le="0.005"}'] == 2
+    assert samples['latency_bucket{route="a",le="0.01"}'] == 3
+    assert samples['latency_bucket{route="a",le="1.0"}'] == 4
+    assert samples[f'latency_bucket{{route="a",le="{BUCKETS[-1]}"}}'] == 4
+    assert samples['latency_bucket{route="a",le="+Inf"}'] == 5
+    assert samples['latency_count{route="a"}'] == 5
+    assert samples['latency_sum{route="a"}'] == pytest.approx(121.0111)
+
+
+def test_snapshots_from_every_worker_are_summed(metrics_dir):
+    worker, scraper = Metrics(), Metrics()
+    worker.inc("requests_total", 3, route="a")
+    worker.observe("latency", 0.2)
+    worker.register_collector(lambda: [("queue_depth", "gauge", {}, 4)])
+    worker.flush()
+    scraper.inc("requests_total", 2, route="a")
+    scraper.observe("latency", 0.2)
+    scraper.register_collector(lambda: [("queue_depth", "gauge", {}, 1)])
+
+    samples = _samples(scraper.render())
+    assert samples['requests_total{route="a"}'] == 5
+    assert samples["latency_count"] == 2
+    assert samples["queue_depth"] == 5
+
+
+def _worker(directory):
+    os.environ["METRICS_DIR"] = directory
+    m = Metrics()
+    m.inc("requests_total", 7)
+    m.register_collector(lambda: [("queue_depth", "gauge", {}, 9)])
+    m.flush()
+
+
+def test_dead_workers_keep_counters_but_not_gauges(metrics_dir):
+    process = multiprocessing.get_context("fork").Process(target=_worker, args=(str(metrics_dir),))
+    process.start()
+    process.join()
+
+    scraper = Metrics()
+    samples = _samples(scraper.render())
+    assert samples["requests_total"] == 7
+    assert "queue_depth" not in samples
+
+    # Its next flush folds the dead worker's file into the retired totals
+    scraper.flush()
+    names = sorted(os.path.basename(p) for p in glob.glob(str(metrics_dir / "metrics-*.json")))
+    assert names == [os.path.basename(scraper._path(str(metrics_dir))), metrics_module.RETIRED]
+    assert _samples(scraper.render())["requests_total"] == 7
+
+
+def test_reused_pid_does_not_overwrite_an_old_snapshot(metrics_dir):
+    old, new = Metrics(), Metrics()
+    old.inc("requests_total", 5)
+    old.flush()
+    new.inc("requests_total", 1)
+    new.flush()
+    assert len(glob.glob(str(metrics_dir / f"metrics-{os.getpid()}-*.json"))) == 2
+    assert _samples(Metrics().render())["requests_total"] == 6
+
+
+def test_stale_snapshots_are_retired_without_losing_counts(metrics_dir):
+    old = Metrics()
+    old.inc("requests_total", 4)
+    old.register_collector(lambda: [("queue_depth", "gauge", {}, 2)])
+    old.flush()
+    path = old._path(str(metrics_dir))
+    # Pretend the file was last written long ago by a worker whose pid is live again
+    stale = time.time() - 3600
+    os.utime(path, (stale, stale))
+
+    scraper = Metrics()
+    assert "queue_depth" not in _samples(scraper.render())
+    scraper.flush()
+    assert not os.path.exists(path)
+    with open(metrics_dir / metrics_module.RETIRED) as f:
+        retired = json.load(f)
+    assert retired["gauges"] == {}
+    assert _samples(scraper.render())["requests_total"] == 4
+
+
+def test_label_values_are_escaped(monkeypatch):
+    monkeypatch.delenv("METRICS_DIR", raising=False)
+    m = Metrics()
+    m.inc("errors_total", route='say "hi"\\now\nthen')
+    line = [l for l in m.render().splitlines() if l.startswith("errors_total")][0]
+    assert line == 'errors_total{route="say \\"hi\\"\\\\now\\nthen"} 1'
+
+
+def test_gunicorn_startup_clears_only_metrics_files(metrics_dir):
+    conf = runpy.run_path(os.path.join(os.path.dirname(os.path.abspath(__file__)), "gunicorn.conf.py"))
+    for name in ("metrics-1-abc.json", metrics_module.RETIRED, "metrics-2-def.json.tmp",
+                 "ratelimit.bin", "responses.cache"):
+        (metrics_dir / name).write_text("{}")
+
+    conf["on_starting"](None)
+    assert sorted(os.listdir(metrics_dir)) == ["ratelimit.bin", "responses.cache"]
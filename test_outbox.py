@@ -0,0 +1,180 @@
+#!/usr/bin/env python3
+"""Outbox: enqueue dedupe, lease reclaim, backoff, dead-lettering and isolating a bad job."""
+import sqlite3
+import time
+import uuid
+from types import SimpleNamespace
+
+import pytest
+from sqlalchemy import text
+
+from outbox import Outbox
+
+
+@pytest.fixture
+def outbox(tmp_path):
+    return Outbox(str(tmp_path / "outbox.db"), batch_size=8, max_attempts=3, lease=60.0)
+
+
+def _jobs(outbox):
+    with sqlite3.connect(outbox.path) as conn:
+        return {key: (status, attempts, available_at, last_error) for key, status, attempts, available_at, last_error
+                in conn.execute("SELECT key, status, attempts, available_at, last_error FROM jobs")}
+
+
+def _make_due(outbox):
+    with sqlite3.connect(outbox.path) as conn:
+        conn.execute("UPDATE jobs SET available_at = 0")
+
+
+def test_enqueueing_a_key_twice_is_a_no_op(outbox, monkeypatch):
+    monkeypatch.setattr(outbox, "ensure_worker", lambda: None)
+    assert outbox.enqueue("email", "a", {"n": 1})
+    assert not outbox.enqueue("email", "a", {"n": 2})
+    # The key is scoped to its kind
+    assert outbox.enqueue("sms", "a", {"n": 3})
+
+    seen = []
+    outbox.register("email", seen.extend)
+    assert outbox.process_once() == 1
+    assert seen == [("a", {"n": 1})]
+    # Still deduped once done
+    assert not outbox.enqueue("email", "a", {"n": 4})
+
+
+def test_claimed_jobs_are_reclaimed_after_the_lease(outbox, monkeypatch):
+    monkeypatch.setattr(outbox, "ensure_worker", lambda: None)
+    outbox.enqueue("email", "a", {})
+    conn = outbox._connect()
+    try:
+        assert len(outbox._claim(conn, "email")) == 1
+        # Another worker can't take it while the lease holds...
+        assert outbox._claim(conn, "email") == []
+        # ...but can once the claiming worker has been silent past it
+        later = time.time() + outbox.lease + 1
+        monkeypatch.setattr(time, "time", lambda: later)
+        assert [row[1] for row in outbox._claim(conn, "email")] == ["a"]
+    finally:
+        conn.close()
+
+
+def test_failures_back_off_then_go_dead(outbox, monkeypatch):
+    monkeypatch.setattr(outbox, "ensure_worker", lambda: None)
+    outbox.enqueue("email", "a", {})
+
+    def fail(jobs):
+        raise RuntimeError("smtp down")
+    outbox.register("email", fail)
+
+    started = time.time()
+    assert outbox.process_once() == 0
+    status, attempts, available_at, error = _jobs(outbox)["a"]
+    assert (status, attempts, error) == ("pending", 1, "smtp down")
+    assert available_at >= started + 2
+    # Not due again until the backoff has passed
+    assert outbox.process_once() == 0
+    assert _jobs(outbox)["a"][1] == 1
+
+    _make_due(outbox)
+    outbox.process_once()
+    status, attempts, available_at, _ = _jobs(outbox)["a"]
+    assert (status, attempts) == ("pending", 2)
+    assert available_at >= time.time() + 3
+
+    _make_due(outbox)
+    outbox.process_once()
+    assert _jobs(outbox)["a"][:2] == ("dead", 3)
+    _make_due(outbox)
+    assert outbox.process_once() == 0
+    assert _jobs(outbox)["a"][:2] == ("dead", 3)
+
+
+def test_one_bad_job_does_not_fail_its_batch(outbox, monkeypatch):
+    monkeypatch.setattr(outbox, "ensure_worker", lambda: None)
+    for i in range(7):
+        outbox.enqueue("profile", f"user-{i}", {"email": "taken@example.com" if i == 4 else f"{i}@example.com"})
+    stored, calls = [], []
+
+    def insert(jobs):
+        calls.append(len(jobs))
+        if any(payload["email"] == "taken@example.com" for _, payload in jobs):
+            raise ValueError("duplicate key value violates unique constraint")
+        stored.extend(key for key, _ in jobs)
+    outbox.register("profile", insert)
+
+    assert outbox.process_once() == 6
+    assert sorted(stored) == [f"user-{i}" for i in range(7) if i != 4]
+    assert calls[0] == 7
+    assert len(calls) < 2 * 7
+
+    jobs = _jobs(outbox)
+    assert jobs["user-4"][:2] == ("pending", 1)
+    assert all(jobs[f"user-{i}"][:2] == ("done", 0) for i in range(7) if i != 4)
+    # Only the bad job is retried, and it alone is dead-lettered
+    for _ in range(outbox.max_attempts):
+        _make_due(outbox)
+        outbox.process_once()
+    jobs = _jobs(outbox)
+    assert jobs["user-4"][0] == "dead"
+    assert sorted(stored) == [f"user-{i}" for i in range(7) if i != 4]
+
+
+def test_done_jobs_keep_their_key_but_not_their_payload(outbox, monkeypatch):
+    monkeypatch.setattr(outbox, "ensure_worker", lambda: None)
+    outbox.enqueue("generation", "g1", {"output": "x" * 10000})
+    outbox.enqueue("generation", "g2", {"output": "y"})
+    outbox.register("generation", lambda jobs: None)
+    assert outbox.stats() == {"generation": {"pending": 2}}
+
+    assert outbox.process_once() == 2
+    with sqlite3.connect(outbox.path) as conn:
+        assert conn.execute("SELECT key, status, payload FROM jobs ORDER BY key").fetchall() == [
+            ("g1", "done", ""), ("g2", "done", "")]
+        plan = " ".join(str(row) for row in conn.execute(
+            "EXPLAIN QUERY PLAN SELECT kind, status, COUNT(*) FROM jobs "
+            "WHERE status IN ('pending', 'dead') GROUP BY kind, status"))
+    assert "jobs_status" in plan
+    assert not outbox.enqueue("generation", "g1", {"output": "x"})
+    assert outbox.stats() == {}
+
+
+class _ProfileTable:
+    """Stands in for PostgREST's users table: upsert inserts only the given columns."""
+
+    def __init__(self, engine):
+        self.engine = engine
+
+    def upsert(self, rows, on_conflict, ignore_duplicates):
+        def execute():
+            with self.engine.begin() as conn:
+                for row in rows:
+                    conn.execute(text(
+                        f"INSERT INTO users ({', '.join(row)}) VALUES ({', '.join(':' + c for c in row)}) "
+                        f"ON CONFLICT ({on_conflict}) DO NOTHING"), row)
+        return SimpleNamespace(execute=execute)
+
+
+def test_signup_profile_drains_into_a_migrated_users_table(monkeypatch):
+    import app as app_module
+    from db import User
+
+    user_id = str(uuid.uuid4())
+    fake = SimpleNamespace(
+        auth=SimpleNamespace(sign_up=lambda params: {"user": {"id": user_id}}),
+        table=lambda name: _ProfileTable(app_module.engine))
+    monkeypatch.setattr(app_module, "_supabase_available", lambda: True)
+    monkeypatch.setattr(app_module, "_supabase_call", lambda service, operation, build: build(fake))
+
+    response = app_module.app.test_client().post(
+        "/signup", data={"email": f"{user_id}@example.com", "password": "secret123"})
+    assert response.status_code == 302
+    # The worker thread enqueue() woke may drain it first
+    deadline = time.monotonic() + 5
+    user = None
+    while user is None and time.monotonic() < deadline:
+        app_module.outbox.process_once()
+        with app_module.SessionLocal() as db:
+            user = db.get(User, user_id)
+        time.sleep(0.01)
+    assert (user.tier, user.used, user.tokens_used) == ("free", 0, 0)
+    assert app_module.outbox.stats().get("user_profile", {}).get("dead", 0) == 0
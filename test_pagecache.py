@@ -0,0 +1,60 @@
+#!/usr/bin/env python3
+"""Cached marketing pages and static files: compression, ETags and invalidation."""
+import gzip
+import os
+
+from flask import Flask, request
+
+import app as app_module
+from pagecache import PageCache
+
+
+def test_landing_is_compressed_and_revalidates_with_304():
+    client = app_module.app.test_client()
+    first = client.get("/", headers={"Accept-Encoding": "gzip"})
+    assert first.status_code == 200
+    assert first.headers["Content-Encoding"] == "gzip"
+    assert "Accept-Encoding" in first.headers["Vary"]
+    assert b"<html" in gzip.decompress(first.data).lower()
+
+    again = client.get("/", headers={"Accept-Encoding": "gzip", "If-None-Match": first.headers["ETag"]})
+    assert again.status_code == 304
+    assert again.data == b""
+
+    # The uncompressed representation has its own ETag
+    plain = client.get("/", headers={"Accept-Encoding": "identity", "If-None-Match": first.headers["ETag"]})
+    assert plain.status_code == 200
+    assert "Content-Encoding" not in plain.headers
+
+
+def test_fingerprinted_static_urls_are_immutable():
+    with app_module.app.test_request_context():
+        from flask import url_for
+        url = url_for("static", filename="styles.css")
+    assert "?v=" in url
+    client = app_module.app.test_client()
+    assert client.get(url).headers["Cache-Control"] == "public, max-age=31536000, immutable"
+    assert "immutable" not in client.get("/static/styles.css").headers["Cache-Control"]
+    assert client.get("/static/missing.css").status_code == 404
+
+
+def test_entry_rebuilds_when_source_file_changes(tmp_path):
+    source = tmp_path / "page.html"
+    source.write_text("<p>one</p>")
+    cache = PageCache(check_interval=0)
+    builds = []
+
+    def build():
+        builds.append(1)
+        return source.read_bytes(), "text/html"
+
+    flask_app = Flask(__name__)
+    with flask_app.test_request_context("/"):
+        first = cache.get("page", build, [str(source)])
+        assert cache.get("page", build, [str(source)]) is first
+        source.write_text("<p>two</p>")
+        os.utime(source, ns=(0, os.stat(source).st_mtime_ns + 10**9))
+        second = cache.get("page", build, [str(source)])
+        assert cache.respond(request, second).get_data() == b"<p>two</p>"
+    assert len(builds) == 2
+    assert second.variants[None][1] != first.variants[None][1]
@@ -0,0 +1,79 @@
+#!/usr/bin/env python3
+"""Token buckets shared across processes, and the 429s app.py returns from them."""
+import multiprocessing
+import os
+import subprocess
+import sys
+import time
+
+from ratelimit import SharedBuckets
+
+
+def test_burst_then_reject_with_retry_after(tmp_path):
+    buckets = SharedBuckets(str(tmp_path / "rl.bin"), sets=64)
+    results = [buckets.take("user:a", rate=1.0, burst=3) for _ in range(4)]
+    assert [allowed for allowed, _ in results] == [True, True, True, False]
+    assert 0 < results[-1][1] <= 1.0
+    # Other keys have their own bucket
+    assert buckets.take("user:b", rate=1.0, burst=3)[0]
+
+
+def test_tokens_refill_over_time(tmp_path):
+    buckets = SharedBuckets(str(tmp_path / "rl.bin"), sets=64)
+    assert buckets.take("k", rate=50.0, burst=1)[0]
+    assert not buckets.take("k", rate=50.0, burst=1)[0]
+    time.sleep(0.05)
+    assert buckets.take("k", rate=50.0, burst=1)[0]
+
+
+def test_full_set_recycles_oldest_bucket(tmp_path):
+    buckets = SharedBuckets(str(tmp_path / "rl.bin"), sets=1, ways=2)
+    for key in ("a", "b", "c"):
+        assert buckets.take(key, rate=0.001, burst=1)[0]
+    # "a" was evicted by "c", so it starts over with a full bucket
+    assert buckets.take("a", rate=0.001, burst=1)[0]
+    assert not buckets.take("c", rate=0.001, burst=1)[0]
+
+
+def _take_many(path, n, queue):
+    buckets = SharedBuckets(path, sets=64)
+    queue.put(sum(buckets.take("shared", rate=0.001, burst=100)[0] for _ in range(n)))
+
+
+def test_buckets_are_shared_across_processes(tmp_path):
+    path = str(tmp_path / "rl.bin")
+    ctx = multiprocessing.get_context("fork")
+    queue = ctx.Queue()
+    procs = [ctx.Process(target=_take_many, args=(path, 50, queue)) for _ in range(4)]
+    for p in procs:
+        p.start()
+    allowed = sum(queue.get(timeout=30) for _ in procs)
+    for p in procs:
+        p.join()
+    assert allowed == 100
+
+
+def test_login_flood_gets_429_before_supabase(monkeypatch):
+    import app as app_module
+
+    calls = []
+    monkeypatch.setattr(app_module, "_supabase_call", lambda *a, **k: calls.append(a) or 1 / 0)
+    client = app_module.app.test_client()
+    statuses = [
+        client.post("/login", data={"email": "a@example.com", "password": "x"},
+                    environ_base={"REMOTE_ADDR": "203.0.113.7"}).status_code
+        for _ in range(8)
+    ]
+    per_minute, burst = app_module.IP_RATE_LIMITS["login"]
+    assert statuses[:burst] == [200] * burst
+    assert set(statuses[burst:]) == {429}
+    assert len(calls) == burst
+
+
+def test_ip_limits_stay_off_until_proxies_are_configured():
+    # Behind an unconfigured proxy every client would share one bucket
+    env = {k: v for k, v in os.environ.items() if k != "TRUSTED_PROXIES"}
+    result = subprocess.run([sys.executable, "-c", "import app; print(app.IP_RATE_LIMIT_ENABLED)"],
+                            env=env, capture_output=True, text=True, timeout=60)
+    assert result.stdout.strip().splitlines()[-1] == "False"
+    assert "TRUSTED_PROXIES is not set" in result.stdout + result.stderr
@@ -0,0 +1,106 @@
+#!/usr/bin/env python3
+"""Deadlines, hedging, circuit breaking and fallback against the local OpenAI fake."""
+import time
+
+import pytest
+from openai import OpenAI
+
+import app as app_module
+from benchmarks.fakes import FakeServer, OpenAIHandler
+from resilience import CircuitOpen, Deadline, DeadlineExceeded, Resilience
+
+
+@pytest.fixture
+def fake():
+    server = FakeServer(OpenAIHandler, latency=0.0, token_delay=0.0, tokens=3, error_rate=0.0).start()
+    yield server
+    server.stop()
+
+
+def _caller(server):
+    client = OpenAI(api_key="sk-fake", base_url=server.url + "/v1", max_retries=0)
+
+    def call(model, timeout):
+        response = client.chat.completions.create(
+            model=model, messages=[{"role": "user", "content": "hi"}], timeout=timeout)
+        return response.choices[0].message.content
+    return call
+
+
+def test_falls_back_when_primary_model_fails(fake):
+    fake.httpd.fail_models = {"primary"}
+    resilience = Resilience()
+    result, model = resilience.call(_caller(fake), ["primary", "fallback"], Deadline(5))
+    assert model == "fallback"
+    assert result.startswith("tok0")
+    assert resilience.fallbacks == 1
+
+
+def test_deadline_bounds_a_slow_upstream(fake):
+    fake.httpd.latency = 2.0
+    started = time.monotonic()
+    with pytest.raises(DeadlineExceeded):
+        Resilience().call(_caller(fake), ["primary", "fallback"], Deadline(0.3))
+    assert time.monotonic() - started < 1.0
+
+
+def test_hedge_wins_when_first_attempt_stalls(fake):
+    fake.httpd.latency_sequence = [2.0]
+    resilience = Resilience(min_hedge_delay=0.05, default_hedge_delay=0.1)
+    started = time.monotonic()
+    result, model = resilience.call(_caller(fake), ["primary"], Deadline(5), hedge=True)
+    assert time.monotonic() - started < 1.0
+    assert (model, resilience.hedges, resilience.hedge_wins) == ("primary", 1, 1)
+
+
+def test_breaker_opens_on_error_spike_and_recovers(fake):
+    fake.httpd.error_rate = 1.0
+    resilience = Resilience(min_calls=4, error_ratio=0.5, cooldown=0.2)
+    call = _caller(fake)
+    for _ in range(4):
+        with pytest.raises(Exception):
+            resilience.call(call, ["primary"], Deadline(5))
+    hits = fake.httpd.requests
+
+    # Open: fail fast without touching the upstream
+    with pytest.raises(CircuitOpen):
+        resilience.call(call, ["primary"], Deadline(5))
+    assert fake.httpd.requests == hits
+    assert resilience.stats()["models"]["primary"]["state"] == "open"
+
+    # After the cooldown one probe is let through and closes it again
+    fake.httpd.error_rate = 0.0
+    time.sleep(0.25)
+    assert resilience.call(call, ["primary"], Deadline(5))[1] == "primary"
+    assert resilience.breaker("primary").state == "closed"
+
+
+def test_generate_serves_fallback_model(monkeypatch, fake, make_user):
+    fake.httpd.fail_models = {app_module.TIERS["pro"]["model"]}
+    client = OpenAI(api_key="sk-fake", base_url=fake.url + "/v1", max_retries=0)
+    monkeypatch.setattr(app_module, "client", client)
+    monkeypatch.setattr(app_module, "openai_resilience", Resilience())
+
+    _, _, headers = make_user("pro")
+    response = app_module.app.test_client().post(
+        "/generate", json={"prompt": "hello", "save": False}, headers=headers)
+    assert response.status_code == 200
+    assert response.get_json()["model"] == app_module.TIERS["pro"]["fallback_model"]
+
+
+def test_hedge_only_runs_in_a_spare_slot(fake):
+    fake.httpd.latency_sequence = [0.5]
+    resilience = Resilience(min_hedge_delay=0.05, default_hedge_delay=0.1)
+    resilience.call(_caller(fake), ["primary"], Deadline(5), hedge=True, hedge_slot=lambda: None)
+    assert resilience.hedges == 0
+    assert fake.httpd.requests == 1
+
+    fake.httpd.latency_sequence = [0.5]
+    freed = []
+    resilience.call(_caller(fake), ["primary"], Deadline(5), hedge=True,
+                    hedge_slot=lambda: lambda: freed.append(1))
+    assert resilience.hedges == 1
+    deadline = time.monotonic() + 2
+    while not freed and time.monotonic() < deadline:
+        time.sleep(0.01)
+    assert freed == [1]
@@ -0,0 +1,127 @@
+#!/usr/bin/env python3
+"""Response cache: LRU by count and bytes, TTL, single-flight coalescing and the can_rerun bypass."""
+import threading
+import time
+import uuid
+from types import SimpleNamespace
+
+import pytest
+
+import app as app_module
+from response_cache import ResponseCache, make_cache_key
+
+
+def test_evicts_least_recently_used_by_entry_count():
+    cache = ResponseCache(max_entries=2)
+    cache.put("a", "1")
+    cache.put("b", "2")
+    assert cache.get("a") == "1"  # b is now the oldest
+    cache.put("c", "3")
+    assert (cache.get("a"), cache.get("b"), cache.get("c")) == ("1", None, "3")
+    assert cache.stats()["evictions"] == 1
+
+
+def test_evicts_to_stay_within_byte_budget():
+    cache = ResponseCache(max_entries=100, max_bytes=10)
+    cache.put("a", "xxxx")
+    cache.put("b", "yyyy")
+    cache.put("c", "zzzz")
+    assert cache.get("a") is None
+    assert cache.stats()["bytes"] == 8
+    # A value over the whole budget is never stored
+    cache.put("huge", "x" * 11)
+    assert cache.get("huge") is None
+
+
+def test_entries_expire_after_ttl():
+    cache = ResponseCache(ttl=0.05)
+    cache.put("a", "1")
+    assert cache.get("a") == "1"
+    time.sleep(0.06)
+    assert cache.get("a") is None
+    assert cache.stats()["entries"] == 0
+
+
+def _concurrently(n, fn):
+    results, errors = [], []
+
+    def run():
+        try:
+            results.append(fn())
+        except Exception as e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=run) for _ in range(n)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    return results, errors
+
+
+def test_concurrent_misses_share_one_computation():
+    cache = ResponseCache()
+    calls = []
+
+    def compute():
+        calls.append(1)
+        time.sleep(0.1)
+        return "output"
+
+    results, errors = _concurrently(8, lambda: cache.get_or_compute("k", compute))
+    assert (results, errors, calls) == (["output"] * 8, [], [1])
+    assert cache.stats()["coalesced"] == 7
+
+
+def test_leader_error_reaches_followers_and_is_not_cached():
+    cache = ResponseCache()
+    calls = []
+
+    def compute():
+        calls.append(1)
+        time.sleep(0.1)
+        raise RuntimeError("upstream failed")
+
+    results, errors = _concurrently(4, lambda: cache.get_or_compute("k", compute))
+    assert results == [] and len(calls) == 1
+    assert [str(e) for e in errors] == ["upstream failed"] * 4
+    assert cache.get_or_compute("k", lambda: "recovered") == "recovered"
+
+
+def test_follower_gives_up_at_its_own_deadline():
+    cache = ResponseCache()
+    started = threading.Event()
+
+    def slow():
+        started.set()
+        time.sleep(0.5)
+        return "late"
+
+    leader = threading.Thread(target=cache.get_or_compute, args=("k", slow))
+    leader.start()
+    started.wait()
+    began = time.monotonic()
+    with pytest.raises(TimeoutError):
+        cache.get_or_compute("k", slow, timeout=0.05)
+    assert time.monotonic() - began < 0.4
+    leader.join()
+
+
+@pytest.mark.parametrize("tier, upstream_calls", [("free", 1), ("pro", 2)])
+def test_only_tiers_without_can_rerun_are_served_from_cache(monkeypatch, make_user, tier, upstream_calls):
+    calls = []
+
+    def fake(model, prompt, **kwargs):
+        calls.append(prompt)
+        return SimpleNamespace(choices=[SimpleNamespace(message=SimpleNamespace(content=f"reply {len(calls)}"))])
+
+    monkeypatch.setattr(app_module, "_chat_completion", fake)
+    prompt = f"caption for {uuid.uuid4()}"
+    client = app_module.app.test_client()
+    outputs = [client.post("/generate", json={"prompt": prompt, "save": False}, headers=make_user(tier)[2])
+               .get_json()["output"] for _ in range(2)]
+    assert len(calls) == upstream_calls
+    assert (outputs[0] == outputs[1]) == (upstream_calls == 1)
+    model = app_module.TIERS[tier]["model"]
+    key = make_cache_key(model, prompt, app_module.GENERATE_TEMPERATURE, app_module.TIERS[tier]["max_output_tokens"])
+    assert (app_module.response_cache.get(key) is not None) == (tier == "free")
@@ -0,0 +1,130 @@
+#!/usr/bin/env python3
+"""Dispatch scheduler: weighted fairness, queue depth, wait budgets and the 429s app.py returns."""
+import os
+import subprocess
+import sys
+import threading
+import time
+
+import pytest
+
+import app as app_module
+from scheduler import DispatchScheduler, QueueFull
+
+
+def _wait_for(condition, timeout=5):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline
+        time.sleep(0.005)
+
+
+def test_slots_go_to_classes_in_proportion_to_weight():
+    scheduler = DispatchScheduler(max_concurrency=1, weights={"highest": 8, "low": 1})
+    held = scheduler.acquire("highest")
+    order = []
+
+    def waiter(priority):
+        with scheduler.slot(priority):
+            order.append(priority)
+
+    threads = [threading.Thread(target=waiter, args=(p,)) for p in ["low"] * 2 + ["highest"] * 16]
+    for t in threads:
+        t.start()
+    _wait_for(lambda: sum(c["queued"] for c in scheduler.stats()["classes"].values()) == len(threads))
+    scheduler.release(held)
+    for t in threads:
+        t.join()
+
+    # The low class queued first, yet gets one slot in nine, and is never starved
+    assert order[:9].count("low") == 1
+    assert order[:18].count("low") == 2
+    assert scheduler.stats()["active"] == 0
+
+
+def test_full_queue_rejects_at_once_with_retry_after():
+    scheduler = DispatchScheduler(max_concurrency=1, max_queue={"highest": 1, "high": 1, "low": 1})
+    held = scheduler.acquire("low")
+    queued = threading.Thread(target=lambda: scheduler.release(scheduler.acquire("low")))
+    queued.start()
+    _wait_for(lambda: scheduler.stats()["classes"]["low"]["queued"] == 1)
+
+    started = time.monotonic()
+    with pytest.raises(QueueFull) as rejected:
+        scheduler.acquire("low")
+    assert time.monotonic() - started < 0.1
+    assert rejected.value.retry_after >= 1
+    # Other classes have their own queues
+    high = threading.Thread(target=lambda: scheduler.release(scheduler.acquire("high")))
+    high.start()
+    _wait_for(lambda: scheduler.stats()["classes"]["high"]["queued"] == 1)
+
+    scheduler.release(held)
+    queued.join()
+    high.join()
+    assert scheduler.stats()["classes"]["low"]["rejected"] == 1
+
+
+def test_waiters_give_up_after_their_wait_budget():
+    scheduler = DispatchScheduler(max_concurrency=1, max_wait={"highest": 5.0, "high": 5.0, "low": 0.05})
+    held = scheduler.acquire("high")
+    started = time.monotonic()
+    with pytest.raises(QueueFull):
+        scheduler.acquire("low")
+    assert 0.04 < time.monotonic() - started < 0.5
+    # A shorter request deadline wins over the class budget
+    started = time.monotonic()
+    with pytest.raises(QueueFull):
+        scheduler.acquire("high", timeout=0.05)
+    assert time.monotonic() - started < 0.5
+
+    scheduler.release(held)
+    stats = scheduler.stats()
+    assert (stats["active"], stats["classes"]["low"]["timed_out"], stats["classes"]["high"]["timed_out"]) == (0, 1, 1)
+    assert stats["classes"]["low"]["queued"] == 0
+
+
+def test_generate_answers_429_with_retry_after_and_refunds(monkeypatch, make_user):
+    scheduler = DispatchScheduler(max_concurrency=1, max_queue={"highest": 0, "high": 0, "low": 0})
+    monkeypatch.setattr(app_module, "dispatcher", scheduler)
+    held = scheduler.acquire("highest")
+    _, email, headers = make_user("pro")
+
+    response = app_module.app.test_client().post(
+        "/generate", json={"prompt": "hi", "save": False}, headers=headers)
+    scheduler.release(held)
+    assert response.status_code == 429
+    assert int(response.headers["Retry-After"]) >= 1
+    assert response.get_json()["retry_after"] == int(response.headers["Retry-After"])
+    assert app_module.usage_meter.used(email) == 0
+
+
+
+def test_try_acquire_takes_only_a_free_slot_without_waiting():
+    scheduler = DispatchScheduler(max_concurrency=1)
+    held = scheduler.try_acquire("low")
+    assert held is not None
+    started = time.monotonic()
+    assert scheduler.try_acquire("highest") is None
+    assert time.monotonic() - started < 0.1
+    assert scheduler.stats()["classes"]["highest"]["queued"] == 0
+
+    scheduler.release(held)
+    scheduler.release(scheduler.try_acquire("highest"))
+    assert scheduler.stats()["active"] == 0
+
+
+def test_async_mode_defaults_leave_room_to_queue_and_shed():
+    # Module-level settings, so import app afresh with ASYNC_MODE on
+    script = ("import app; d = app.dispatcher; "
+              "print(app.WORKER_THREADS, d.max_concurrency, d.max_queue['low'])")
+    env = dict(os.environ, ASYNC_MODE="true")
+    env.pop("GUNICORN_THREADS", None)
+    env.pop("OPENAI_MAX_CONCURRENCY", None)
+    result = subprocess.run([sys.executable, "-c", script], env=env, cwd=os.path.dirname(os.path.abspath(__file__)),
+                            capture_output=True, text=True, timeout=60)
+    assert result.returncode == 0, result.stderr
+    threads, concurrency, low_queue = map(int, result.stdout.split()[-3:])
+    assert concurrency < threads
+    # More low-priority requests than fit in flight plus queued get shed
+    assert concurrency + low_queue < threads
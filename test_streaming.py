@@ -0,0 +1,114 @@
+#!/usr/bin/env python3
+"""SSE mode of /generate: both ways to ask for it, the final usage event, and client disconnects."""
+import json
+from types import SimpleNamespace
+
+import pytest
+from sqlalchemy import select
+
+import app as app_module
+from db import User
+from resilience import Resilience
+
+
+class FakeStream:
+    def __init__(self, parts):
+        self.parts = parts
+        self.sent = 0
+        self.closed = False
+
+    def __iter__(self):
+        for text in self.parts:
+            self.sent += 1
+            yield SimpleNamespace(choices=[SimpleNamespace(delta=SimpleNamespace(content=text))])
+
+    def close(self):
+        self.closed = True
+
+
+@pytest.fixture
+def upstream(monkeypatch):
+    streams = []
+
+    def fake(model, prompt, **kwargs):
+        assert kwargs.get("stream")
+        streams.append(FakeStream(["Hel", "lo", " there", "!"]))
+        return streams[-1]
+
+    monkeypatch.setattr(app_module, "_chat_completion", fake)
+    monkeypatch.setattr(app_module, "openai_resilience", Resilience())
+    return streams
+
+
+@pytest.fixture
+def pro_user(make_user):
+    _, email, headers = make_user("pro")
+    return email, headers
+
+
+def _events(body):
+    events = []
+    for frame in body.decode().strip().split("\n\n"):
+        fields = dict(line.split(": ", 1) for line in frame.splitlines())
+        events.append((fields.get("event", "message"), json.loads(fields["data"])))
+    return events
+
+
+def _usage(email):
+    app_module.usage_meter.buffer.flush()
+    with app_module.SessionLocal() as db:
+        return tuple(db.execute(select(User.used, User.tokens_used).where(User.email == email)).one())
+
+
+@pytest.mark.parametrize("path, headers", [
+    ("/generate?stream=1", {}),
+    ("/generate", {"Accept": "text/event-stream"})
+])
+def test_tokens_are_forwarded_then_a_done_event(upstream, pro_user, path, headers):
+    email, auth = pro_user
+    response = app_module.app.test_client().post(
+        path, json={"prompt": "hi", "save": False}, headers={**auth, **headers})
+    assert response.status_code == 200
+    assert response.mimetype == "text/event-stream"
+
+    events = _events(response.get_data())
+    assert [data["token"] for name, data in events[:-1]] == ["Hel", "lo", " there", "!"]
+    name, done = events[-1]
+    assert name == "done"
+    assert (done["tier"], done["used"], done["limit"]) == ("pro", 1, app_module.TIERS["pro"]["limit"])
+    assert done["usage"]["completion_tokens"] > 0
+    assert upstream[0].closed
+    assert _usage(email)[0] == 1
+
+
+def test_disconnect_mid_stream_counts_once_and_closes_upstream(upstream, pro_user):
+    email, auth = pro_user
+    response = app_module.app.test_client().post(
+        "/generate?stream=1", json={"prompt": "hi", "save": False}, headers=auth, buffered=False)
+    body = iter(response.response)
+    assert b'"Hel"' in next(body)
+    response.close()
+
+    stream = upstream[0]
+    assert stream.closed
+    assert stream.sent < len(stream.parts)
+    used, tokens_used = _usage(email)
+    # One use, and the prompt plus the tokens that were sent still count
+    assert used == 1
+    assert tokens_used > 0
+
+
+def test_body_never_read_still_frees_the_slot_and_upstream(upstream, pro_user):
+    email, auth = pro_user
+    active = app_module.dispatcher.stats()["active"]
+    # The test client always reads the first chunk, so dispatch by hand
+    with app_module.app.test_request_context(
+            "/generate?stream=1", method="POST", json={"prompt": "hi", "save": False}, headers=auth):
+        response = app_module.app.full_dispatch_request()
+    assert app_module.dispatcher.stats()["active"] == active + 1
+    response.close()
+
+    assert upstream[0].closed
+    assert upstream[0].sent == 0
+    assert app_module.dispatcher.stats()["active"] == active
+    assert _usage(email)[0] == 1
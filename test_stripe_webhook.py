@@ -0,0 +1,153 @@
+#!/usr/bin/env python3
+"""Stripe webhook ingestion with locally signed fake events."""
+import hashlib
+import hmac
+import json
+import time
+import uuid
+
+import pytest
+
+import app as app_module
+from db import User
+
+SECRET = "whsec_test"
+
+
+def _signed(payload):
+    timestamp = int(time.time())
+    signature = hmac.new(SECRET.encode(), f"{timestamp}.{payload}".encode(), hashlib.sha256).hexdigest()
+    return {"Stripe-Signature": f"t={timestamp},v1={signature}", "Content-Type": "application/json"}
+
+
+def _event(event_type, obj, created=None, event_id=None):
+    return {
+        "id": event_id or f"evt_{uuid.uuid4().hex}",
+        "object": "event",
+        "type": event_type,
+        "created": created or int(time.time()),
+        "data": {"object": obj}
+    }
+
+
+def _post(client, event):
+    payload = json.dumps(event)
+    return client.post("/stripe-webhook", data=payload, headers=_signed(payload))
+
+
+def _drain():
+    # The worker thread may be processing too; wait until nothing is pending
+    deadline = time.time() + 5
+    while time.time() < deadline:
+        app_module.outbox.process_once()
+        if not app_module.outbox.stats().get("stripe_event", {}).get("pending"):
+            return
+        time.sleep(0.05)
+    raise AssertionError("stripe events were not processed")
+
+
+def _user(user_id):
+    db = app_module.SessionLocal()
+    try:
+        return db.query(User).filter(User.id == user_id).first()
+    finally:
+        db.close()
+
+
+@pytest.fixture
+def client():
+    return app_module.app.test_client()
+
+
+@pytest.fixture
+def user(make_user):
+    return make_user("free")[0]
+
+
+def _checkout_completed(user_id, customer_id, tier="pro"):
+    return _event("checkout.session.completed", {
+        "object": "checkout.session",
+        "mode": "subscription",
+        "client_reference_id": user_id,
+        "customer": customer_id,
+        "metadata": {"user_id": user_id, "tier": tier}
+    })
+
+
+def test_rejects_unsigned_and_tampered_events(client, user):
+    event = _checkout_completed(user, "cus_bad")
+    assert client.post("/stripe-webhook", json=event).status_code == 400
+
+    headers = _signed(json.dumps(event))
+    event["data"]["object"]["metadata"]["tier"] = "agency"
+    assert client.post("/stripe-webhook", data=json.dumps(event), headers=headers).status_code == 400
+
+    _drain()
+    assert _user(user).tier == "free"
+
+
+def test_checkout_completed_upgrades_user_and_invalidates_cache(client, user):
+    app_module.entitlements.put(app_module.Entitlement(user, user, f"{user}@example.com", "free", 0, None))
+
+    assert _post(client, _checkout_completed(user, "cus_1")).status_code == 200
+    _drain()
+
+    stored = _user(user)
+    assert stored.tier == "pro"
+    assert stored.stripe_customer_id == "cus_1"
+    reloaded = app_module.entitlements.get(
+        user, lambda: app_module._load_entitlement(user, f"{user}@example.com"))
+    assert reloaded.tier == "pro"
+
+
+def test_duplicate_event_is_applied_once(client, user):
+    upgrade = _checkout_completed(user, "cus_2")
+    _post(client, upgrade)
+    _drain()
+
+    cancel = _event("customer.subscription.deleted", {
+        "object": "subscription", "customer": "cus_2", "status": "canceled", "metadata": {}
+    })
+    _post(client, cancel)
+    _drain()
+
+    # Stripe redelivers the old upgrade; it must not resurrect the tier
+    assert _post(client, upgrade).status_code == 200
+    _drain()
+    assert _user(user).tier == "free"
+
+
+def test_subscription_update_maps_price_to_tier(client, user):
+    _post(client, _checkout_completed(user, "cus_3"))
+    _drain()
+
+    update = _event("customer.subscription.updated", {
+        "object": "subscription",
+        "customer": "cus_3",
+        "status": "active",
+        "metadata": {},
+        "items": {"data": [{"price": {"id": "price_agency"}}]}
+    })
+    _post(client, update)
+    _drain()
+    assert _user(user).tier == "agency"
+
+
+def test_out_of_order_events_keep_newest_state(client, user):
+    _post(client, _checkout_completed(user, "cus_4"))
+    _drain()
+
+    now = int(time.time())
+    deleted = _event("customer.subscription.deleted", {
+        "object": "subscription", "customer": "cus_4", "status": "canceled", "metadata": {}
+    }, created=now + 10)
+    updated = _event("customer.subscription.updated", {
+        "object": "subscription", "customer": "cus_4", "status": "active",
+        "metadata": {"tier": "agency"}
+    }, created=now + 5)
+    # Newest first, as Stripe may deliver them
+    app_module.outbox.enqueue("stripe_event", deleted["id"], deleted)
+    app_module.outbox.enqueue("stripe_event", updated["id"], updated)
+    _drain()
+
+    assert _user(user).tier == "free"
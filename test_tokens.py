@@ -0,0 +1,92 @@
+#!/usr/bin/env python3
+"""Local prompt sizing, per-tier token caps and token usage accounting."""
+from types import SimpleNamespace
+
+import pytest
+from sqlalchemy import select
+
+import app as app_module
+import tokens
+from db import User
+
+
+@pytest.fixture
+def estimate_only(monkeypatch):
+    monkeypatch.setattr(tokens, "tiktoken", None)
+
+
+def test_estimate_counts_ascii_cheaper_than_other_scripts(estimate_only):
+    assert tokens.count_tokens("") == 0
+    assert tokens.count_tokens("abcd" * 10) == 10
+    assert tokens.count_tokens("日本語") == 3
+
+
+def test_truncate_fits_budget(estimate_only):
+    text = "word " * 400 + "日本語" * 50
+    cut = tokens.truncate_to_tokens(text, 120)
+    assert tokens.count_tokens(cut) <= 120
+    assert text.startswith(cut)
+    assert tokens.truncate_to_tokens("short", 120) == "short"
+
+
+@pytest.fixture
+def pro_user(make_user):
+    _, email, headers = make_user("pro")
+    return email, headers
+
+
+def _fake_completion(calls):
+    def fake(model, prompt, **kwargs):
+        calls.append((prompt, kwargs))
+        message = SimpleNamespace(content="four token reply!")
+        return SimpleNamespace(choices=[SimpleNamespace(message=message)])
+    return fake
+
+
+def test_oversize_prompt_is_rejected_before_reserving(monkeypatch, estimate_only, pro_user):
+    calls = []
+    monkeypatch.setattr(app_module, "_chat_completion", _fake_completion(calls))
+    email, headers = pro_user
+    prompt = "x" * 4 * (app_module.TIERS["pro"]["max_input_tokens"] + 1)
+
+    response = app_module.app.test_client().post("/generate", json={"prompt": prompt}, headers=headers)
+    assert response.status_code == 413
+    assert response.get_json()["max_input_tokens"] == app_module.TIERS["pro"]["max_input_tokens"]
+    assert calls == []
+    assert app_module.usage_meter.used(email) == 0
+
+
+def test_truncated_prompt_is_capped_and_tokens_recorded(monkeypatch, estimate_only, pro_user):
+    calls = []
+    monkeypatch.setattr(app_module, "_chat_completion", _fake_completion(calls))
+    email, headers = pro_user
+    max_input = app_module.TIERS["pro"]["max_input_tokens"]
+    prompt = "x" * 4 * (max_input + 500)
+
+    response = app_module.app.test_client().post(
+        "/generate", json={"prompt": prompt, "truncate": True}, headers=headers)
+    assert response.status_code == 200
+    usage = response.get_json()["usage"]
+    assert usage == {"prompt_tokens": max_input, "completion_tokens": 5, "truncated": True}
+
+    sent_prompt, kwargs = calls[0]
+    assert tokens.count_tokens(sent_prompt) == max_input
+    assert kwargs["max_tokens"] == app_module.TIERS["pro"]["max_output_tokens"]
+
+    app_module.usage_meter.buffer.flush()
+    with app_module.SessionLocal() as db:
+        row = db.execute(select(User.used, User.tokens_used).where(User.email == email)).one()
+    assert tuple(row) == (1, max_input + 5)
+
+
+@pytest.mark.parametrize("prompt", [123, ["hi"], {"text": "hi"}, "   ", None])
+def test_non_string_prompt_is_a_400(monkeypatch, pro_user, prompt):
+    calls = []
+    monkeypatch.setattr(app_module, "_chat_completion", _fake_completion(calls))
+    email, headers = pro_user
+
+    response = app_module.app.test_client().post("/generate", json={"prompt": prompt}, headers=headers)
+    assert response.status_code == 400
+    assert response.get_json()["error"] == "Missing prompt"
+    assert calls == []
+    assert app_module.usage_meter.used(email) == 0
@@ -0,0 +1,113 @@
+#!/usr/bin/env python3
+"""Shared transport pools: keep-alive reuse, DNS caching and per-process state."""
+import asyncio
+
+import httpx
+import pytest
+
+from benchmarks.fakes import FakeServer, OpenAIHandler
+from transport import DNSCache, TransportPools
+
+
+@pytest.fixture
+def fake():
+    server = FakeServer(OpenAIHandler, latency=0.0, token_delay=0.0, tokens=3, error_rate=0.0).start()
+    yield server
+    server.stop()
+
+
+def _completion(client, base_url):
+    response = client.post(base_url + "/v1/chat/completions",
+                           json={"model": "m", "messages": [{"role": "user", "content": "hi"}]})
+    response.raise_for_status()
+    return response.json()
+
+
+def test_requests_reuse_one_connection_and_cache_dns(fake):
+    pools = TransportPools(dns_ttl=60)
+    base_url = fake.url.replace("127.0.0.1", "localhost")
+    with pools.client("openai") as client:
+        for _ in range(5):
+            _completion(client, base_url)
+
+    stats = pools.stats()
+    pool = stats["pools"]["openai:sync"]
+    assert pool["requests"] == 5
+    assert pool["connections_opened"] == 1
+    assert pool["connections_reused"] == 4
+    assert pool["errors"] == 0
+    # Resolved once, for the one connection that was opened
+    assert stats["dns_cache"] == {"hits": 0, "misses": 1, "ttl": 60}
+
+
+def test_disabling_keepalive_opens_a_connection_per_request(fake):
+    pools = TransportPools(max_keepalive=0, dns_ttl=60)
+    base_url = fake.url.replace("127.0.0.1", "localhost")
+    with pools.client("openai") as client:
+        for _ in range(3):
+            _completion(client, base_url)
+
+    stats = pools.stats()
+    assert stats["pools"]["openai:sync"]["connections_opened"] == 3
+    assert stats["dns_cache"]["misses"] == 1 and stats["dns_cache"]["hits"] == 2
+
+
+def test_async_pool_and_sdk_client_subclass(fake):
+    from openai import DefaultAsyncHttpxClient
+    pools = TransportPools()
+
+    async def run():
+        async with pools.async_client("openai", cls=DefaultAsyncHttpxClient) as client:
+            for _ in range(3):
+                response = await client.post(fake.url + "/v1/chat/completions",
+                                             json={"model": "m", "messages": []})
+                assert response.status_code == 200
+
+    asyncio.run(run())
+    pool = pools.stats()["pools"]["openai:async"]
+    assert pool["requests"] == 3 and pool["connections_opened"] == 1
+
+
+def test_refused_connection_evicts_cached_address(fake):
+    dns = DNSCache(ttl=60)
+    pools = TransportPools()
+    pools._state()
+    pools._dns = dns
+    dns._entries[("localhost", fake.httpd.server_port)] = (("127.0.0.2",), float("inf"))
+    base_url = fake.url.replace("127.0.0.1", "localhost")
+    with pools.client("openai") as client:
+        try:
+            _completion(client, base_url)
+        except httpx.ConnectError:
+            pass  # nothing listens on the stale address
+        _completion(client, base_url)
+    assert "127.0.0.1" in dns._entries[("localhost", fake.httpd.server_port)][0]
+
+
+def test_connect_falls_through_to_the_next_cached_address(fake):
+    pools = TransportPools()
+    dns = pools._state()
+    key = ("localhost", fake.httpd.server_port)
+    # Nothing listens on 127.0.0.2, so the first address refuses
+    dns._entries[key] = (("127.0.0.2", "127.0.0.1"), float("inf"))
+    base_url = fake.url.replace("127.0.0.1", "localhost")
+    with pools.client("openai") as client:
+        _completion(client, base_url)
+    assert dns._entries[key][0] == ("127.0.0.2", "127.0.0.1")
+    assert pools.stats()["pools"]["openai:sync"]["errors"] == 0
+
+    async def run():
+        async with pools.async_client("openai") as client:
+            response = await client.post(base_url + "/v1/chat/completions", json={"model": "m", "messages": []})
+            assert response.status_code == 200
+
+    asyncio.run(run())
+    assert dns.hits == 2
+
+
+def test_pools_from_another_process_are_not_reported():
+    pools = TransportPools()
+    pools.transport("stripe")
+    assert "stripe:sync" in pools.stats()["pools"]
+    pools._pid = -1  # as seen from a forked worker
+    assert pools.stats()["pools"] == {}
@@ -0,0 +1,85 @@
+"""Prompt token counting and truncation, done locally before dispatch.
+
+Uses tiktoken (in requirements.txt) when its encoding files are available
+(set TIKTOKEN_CACHE_DIR to ship them with the build). Otherwise it falls
+back to an estimate that costs a quarter token per ASCII character and a
+full token per other character. That is close to BPE for English and
+errs high for CJK and emoji, so a budget checked with the estimate is
+not exceeded upstream by much.
+"""
+import logging
+import math
+import threading
+
+try:
+    import tiktoken
+except ImportError:  # optional
+    tiktoken = None
+
+DEFAULT_ENCODING = "o200k_base"
+
+logger = logging.getLogger(__name__)
+
+_encodings = {}
+_lock = threading.Lock()
+_unavailable = False
+
+
+def _encoding(model):
+    """The tiktoken encoding for model, or None to use the estimate."""
+    global _unavailable
+    if tiktoken is None or _unavailable:
+        return None
+    if model in _encodings:
+        return _encodings[model]
+    with _lock:
+        if model not in _encodings:
+            try:
+                try:
+                    encoding = tiktoken.encoding_for_model(model or "")
+                except KeyError:
+                    encoding = tiktoken.get_encoding(DEFAULT_ENCODING)
+            except Exception as e:
+                # e.g. no network to fetch the BPE file and nothing cached;
+                # don't retry the download on every request
+                logger.warning("tiktoken unavailable, estimating tokens", extra={"error": str(e)})
+                _unavailable = True
+                return None
+            _encodings[model] = encoding
+    return _encodings[model]
+
+
+def _char_cost(ch):
+    return 0.25 if ch < "\x80" else 1.0
+
+
+def count_tokens(text, model=None):
+    if not text:
+        return 0
+    encoding = _encoding(model)
+    if encoding is not None:
+        return len(encoding.encode(text, disallowed_special=()))
+    ascii_chars = len(text.encode("ascii", "ignore"))
+    return math.ceil(ascii_chars * 0.25 + (len(text) - ascii_chars))
+
+
+def truncate_to_tokens(text, max_tokens, model=None):
+    """Cut text so count_tokens(result, model) <= max_tokens."""
+    encoding = _encoding(model)
+    if encoding is not None:
+        ids = encoding.encode(text, disallowed_special=())
+        if len(ids) <= max_tokens:
+            return text
+        # A cut through a multi-byte character can re-encode longer; back off
+        while max_tokens > 0:
+            truncated = encoding.decode(ids[:max_tokens])
+            if len(encoding.encode(truncated, disallowed_special=())) <= max_tokens:
+                return truncated
+            max_tokens -= 1
+        return ""
+    budget = float(max_tokens)
+    for i, ch in enumerate(text):
+        budget -= _char_cost(ch)
+        if budget < 0:
+            return text[:i]
+    return text
@@ -0,0 +1,369 @@
+"""Shared keep-alive HTTP transports for the upstream SDK clients.
+
+OpenAI, Stripe and Supabase all take an httpx client (OpenAI's is the
+httpx2 fork, which has the same transport API on top of httpcore2), so
+each is handed one built on a transport from TransportPools instead of
+its own defaults. That gives every upstream one tuned pool per worker:
+
+- pool size and keep-alive are set here (and from the environment in
+  app.py), with HTTP/2 negotiated over TLS when h2 is installed;
+- hostnames are resolved through a small TTL cache, so opening a new
+  connection doesn't repeat the DNS lookup. Every address is kept and
+  tried in order, as socket.create_connection would; when none of them
+  accepts a connection the entry is evicted and looked up again next
+  time. TLS still verifies and sends SNI for the original hostname;
+- every request is traced, so stats() can say how many connections were
+  opened versus reused and how long requests waited for a connection.
+
+Pools are built inside the LazyClient / runtime.resource factories, which
+run once per process, so a gunicorn fork never shares a socket with its
+parent. stats() also only reports pools from the current process.
+"""
+import asyncio
+import functools
+import importlib
+import ipaddress
+import os
+import socket
+import threading
+import time
+
+import httpx
+
+try:
+    import h2  # noqa: F401
+    HTTP2_AVAILABLE = True
+except ImportError:  # optional, HTTP/1.1 only without it
+    HTTP2_AVAILABLE = False
+
+# httpx-compatible client libraries and the connection library under each
+_CORE = {"httpx": "httpcore", "httpx2": "httpcore2"}
+
+
+# --------------------
+# DNS CACHE
+# --------------------
+
+class DNSCache:
+    def __init__(self, ttl=60.0):
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._entries = {}  # (host, port) -> (addresses, expires_at)
+        self._lock = threading.Lock()
+
+    def _cached(self, host, port):
+        if self.ttl <= 0 or _is_ip(host):
+            return (host,)
+        entry = self._entries.get((host, port))
+        if entry and entry[1] > time.monotonic():
+            self.hits += 1
+            return entry[0]
+        return None
+
+    def _store(self, host, port, infos):
+        self.misses += 1
+        # In getaddrinfo's preferred order, without repeats
+        addresses = tuple(dict.fromkeys(info[4][0] for info in infos))
+        with self._lock:
+            self._entries[(host, port)] = (addresses, time.monotonic() + self.ttl)
+        return addresses
+
+    def resolve(self, host, port):
+        """host's addresses, from the cache while it is fresh."""
+        return self._cached(host, port) or self._store(
+            host, port, socket.getaddrinfo(host, port, type=socket.SOCK_STREAM))
+
+    async def resolve_async(self, host, port):
+        cached = self._cached(host, port)
+        if cached:
+            return cached
+        infos = await asyncio.get_running_loop().getaddrinfo(host, port, type=socket.SOCK_STREAM)
+        return self._store(host, port, infos)
+
+    def evict(self, host, port):
+        with self._lock:
+            self._entries.pop((host, port), None)
+
+
+def _is_ip(host):
+    try:
+        ipaddress.ip_address(host)
+        return True
+    except ValueError:
+        return False
+
+
+# Network backends are duck-typed by the connection pool, so these wrap
+# httpcore's and httpcore2's alike; `core` supplies the error types.
+
+class _ResolvingBackend:
+    """Connects to the first cached address that accepts; everything else is the inner backend's."""
+
+    def __init__(self, inner, dns, core):
+        self._inner = inner
+        self._dns = dns
+        self._core = core
+
+    def connect_tcp(self, host, port, timeout=None, local_address=None, socket_options=None):
+        try:
+            addresses = self._dns.resolve(host, port)
+        except OSError as e:
+            # Surface as the error httpx (and the SDKs) expect from a failed connect
+            raise self._core.ConnectError(str(e)) from e
+        for i, address in enumerate(addresses):
+            try:
+                return self._inner.connect_tcp(address, port, timeout, local_address, socket_options)
+            except (self._core.ConnectError, self._core.ConnectTimeout):
+                if i == len(addresses) - 1:
+                    self._dns.evict(host, port)
+                    raise
+
+    def connect_unix_socket(self, path, timeout=None, socket_options=None):
+        return self._inner.connect_unix_socket(path, timeout, socket_options)
+
+    def sleep(self, seconds):
+        self._inner.sleep(seconds)
+
+
+class _AsyncResolvingBackend:
+    def __init__(self, inner, dns, core):
+        self._inner = inner
+        self._dns = dns
+        self._core = core
+
+    async def connect_tcp(self, host, port, timeout=None, local_address=None, socket_options=None):
+        try:
+            addresses = await self._dns.resolve_async(host, port)
+        except OSError as e:
+            raise self._core.ConnectError(str(e)) from e
+        for i, address in enumerate(addresses):
+            try:
+                return await self._inner.connect_tcp(address, port, timeout, local_address, socket_options)
+            except (self._core.ConnectError, self._core.ConnectTimeout):
+                if i == len(addresses) - 1:
+                    self._dns.evict(host, port)
+                    raise
+
+    async def connect_unix_socket(self, path, timeout=None, socket_options=None):
+        return await self._inner.connect_unix_socket(path, timeout, socket_options)
+
+    async def sleep(self, seconds):
+        await self._inner.sleep(seconds)
+
+
+# --------------------
+# POOL STATS
+# --------------------
+
+class PoolStats:
+    def __init__(self):
+        self.requests = 0
+        self.errors = 0
+        self.connections_opened = 0
+        self.connect_seconds = 0.0
+        self.wait_seconds = 0.0
+        self._lock = threading.Lock()
+
+    def record(self, probe, failed):
+        with self._lock:
+            self.requests += 1
+            self.errors += failed
+            self.connections_opened += probe.opened
+            self.connect_seconds += probe.connect_seconds
+            self.wait_seconds += probe.wait_seconds
+
+
+class _Probe:
+    """Follows one request's trace events.
+
+    wait_seconds is the time spent getting a connection, not counting
+    TCP/TLS setup (that is connect_seconds): queueing for a free
+    connection once the pool is at its limit.
+    """
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.opened = 0
+        self.connect_seconds = 0.0
+        self.wait_seconds = 0.0
+        self._setup_started = None
+        self._sent = False
+
+    def event(self, name):
+        now = time.perf_counter()
+        if name == "connection.connect_tcp.started":
+            self._setup_started = now
+        elif name in ("connection.connect_tcp.complete", "connection.start_tls.complete"):
+            if name == "connection.connect_tcp.complete":
+                self.opened += 1
+            self.connect_seconds += now - self._setup_started
+            self._setup_started = now
+        elif name.endswith("send_request_headers.started") and not self._sent:
+            self._sent = True
+            self.wait_seconds = max(0.0, now - self.started - self.connect_seconds)
+
+
+def _chain(previous, probe):
+    def trace(name, info):
+        probe.event(name)
+        if previous is not None:
+            previous(name, info)
+    return trace
+
+
+def _chain_async(previous, probe):
+    async def trace(name, info):
+        probe.event(name)
+        if previous is not None:
+            await previous(name, info)
+    return trace
+
+
+def _connection_counts(transport):
+    conns = list(transport._pool.connections)
+    return len(conns), sum(1 for c in conns if c.is_idle())
+
+
+@functools.lru_cache(maxsize=None)
+def _transport_classes(lib):
+    """(sync, async) pooled transport classes for an httpx-compatible module."""
+    core = importlib.import_module(_CORE[lib.__name__])
+
+    class PooledTransport(lib.HTTPTransport):
+        def __init__(self, stats, dns, **kwargs):
+            super().__init__(**kwargs)
+            self.stats = stats
+            # httpx has no network_backend option; wrap the pool's own
+            self._pool._network_backend = _ResolvingBackend(self._pool._network_backend, dns, core)
+
+        def handle_request(self, request):
+            probe = _Probe()
+            request.extensions["trace"] = _chain(request.extensions.get("trace"), probe)
+            failed = True
+            try:
+                response = super().handle_request(request)
+                failed = False
+                return response
+            finally:
+                self.stats.record(probe, failed)
+
+        connections = _connection_counts
+
+    class AsyncPooledTransport(lib.AsyncHTTPTransport):
+        def __init__(self, stats, dns, **kwargs):
+            super().__init__(**kwargs)
+            self.stats = stats
+            self._pool._network_backend = _AsyncResolvingBackend(self._pool._network_backend, dns, core)
+
+        async def handle_async_request(self, request):
+            probe = _Probe()
+            request.extensions["trace"] = _chain_async(request.extensions.get("trace"), probe)
+            failed = True
+            try:
+                response = await super().handle_async_request(request)
+                failed = False
+                return response
+            finally:
+                self.stats.record(probe, failed)
+
+        connections = _connection_counts
+
+    return PooledTransport, AsyncPooledTransport
+
+
+def _library(client_cls):
+    """The httpx-compatible module a client class (or SDK subclass) is built on."""
+    for base in client_cls.__mro__:
+        name = base.__module__.split(".")[0]
+        if name in _CORE:
+            return importlib.import_module(name)
+    raise TypeError(f"{client_cls.__name__} is not an httpx client")
+
+
+# --------------------
+# POOLS
+# --------------------
+
+class TransportPools:
+    def __init__(self, max_connections=100, max_keepalive=64, keepalive_expiry=30.0,
+                 http2=None, dns_ttl=60.0):
+        self.max_connections = max_connections
+        self.max_keepalive = max_keepalive
+        self.keepalive_expiry = keepalive_expiry
+        self.http2 = HTTP2_AVAILABLE if http2 is None else (http2 and HTTP2_AVAILABLE)
+        self.dns_ttl = dns_ttl
+        self._lock = threading.Lock()
+        self._pid = None
+        self._dns = None
+        self._transports = {}  # (name, sync|async) -> [transports]
+
+    def _state(self):
+        # Nothing from a parent process is reused or reported after fork
+        if self._pid != os.getpid():
+            with self._lock:
+                if self._pid != os.getpid():
+                    self._dns = DNSCache(self.dns_ttl)
+                    self._transports = {}
+                    self._pid = os.getpid()
+        return self._dns
+
+    def _build(self, name, kind, lib, verify, overrides):
+        dns = self._state()
+        sync_cls, async_cls = _transport_classes(lib)
+        transport = (sync_cls if kind == "sync" else async_cls)(
+            PoolStats(), dns,
+            verify=verify,
+            http2=overrides.pop("http2", self.http2),
+            limits=lib.Limits(
+                max_connections=overrides.pop("max_connections", self.max_connections),
+                max_keepalive_connections=overrides.pop("max_keepalive", self.max_keepalive),
+                keepalive_expiry=overrides.pop("keepalive_expiry", self.keepalive_expiry)
+            )
+        )
+        with self._lock:
+            self._transports.setdefault((name, kind), []).append(transport)
+        return transport
+
+    def transport(self, name, verify=True, lib=httpx, **overrides):
+        """A new sync transport for `name`; pool settings can be overridden."""
+        return self._build(name, "sync", lib, verify, overrides)
+
+    def async_transport(self, name, verify=True, lib=httpx, **overrides):
+        return self._build(name, "async", lib, verify, overrides)
+
+    def client(self, name, cls=httpx.Client, verify=True, pool=None, **kwargs):
+        """cls(transport=..., **kwargs); cls may be an SDK's httpx.Client subclass."""
+        transport = self.transport(name, verify, _library(cls), **(pool or {}))
+        return cls(transport=transport, **kwargs)
+
+    def async_client(self, name, cls=httpx.AsyncClient, verify=True, pool=None, **kwargs):
+        transport = self.async_transport(name, verify, _library(cls), **(pool or {}))
+        return cls(transport=transport, **kwargs)
+
+    def stats(self):
+        dns = self._state()
+        with self._lock:
+            transports = {key: list(value) for key, value in self._transports.items()}
+        pools = {}
+        for (name, kind), group in sorted(transports.items()):
+            requests = sum(t.stats.requests for t in group)
+            opened = sum(t.stats.connections_opened for t in group)
+            wait = sum(t.stats.wait_seconds for t in group)
+            conns = [t.connections() for t in group]
+            pools[f"{name}:{kind}"] = {
+                "requests": requests,
+                "errors": sum(t.stats.errors for t in group),
+                "connections_opened": opened,
+                "connections_reused": max(0, requests - opened),
+                "connect_seconds": round(sum(t.stats.connect_seconds for t in group), 4),
+                "wait_seconds": round(wait, 4),
+                "avg_wait_ms": round(1000 * wait / requests, 3) if requests else 0.0,
+                "open_connections": sum(c[0] for c in conns),
+                "idle_connections": sum(c[1] for c in conns)
+            }
+        return {
+            "http2": self.http2,
+            "dns_cache": {"hits": dns.hits, "misses": dns.misses, "ttl": self.dns_ttl},
+            "pools": pools
+        }